@@ -1,14 +1,17 @@
 import logging
+from itertools import chain, islice
 
 from dateutil.parser import parse
-from flask import current_app, request, jsonify, g
-from sqlalchemy import and_
+from flask import current_app, request, jsonify, g, Response, \
+    stream_with_context
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm.exc import NoResultFound
 
 from apiserver.logconf import logger
 from apiserver.models import orm
-from apiserver.use_cases.usecases import UseCases
+from apiserver.respostas import codifica_json, envia_arquivo, status_excecao
+from apiserver.use_cases.usecases import UseCases, \
+    TAMANHO_PAGINA, arvore_campos, codifica_cursor, decodifica_cursor, \
+    decodifica_cursor_linha_tempo
 
 RECINTO = '00001'
 
@@ -16,17 +19,22 @@ RECINTO = '00001'
 def dump_eventos(eventos):
     eventos_dump = []
     for evento in eventos:
-        evento.hash = hash(evento)
-        eventos_dump.append(evento.dump())
+        if isinstance(evento, dict):
+            eventos_dump.append(evento)
+        else:
+            eventos_dump.append(evento.dump())
     return jsonify(eventos_dump)
 
 
 titles = {200: 'Evento encontrado',
           201: 'Evento incluido',
+          202: 'Evento aceito para processamento',
           400: 'Evento ou consulta invalidos (BAD Request)',
           401: 'Não autorizado',
           404: 'Evento ou recurso nao encontrado',
-          409: 'Erro de integridade'}
+          409: 'Erro de integridade',
+          429: 'Limite de requisições excedido',
+          500: 'Erro interno do servidor'}
 
 
 def get_recinto():
@@ -36,10 +44,23 @@ def get_recinto():
     return recinto
 
 
+def classe_evento(tipoevento: str):
+    """Classe ORM do tipo de evento. Outros nomes do módulo orm são recusados.
+
+    :raises AttributeError: tipoevento não é um tipo de evento
+    """
+    classes = dict([(aclass.__name__, aclass)
+                    for aclass in orm.EventoBase.__subclasses__()])
+    if tipoevento not in classes:
+        raise AttributeError('tipoevento "%s" não existente' % tipoevento)
+    return classes[tipoevento]
+
+
 def create_usecases():
     db_session = current_app.config['db_session']
     basepath = current_app.config['UPLOAD_FOLDER']
-    return UseCases(db_session, basepath)
+    return UseCases(db_session, basepath, current_app.config.get('duplicados'),
+                    current_app.config.get('ANEXOS_POR_HASH', False))
 
 
 def _response(msg, status_code, title=None):
@@ -56,11 +77,7 @@ def _response(msg, status_code, title=None):
 
 
 def _response_for_exception(exception, title=None):
-    status_code = 400
-    if isinstance(exception, IntegrityError):
-        status_code = 409
-    elif isinstance(exception, NoResultFound):
-        status_code = 404
+    status_code = status_excecao(exception)
     if title is None:
         title = titles[status_code]
     response = {'detail': str(exception),
@@ -70,7 +87,8 @@ def _response_for_exception(exception, title=None):
     return response, status_code
 
 
-def _commit(evento):
+def _grava(evento):
+    """Grava evento na sessão; o commit é feito no fim da requisição."""
     db_session = current_app.config['db_session']
     try:
         evento.request_IP = request.environ.get('HTTP_X_REAL_IP',
@@ -79,18 +97,15 @@ def _commit(evento):
         # evento.time_created = datetime.datetime.utcnow()
         db_session.flush()
         db_session.refresh(evento)
-        ohash = hash(evento)
-        db_session.commit()
-        logger.info('Recinto: %s Classe: %s IDEvento: %d ID: %d hash: %d' %
+        ohash = evento.hash
+        logger.info('Recinto: %s Classe: %s IDEvento: %s ID: %d hash: %s' %
                     (evento.recinto, evento.__class__.__name__,
-                     evento.IDEvento, evento.ID, ohash))
+                     evento.idEvento, evento.ID, ohash))
     except IntegrityError as err:
-        db_session.rollback()
         logging.error(err, exc_info=True)
         return _response('Evento repetido ou campo invalido: %s' % err,
                          409)
     except Exception as err:
-        db_session.rollback()
         logging.error(err, exc_info=True)
         return _response('Erro inesperado: %s ' % err, 400)
     return _response(ohash, 201)
@@ -104,10 +119,8 @@ def get_evento(IDEvento, aclass):
             aclass.recinto == get_recinto()
         ).one_or_none()
         # print(evento.dump() if evento is not None else 'None')
-        # print(hash(evento) if evento is not None else 'None')
         if evento is None:
             return _response('Evento não encontrado', 404)
-        evento.hash = hash(evento)
         return evento.dump(), 200
     except Exception as err:
         logging.error(err, exc_info=True)
@@ -118,36 +131,99 @@ def add_evento(aclass, evento):
     usecase = create_usecases()
     try:
         novo_evento = usecase.insert_evento(aclass, evento)
-        logger.info('Recinto: %s Classe: %s IDEvento: %d ID: %d Token: %d' %
+        logger.info('Recinto: %s Classe: %s IDEvento: %s ID: %d Token: %s' %
                     (novo_evento.recinto, novo_evento.__class__.__name__,
-                     novo_evento.IDEvento, novo_evento.ID, novo_evento.hash))
+                     novo_evento.idEvento, novo_evento.ID, novo_evento.hash))
     except IntegrityError as err:
-        usecase.db_session.rollback()
         logging.error(err, exc_info=True)
         return _response('Evento repetido ou campo invalido: %s' % err,
                          409)
     except Exception as err:
-        usecase.db_session.rollback()
         logging.error(err, exc_info=True)
         return _response('Erro inesperado: %s ' % err, 400)
     return _response(novo_evento.hash, 201)
 
 
+def ingestao_assincrona() -> bool:
+    return current_app.config.get('ingestao') is not None
+
+
+def enfileira_evento(aclass, evento):
+    """Valida evento e grava na fila de ingestão. Retorna ticket (202)."""
+    try:
+        create_usecases().verifica_duplicado(aclass, evento)
+        aclass(**evento)
+        ticket = current_app.config['ingestao'].enfileira(aclass.__name__,
+                                                          evento)
+    except Exception as err:
+        logging.error(err, exc_info=True)
+        return _response_for_exception(err)
+    return _response(ticket, 202)
+
+
+def get_ingestao(ticket):
+    fila = current_app.config.get('ingestao')
+    if fila is None:
+        return _response('Ingestão assíncrona desativada', 404)
+    situacao = fila.consulta(ticket)
+    if situacao is None:
+        return _response('Ticket não encontrado', 404)
+    return situacao, 200
+
+
+def get_duplicados():
+    duplicados = current_app.config.get('duplicados')
+    if duplicados is None:
+        return _response('Filtro de duplicados desativado', 404)
+    return duplicados.estatisticas(), 200
+
+
+def get_pool():
+    engine = current_app.config['engine']
+    telemetria = getattr(engine.pool, 'telemetria', None)
+    if telemetria is None:
+        return _response('Telemetria do pool desativada', 404)
+    return telemetria.estatisticas(engine.pool), 200
+
+
+def add_lote(aclass, eventos):
+    """Insere lote de eventos. Retorna resposta padrão para cada evento."""
+    usecase = create_usecases()
+    resultados = usecase.insert_eventos_lote(aclass, eventos)
+    respostas = []
+    for evento, resultado in zip(eventos, resultados):
+        if isinstance(resultado, Exception):
+            logging.error('Lote %s idEvento %s: %s' %
+                          (aclass.__name__, evento.get('idEvento'), resultado))
+            resposta, _ = _response_for_exception(resultado)
+        else:
+            resposta, _ = _response(resultado.hash, 201)
+        resposta['idEvento'] = evento.get('idEvento')
+        respostas.append(resposta)
+    return respostas, 201
+
+
 def pesagemveiculocarga(evento):
+    if ingestao_assincrona():
+        return enfileira_evento(orm.PesagemVeiculoCarga, evento)
     usecase = create_usecases()
     try:
         evento = usecase.insert_pesagemveiculocarga(evento)
     except Exception as err:
         logging.error(err, exc_info=True)
-        usecase.db_session.rollback()
         return _response_for_exception(err)
     return _response(evento.hash, 201)
 
 
-def get_pesagemveiculocarga(codRecinto, IDEvento):
+def pesagemveiculocarga_lote(eventos):
+    return add_lote(orm.PesagemVeiculoCarga, eventos)
+
+
+def get_pesagemveiculocarga(codRecinto, IDEvento, fields=None):
     usecase = create_usecases()
     try:
-        evento = usecase.load_pesagemveiculocarga(codRecinto, IDEvento)
+        campos = arvore_campos(orm.PesagemVeiculoCarga, fields)
+        evento = usecase.load_pesagemveiculocarga(codRecinto, IDEvento, campos)
         return evento, 200
     except Exception as err:
         logging.error(err, exc_info=True)
@@ -155,41 +231,66 @@ def get_pesagemveiculocarga(codRecinto, IDEvento):
 
 
 def inspecaonaoinvasiva(evento):
+    if ingestao_assincrona():
+        return enfileira_evento(orm.InspecaonaoInvasiva, evento)
     usecase = create_usecases()
     try:
         inspecaonaoinvasiva = usecase.insert_inspecaonaoinvasiva(evento)
     except Exception as err:
         logging.error(err, exc_info=True)
-        usecase.db_session.rollback()
         return _response_for_exception(err)
     return _response(inspecaonaoinvasiva.hash, 201)
 
 
-def get_inspecaonaoinvasiva(codRecinto, IDEvento):
+def inspecaonaoinvasiva_lote(eventos):
+    return add_lote(orm.InspecaonaoInvasiva, eventos)
+
+
+def get_inspecaonaoinvasiva(codRecinto, IDEvento, fields=None):
     usecase = create_usecases()
     try:
-        inspecaonaoinvasiva = usecase.load_inspecaonaoinvasiva(codRecinto, IDEvento)
+        campos = arvore_campos(orm.InspecaonaoInvasiva, fields)
+        inspecaonaoinvasiva = usecase.load_inspecaonaoinvasiva(codRecinto, IDEvento, campos)
         return inspecaonaoinvasiva, 200
     except Exception as err:
         logging.error(err, exc_info=True)
         return _response_for_exception(err)
 
 
+def get_anexo_inspecaonaoinvasiva(codRecinto, IDEvento, nomeArquivo):
+    usecase = create_usecases()
+    try:
+        anexo = usecase.load_anexo(orm.InspecaonaoInvasiva, codRecinto,
+                                   IDEvento, nomeArquivo)
+        return envia_arquivo(
+            anexo.caminhos_arquivo(usecase.basepath, usecase.por_hash),
+            anexo.contentType, anexo.hashArquivo)
+    except Exception as err:
+        logging.error(err, exc_info=True)
+        return _response_for_exception(err)
+
+
 def acessoveiculo(evento):
+    if ingestao_assincrona():
+        return enfileira_evento(orm.AcessoVeiculo, evento)
     usecase = create_usecases()
     try:
         evento = usecase.insert_acessoveiculo(evento)
     except Exception as err:
         logging.error(err, exc_info=True)
-        usecase.db_session.rollback()
         return _response_for_exception(err)
     return _response(evento.hash, 201)
 
 
-def get_acessoveiculo(codRecinto, IDEvento):
+def acessoveiculo_lote(eventos):
+    return add_lote(orm.AcessoVeiculo, eventos)
+
+
+def get_acessoveiculo(codRecinto, IDEvento, fields=None):
     usecase = create_usecases()
     try:
-        evento = usecase.load_acessoveiculo(codRecinto, IDEvento)
+        campos = arvore_campos(orm.AcessoVeiculo, fields)
+        evento = usecase.load_acessoveiculo(codRecinto, IDEvento, campos)
         return evento, 200
     except Exception as err:
         logging.error(err, exc_info=True)
@@ -198,8 +299,12 @@ def get_acessoveiculo(codRecinto, IDEvento):
 
 
 def filter_eventos(filtro):
-    db_session = current_app.config['db_session']
-    print(filtro)
+    """Eventos do filtro, em array JSON ou NDJSON (Accept: application/x-ndjson).
+
+    A resposta é gerada em streaming, lote a lote. Erro na leitura do
+    primeiro lote tem resposta de erro; erro depois do início do streaming
+    interrompe a resposta, que chega incompleta ao cliente.
+    """
     recinto = filtro.get('recinto')
     datainicial = filtro.get('datainicial')
     datafinal = filtro.get('datafinal')
@@ -211,26 +316,135 @@ def filter_eventos(filtro):
         return _response('Datas inválidas, verifique.', 400)
     try:
         tipoevento = filtro.get('tipoevento')
-        aclass = getattr(orm, tipoevento)
+        aclass = classe_evento(tipoevento)
     except AttributeError as err:
         logging.error(err, exc_info=True)
         return _response('Erro no campo tipoevento do filtro %s ' % str(err), 400)
     try:
-        filters = [aclass.dataevento.between(datainicial, datafinal)]
-        if recinto:
-            filters.append(aclass.recinto == recinto)
-        eventos = db_session.query(aclass).filter(
-            and_(*filters)
-        ).all()
-        if eventos is None:
-            return _response('Sem eventos tipo %s para recinto %s '
-                             'no intervalo de datas %s a %s.' %
-                             (tipoevento, recinto, datainicial, datafinal), 404)
-        return dump_eventos(eventos)
+        campos = arvore_campos(aclass, filtro.get('fields'))
+    except ValueError as err:
+        return _response(err, 400)
+    usecase = create_usecases()
+    lotes = usecase.gera_eventos_filtro(aclass, datainicial, datafinal, recinto,
+                                        campos=campos)
+    try:
+        lotes = chain([next(lotes, [])], lotes)
     except Exception as err:
         logging.error(err, exc_info=True)
-        return _response(err, 405)
-
-
-def get_eventosnovos():
-    pass
\ No newline at end of file
+        return _response_for_exception(err)
+    if 'application/x-ndjson' in request.headers.get('Accept', ''):
+        return Response(stream_with_context(_gera_ndjson(lotes)),
+                        mimetype='application/x-ndjson')
+    return Response(stream_with_context(_gera_json(lotes)),
+                    mimetype='application/json')
+
+
+def _gera_json(lotes):
+    """Escreve array JSON, um pedaço por lote de eventos.
+
+    Exceção não é tratada: com status 200 já enviado, interromper a
+    resposta é a forma de o cliente não receber resultado truncado como
+    se fosse completo.
+    """
+    yield b'['
+    separador = b''
+    for lote in lotes:
+        if lote:
+            yield separador + b','.join(
+                [codifica_json(evento) for evento in lote])
+            separador = b','
+    yield b']'
+
+
+def _gera_ndjson(lotes):
+    """Escreve um evento JSON por linha, um pedaço por lote de eventos."""
+    for lote in lotes:
+        yield b''.join([codifica_json(evento) + b'\n'
+                        for evento in lote])
+
+
+def timeline_eventos(filtro):
+    """Linha do tempo do recinto: eventos de vários tipos, paginados em
+    ordem de dtHrOcorrencia, cada um com o campo tipoevento.
+    """
+    recinto = filtro.get('recinto')
+    try:
+        datainicial = parse(filtro.get('datainicial'))
+        datafinal = parse(filtro.get('datafinal'))
+    except Exception as err:
+        logging.error(err, exc_info=True)
+        return _response('Datas inválidas, verifique.', 400)
+    classes = dict([(aclass.__name__, aclass)
+                    for aclass in orm.EventoBase.__subclasses__()])
+    tiposevento = filtro.get('tiposevento') or sorted(classes.keys())
+    invalidos = [tipo for tipo in tiposevento if tipo not in classes]
+    if invalidos:
+        return _response('Tipos de evento inválidos: %s' % invalidos, 400)
+    apos = None
+    cursor = filtro.get('after')
+    if cursor:
+        try:
+            apos = decodifica_cursor_linha_tempo(cursor)
+        except ValueError as err:
+            return _response(err, 400)
+    limite = filtro.get('limit', TAMANHO_PAGINA)
+    try:
+        usecase = create_usecases()
+        # Um a mais que o limite, lido de cada tabela, para saber se há mais
+        itens = list(islice(usecase.gera_linha_tempo(
+            [classes[tipo] for tipo in tiposevento], recinto,
+            datainicial, datafinal, apos, tamanho_lote=limite + 1),
+            limite + 1))
+    except Exception as err:
+        logging.error(err, exc_info=True)
+        return _response(err, 400)
+    mais = len(itens) > limite
+    itens = itens[:limite]
+    eventos = [{'tipoevento': tipoevento, **dump}
+               for _, tipoevento, _, dump in itens]
+    if itens:
+        dtHrOcorrencia, tipoevento, ID, _ = itens[-1]
+        cursor = codifica_cursor(dtHrOcorrencia.isoformat(), tipoevento, ID)
+    return {'eventos': eventos,
+            'cursor': cursor,
+            'mais': mais}, 200
+
+
+def get_eventosnovos(filtro):
+    """Feed de eventos novos, paginado por cursor (keyset em ID).
+
+    Retorna os eventos após o cursor "after" (ou após IDEvento, na primeira
+    chamada) e o cursor para a próxima página. Com o feed em dia, a página
+    vem vazia e o cursor recebido é devolvido, para novas consultas.
+    """
+    tipoevento = filtro.get('tipoevento')
+    try:
+        aclass = classe_evento(tipoevento)
+    except AttributeError as err:
+        logging.error(err, exc_info=True)
+        return _response('Erro no campo tipoevento do filtro %s ' % str(err), 400)
+    apos = filtro.get('IDEvento') or 0
+    cursor = filtro.get('after')
+    if cursor:
+        try:
+            tipocursor, apos = decodifica_cursor(cursor)
+            if tipocursor != tipoevento:
+                raise ValueError('Cursor de outro tipo de evento: %s' % tipocursor)
+        except ValueError as err:
+            return _response(err, 400)
+    limite = filtro.get('limit', TAMANHO_PAGINA)
+    try:
+        campos = arvore_campos(aclass, filtro.get('fields'))
+        if campos is not None:
+            campos['ID'] = None  # Cursor da próxima página
+        usecase = create_usecases()
+        eventos = usecase.load_pagina_eventos(aclass, apos, limite,
+                                              filtro.get('recinto'), campos)
+    except Exception as err:
+        logging.error(err, exc_info=True)
+        return _response(err, 400)
+    if eventos:
+        apos = eventos[-1]['ID']
+    return {'eventos': eventos,
+            'cursor': codifica_cursor(tipoevento, apos),
+            'mais': len(eventos) == limite}, 200
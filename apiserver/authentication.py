@@ -1,8 +1,11 @@
+import hashlib
 import logging
 import os
 import pickle
+import threading
 import time
 from base64 import b85decode
+from collections import OrderedDict
 
 import six
 from flask import request, jsonify, g, current_app
@@ -27,6 +30,62 @@ JWT_ISSUER = 'api-recintos'
 JWT_SECRET = str(make_secret())
 JWT_LIFETIME_SECONDS = 600
 JWT_ALGORITHM = 'HS256'
+# Caminhos liberados de token, relativos à raiz da API
+CAMINHOS_LIVRES = ('/', '/openapi.json', '/auth', '/privatekey')
+
+
+class CacheTokens:
+    """LRU de tokens que já passaram pela verificação do JWT.
+
+    A chave é o SHA-256 do token, para não guardar tokens em claro. Cada
+    entrada vale até o exp do próprio token; depois disso o token volta
+    a ser verificado (e rejeitado) pelo jwt.decode.
+
+    Contadores:
+        hits: tokens aceitos sem jwt.decode
+        misses: tokens verificados por jwt.decode (novos ou expirados)
+    """
+
+    def __init__(self, capacidade: int = 10000):
+        self.capacidade = capacidade
+        self.tokens = OrderedDict()
+        self.contadores = {'hits': 0, 'misses': 0}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _chave(token: str) -> bytes:
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def claims(self, token: str, agora: float = None) -> dict:
+        """Claims do token, se em cache e ainda válido, senão None."""
+        if agora is None:
+            agora = time.time()
+        chave = self._chave(token)
+        with self.lock:
+            claims = self.tokens.get(chave)
+            if claims is not None and agora < claims['exp']:
+                self.tokens.move_to_end(chave)
+                self.contadores['hits'] += 1
+                return claims
+            if claims is not None:
+                del self.tokens[chave]
+            self.contadores['misses'] += 1
+        return None
+
+    def adiciona(self, token: str, claims: dict):
+        if 'exp' not in claims:
+            return  # Sem validade definida: verifica sempre
+        chave = self._chave(token)
+        with self.lock:
+            self.tokens[chave] = claims
+            self.tokens.move_to_end(chave)
+            while len(self.tokens) > self.capacidade:
+                self.tokens.popitem(last=False)
+
+    def estatisticas(self) -> dict:
+        with self.lock:
+            return {**self.contadores, 'tamanho': len(self.tokens),
+                    'capacidade': self.capacidade}
 
 
 def generate_token(recinto):
@@ -54,6 +113,25 @@ def decode_token(token):
                         (token, (str(err))))
 
 
+def verifica_token(token, cache: CacheTokens = None) -> dict:
+    """Retorna claims do token, do cache ou verificadas por decode_token."""
+    if cache is not None:
+        claims = cache.claims(token)
+        if claims is not None:
+            return claims
+    claims = decode_token(token)
+    if cache is not None:
+        cache.adiciona(token, claims)
+    return claims
+
+
+def get_cache_tokens():
+    cache = current_app.config.get('cache_tokens')
+    if cache is None:
+        return _response('Autenticação desativada', 404)
+    return cache.estatisticas(), 200
+
+
 def get_secret(user, token_info) -> str:
     return """
     You are user_id {user} and the secret is 'wbevuec'.
@@ -80,7 +158,8 @@ def valida_token_e_assinatura(request, db_session=None) -> [bool, str]:
     """Analisa request e retorna True ou False
 
     1. Retira token do header
-    2. Decodifica token
+    2. Decodifica token (ou usa o já verificado, em cache)
+    3. Coloca o recinto do token em g.recinto
 
     :param request: Objeto request
     :param db_session: Conexão ao BD
@@ -93,11 +172,12 @@ def valida_token_e_assinatura(request, db_session=None) -> [bool, str]:
     try:
         if db_session is None:
             db_session = current_app.config['db_session']
-        # print(token)
-        decoded_token = decode_token(token)
+        decoded_token = verifica_token(token,
+                                       current_app.config.get('cache_tokens'))
     except Exception as err:
         logging.error(err, exc_info=True)
         return False, str(err)
+    g.recinto = decoded_token.get('recinto')
     return True, None
 
 
@@ -111,10 +191,14 @@ def configure_signature(app):
             ' Configure a variável de ambiente ($export AUTHENTICATE=YES) para ativar.'
         )
         return
+    app.app.config['cache_tokens'] = CacheTokens(
+        int(os.environ.get('CACHE_TOKENS_CAPACIDADE', 10000)))
 
     @app.app.before_request
     def before_request():
-        if request.path in ['/', '/openapi.json', '/auth', '/privatekey']:
+        # request.path inclui o prefixo da API (servers do openapi.yaml)
+        caminho = request.path.split('/apirecintos', 1)[-1] or '/'
+        if caminho in CAMINHOS_LIVRES:
             return
         if 'site' in request.path or '/ui' in request.path:
             return
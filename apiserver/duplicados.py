@@ -0,0 +1,173 @@
+"""Filtro em memória de eventos já gravados, por (codRecinto, idEvento).
+
+Evita ir ao Banco (flush, IntegrityError e rollback) para rejeitar
+retransmissões. Um filtro de Bloom por tipo de evento diz se a chave
+certamente não existe ou talvez exista. Só no segundo caso o Banco é
+consultado, para confirmação exata.
+
+O filtro é aquecido com as chaves do Banco em segundo plano, na subida do
+app (de cada worker), e atualizado a cada commit deste processo. Até o
+fim do aquecimento, todas as chaves são confirmadas no Banco, como sem
+filtro. Chaves gravadas por outros processos não são vistas, mas
+continuam barradas pelo índice único do Banco.
+
+Variáveis de ambiente:
+    FILTRO_DUPLICADOS: YES para ligar (padrão NO)
+    FILTRO_DUPLICADOS_CAPACIDADE: chaves previstas por tipo de evento
+"""
+import hashlib
+import logging
+import math
+import os
+import threading
+
+from apiserver.models import orm
+
+TAXA_FALSOS_POSITIVOS = 0.01
+
+
+class FiltroBloom:
+    """Filtro de Bloom sobre bytearray, com k hashes derivados de blake2b."""
+
+    def __init__(self, capacidade: int,
+                 taxa_falsos_positivos: float = TAXA_FALSOS_POSITIVOS):
+        self.num_bits = max(8, int(-capacidade * math.log(taxa_falsos_positivos)
+                                   / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacidade * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.lock = threading.Lock()
+
+    def _posicoes(self, chave: str):
+        digest = hashlib.blake2b(chave.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def adiciona(self, chave: str):
+        with self.lock:
+            for posicao in self._posicoes(chave):
+                self.bits[posicao >> 3] |= 1 << (posicao & 7)
+
+    def __contains__(self, chave: str) -> bool:
+        return all(self.bits[posicao >> 3] & (1 << (posicao & 7))
+                   for posicao in self._posicoes(chave))
+
+
+def chave_filtro(chave: tuple) -> str:
+    codRecinto, idEvento = chave
+    return '%s\x1f%s' % (codRecinto, idEvento)
+
+
+class FiltroDuplicados:
+    """Um FiltroBloom por tipo de evento, com contadores de uso.
+
+    Contadores por tipo de evento:
+        hits: repetidos confirmados e rejeitados antes de montar o ORM
+        misses: chaves certamente novas, sem consulta ao Banco
+        falsos_positivos: consultas ao Banco que não acharam a chave
+    """
+
+    def __init__(self, capacidade: int = 1000000):
+        self.capacidade = capacidade
+        self.filtros = {}
+        self.contadores = {}
+        self.lock = threading.Lock()
+        self.aquecido = threading.Event()
+
+    def _filtro(self, aclass) -> FiltroBloom:
+        filtro = self.filtros.get(aclass)
+        if filtro is None:
+            with self.lock:
+                filtro = self.filtros.setdefault(aclass,
+                                                 FiltroBloom(self.capacidade))
+                self.contadores.setdefault(
+                    aclass, {'hits': 0, 'misses': 0, 'falsos_positivos': 0})
+        return filtro
+
+    def adiciona(self, aclass, chave: tuple):
+        self._filtro(aclass).adiciona(chave_filtro(chave))
+
+    def existentes(self, aclass, chaves, confirma) -> set:
+        """Retorna as chaves já gravadas no Banco.
+
+        :param aclass: Classe ORM do evento
+        :param chaves: lista de tuplas (codRecinto, idEvento)
+        :param confirma: função que recebe lista de chaves e retorna as que
+            existem no Banco. Só é chamada com as chaves que o filtro aponta
+        :return: set de chaves existentes
+        """
+        filtro = self._filtro(aclass)
+        if not self.aquecido.is_set():
+            # Filtro ainda sem as chaves antigas: não descarta nenhuma
+            return set(confirma(chaves)) if chaves else set()
+        talvez = [chave for chave in chaves if chave_filtro(chave) in filtro]
+        existentes = set(confirma(talvez)) if talvez else set()
+        with self.lock:
+            contadores = self.contadores[aclass]
+            contadores['misses'] += len(chaves) - len(talvez)
+            contadores['hits'] += len(existentes)
+            contadores['falsos_positivos'] += len(talvez) - len(existentes)
+        return existentes
+
+    def aquece(self, db_session, classes):
+        """Carrega no filtro as chaves já gravadas no Banco e o libera."""
+        for aclass in classes:
+            query = db_session.query(aclass.codRecinto,
+                                     aclass.idEvento).yield_per(10000)
+            for chave in query:
+                self.adiciona(aclass, tuple(chave))
+        db_session.rollback()
+        self.aquecido.set()
+
+    def estatisticas(self) -> dict:
+        with self.lock:
+            return dict([(aclass.__name__, dict(contadores))
+                         for aclass, contadores in self.contadores.items()])
+
+
+def _aquece(duplicados: FiltroDuplicados, db_session, classes):
+    try:
+        duplicados.aquece(db_session, classes)
+        logging.info('Filtro de duplicados aquecido')
+    except Exception as err:
+        # Sem aquecer, o filtro segue consultando o Banco para toda chave
+        logging.error('Erro ao aquecer filtro de duplicados: %s', err,
+                      exc_info=True)
+        db_session.rollback()
+
+
+def _aquece_em_segundo_plano(duplicados: FiltroDuplicados, db_session,
+                             classes):
+    try:
+        _aquece(duplicados, db_session, classes)
+    finally:
+        db_session.remove()
+
+
+def configure_duplicados(app, ativo: bool = None, capacidade: int = None,
+                         segundo_plano: bool = True):
+    """Cria e aquece o filtro de duplicados do app, se configurado.
+
+    :param segundo_plano: aquecer em thread própria, sem atrasar a subida
+        do worker (a leitura de todas as chaves pode ser demorada)
+    """
+    if ativo is None:
+        ativo = os.environ.get('FILTRO_DUPLICADOS', 'NO').lower() == 'yes'
+    app.app.config['duplicados'] = None
+    if not ativo:
+        return None
+    if capacidade is None:
+        capacidade = int(os.environ.get('FILTRO_DUPLICADOS_CAPACIDADE',
+                                        1000000))
+    duplicados = FiltroDuplicados(capacidade)
+    classes = orm.EventoBase.__subclasses__()
+    db_session = app.app.config['db_session']
+    if segundo_plano:
+        threading.Thread(target=_aquece_em_segundo_plano,
+                         args=(duplicados, db_session, classes),
+                         name='aquece-duplicados', daemon=True).start()
+    else:
+        _aquece(duplicados, db_session, classes)
+    app.app.config['duplicados'] = duplicados
+    return duplicados
@@ -0,0 +1,307 @@
+"""Ingestão assíncrona de eventos (write-behind).
+
+Com a ingestão assíncrona ligada, os POSTs de eventos apenas validam o
+evento e o gravam em uma fila durável local (SQLite), respondendo 202 com
+um ticket. Trabalhadores em segundo plano retiram os eventos da fila em
+lotes e os gravam no Banco via UseCases.insert_eventos_lote.
+O resultado (hash ou erro) fica na fila para consulta em /ingestao/{ticket}:
+o evento em si é apagado da fila ao concluir, e o resultado, depois de
+INGESTAO_RETENCAO segundos.
+
+Variáveis de ambiente:
+    INGESTAO_ASSINCRONA: YES para ligar (padrão NO)
+    INGESTAO_DB: caminho do arquivo SQLite da fila
+    INGESTAO_TRABALHADORES: número de threads trabalhadoras por processo
+    INGESTAO_LOTE: máximo de eventos gravados por transação
+    INGESTAO_RETENCAO: segundos que o resultado fica disponível para
+        consulta (padrão 604800, uma semana)
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from apiserver.models import orm
+from apiserver.respostas import status_excecao
+from apiserver.use_cases.usecases import EventoDuplicado, UseCases
+
+PENDENTE = 'pendente'
+PROCESSANDO = 'processando'
+CONCLUIDO = 'concluido'
+ERRO = 'erro'
+
+# Segundos que um lote fica reservado para um trabalhador. Passado o prazo,
+# outro trabalhador pode reprocessá-lo (ex: processo que caiu no meio do lote)
+PRAZO_RESERVA = 300
+# Segundos entre limpezas da fila feitas por um trabalhador ocioso
+INTERVALO_LIMPEZA = 60
+
+
+class FilaIngestao:
+    """Fila durável de eventos a gravar, em arquivo SQLite.
+
+    Pode ser compartilhada por threads e processos: cada operação abre sua
+    própria conexão e a reserva de itens é feita em transação exclusiva.
+    """
+
+    def __init__(self, caminho: str):
+        self.caminho = caminho
+        with self._conexao() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS fila ('
+                'ticket TEXT PRIMARY KEY, '
+                'tipoevento TEXT NOT NULL, '
+                'evento TEXT NOT NULL, '
+                'situacao TEXT NOT NULL, '
+                'status INTEGER, '
+                'detail TEXT, '
+                'criado REAL NOT NULL, '
+                'reservado_ate REAL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS fila_situacao_idx '
+                         'ON fila (situacao, criado)')
+
+    @contextmanager
+    def _conexao(self):
+        conn = sqlite3.connect(self.caminho, timeout=30, isolation_level=None)
+        try:
+            conn.execute('PRAGMA synchronous=FULL')
+            yield conn
+        finally:
+            conn.close()
+
+    def enfileira(self, tipoevento: str, evento: dict) -> str:
+        """Grava evento na fila e retorna o ticket para consulta."""
+        ticket = uuid.uuid4().hex
+        with self._conexao() as conn:
+            conn.execute(
+                'INSERT INTO fila (ticket, tipoevento, evento, situacao, criado) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (ticket, tipoevento, json.dumps(evento), PENDENTE, time.time())
+            )
+        return ticket
+
+    def reserva(self, quantidade: int) -> list:
+        """Reserva até quantidade eventos pendentes, na ordem de chegada.
+
+        Itens com reserva vencida são reservados de novo: o trabalhador
+        anterior pode ter gravado o evento no Banco sem chegar a concluí-lo.
+
+        :return: lista de (ticket, tipoevento, evento, reprocessado)
+        """
+        agora = time.time()
+        with self._conexao() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                itens = conn.execute(
+                    'SELECT ticket, tipoevento, evento, situacao FROM fila '
+                    'WHERE situacao = ? OR (situacao = ? AND reservado_ate < ?) '
+                    'ORDER BY criado LIMIT ?',
+                    (PENDENTE, PROCESSANDO, agora, quantidade)
+                ).fetchall()
+                conn.executemany(
+                    'UPDATE fila SET situacao = ?, reservado_ate = ? '
+                    'WHERE ticket = ?',
+                    [(PROCESSANDO, agora + PRAZO_RESERVA, item[0])
+                     for item in itens]
+                )
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return [(ticket, tipoevento, json.loads(evento),
+                 situacao == PROCESSANDO)
+                for ticket, tipoevento, evento, situacao in itens]
+
+    def conclui(self, resultados: list):
+        """Grava resultado dos eventos processados e descarta os eventos.
+
+        :param resultados: lista de (ticket, status HTTP, hash ou erro)
+        """
+        with self._conexao() as conn:
+            conn.executemany(
+                'UPDATE fila SET situacao = ?, status = ?, detail = ?, '
+                "evento = '', reservado_ate = NULL WHERE ticket = ?",
+                [(CONCLUIDO if status == 201 else ERRO, status, detail, ticket)
+                 for ticket, status, detail in resultados]
+            )
+
+    def limpa(self, retencao: float, agora: float = None) -> int:
+        """Apaga resultados de itens criados há mais de retencao segundos.
+
+        :return: quantidade de itens apagados
+        """
+        if agora is None:
+            agora = time.time()
+        with self._conexao() as conn:
+            cursor = conn.execute(
+                'DELETE FROM fila WHERE situacao IN (?, ?) AND criado < ?',
+                (CONCLUIDO, ERRO, agora - retencao))
+        return cursor.rowcount
+
+    def consulta(self, ticket: str) -> dict:
+        """Retorna situação do ticket ou None se não existir."""
+        with self._conexao() as conn:
+            item = conn.execute(
+                'SELECT ticket, tipoevento, situacao, status, detail '
+                'FROM fila WHERE ticket = ?', (ticket,)
+            ).fetchone()
+        if item is None:
+            return None
+        return dict(zip(['ticket', 'tipoevento', 'situacao', 'status', 'detail'],
+                        item))
+
+
+class TrabalhadorIngestao(threading.Thread):
+    """Thread que grava no Banco, em lotes, os eventos da fila."""
+
+    def __init__(self, fila: FilaIngestao, db_session, basepath: str,
+                 tamanho_lote: int = 100, intervalo: float = 0.5,
+                 duplicados=None, retencao: float = 604800,
+                 por_hash: bool = False):
+        super().__init__(daemon=True)
+        self.fila = fila
+        self.db_session = db_session
+        self.basepath = basepath
+        self.duplicados = duplicados
+        self.por_hash = por_hash
+        self.tamanho_lote = tamanho_lote
+        self.intervalo = intervalo
+        self.retencao = retencao
+        self.ultima_limpeza = 0.
+        self.parar = threading.Event()
+
+    def hash_gravado(self, usecase: UseCases, aclass, evento: dict) -> str:
+        """Hash do evento no Banco, se for este mesmo evento (mesmo hash)."""
+        chave = (evento.get('codRecinto'), evento.get('idEvento'))
+        gravado = usecase.valores_por_chave(aclass, [chave], 'hash').get(chave)
+        if gravado is not None and gravado == orm.digest_evento(evento):
+            return gravado
+        return None
+
+    def grava(self, usecase: UseCases, aclass, eventos: list) -> list:
+        """Grava e confirma eventos de um tipo; se o lote falhar, um a um.
+
+        Um evento malformado não leva o erro aos demais eventos do lote,
+        que podem ser de outros recintos.
+
+        :return: lista, na ordem de eventos, com o evento gravado ou a exceção
+        """
+        try:
+            resultados = usecase.insert_eventos_lote(aclass, eventos)
+            self.db_session.commit()
+            return resultados
+        except Exception as err:
+            self.db_session.rollback()
+            logging.error(err, exc_info=True)
+            if len(eventos) == 1:
+                return [err]
+        resultados = []
+        for evento in eventos:
+            resultados.extend(self.grava(usecase, aclass, [evento]))
+        return resultados
+
+    def processa_lote(self) -> int:
+        """Grava um lote da fila. Retorna quantidade de eventos processados."""
+        itens = self.fila.reserva(self.tamanho_lote)
+        por_tipo = {}
+        for ticket, tipoevento, evento, reprocessado in itens:
+            por_tipo.setdefault(tipoevento, []).append(
+                (ticket, evento, reprocessado))
+        usecase = UseCases(self.db_session, self.basepath, self.duplicados,
+                           self.por_hash)
+        for tipoevento, lista in por_tipo.items():
+            try:
+                aclass = getattr(orm, tipoevento)
+            except AttributeError as err:
+                logging.error(err, exc_info=True)
+                resultados = [err] * len(lista)
+            else:
+                resultados = self.grava(usecase, aclass,
+                                        [evento for _, evento, _ in lista])
+            conclusoes = []
+            for (ticket, evento, reprocessado), resultado in zip(lista,
+                                                                 resultados):
+                if reprocessado and isinstance(resultado, EventoDuplicado):
+                    # Gravado por trabalhador que não chegou a concluir:
+                    # o reprocessamento devolve o mesmo resultado
+                    gravado = self.hash_gravado(usecase, aclass, evento)
+                    if gravado is not None:
+                        resultado = gravado
+                if isinstance(resultado, Exception):
+                    conclusoes.append((ticket, status_excecao(resultado),
+                                       str(resultado)))
+                elif isinstance(resultado, str):
+                    conclusoes.append((ticket, 201, resultado))
+                else:
+                    conclusoes.append((ticket, 201, resultado.hash))
+            self.fila.conclui(conclusoes)
+        return len(itens)
+
+    def limpa_fila(self):
+        """Apaga resultados antigos da fila, no máximo a cada INTERVALO_LIMPEZA."""
+        agora = time.time()
+        if agora - self.ultima_limpeza < INTERVALO_LIMPEZA:
+            return
+        self.ultima_limpeza = agora
+        apagados = self.fila.limpa(self.retencao, agora)
+        if apagados:
+            logging.info('Fila de ingestão: %d resultados antigos apagados',
+                         apagados)
+
+    def run(self):
+        while not self.parar.is_set():
+            try:
+                processados = self.processa_lote()
+                if processados == 0:
+                    self.limpa_fila()
+            except Exception as err:
+                logging.error(err, exc_info=True)
+                processados = 0
+            finally:
+                self.db_session.remove()
+            if processados == 0:
+                self.parar.wait(self.intervalo)
+
+
+def configure_ingestao(app, ativa: bool = None, caminho: str = None,
+                       trabalhadores: int = None, tamanho_lote: int = None,
+                       retencao: float = None):
+    """Liga a ingestão assíncrona no app, se configurada.
+
+    Parâmetros não informados são lidos das variáveis de ambiente.
+    """
+    if ativa is None:
+        ativa = os.environ.get('INGESTAO_ASSINCRONA', 'NO').lower() == 'yes'
+    app.app.config['ingestao'] = None
+    if not ativa:
+        return None
+    if caminho is None:
+        caminho = os.environ.get(
+            'INGESTAO_DB',
+            os.path.join(os.path.dirname(__file__), 'ingestao.db'))
+    if trabalhadores is None:
+        trabalhadores = int(os.environ.get('INGESTAO_TRABALHADORES', 2))
+    if tamanho_lote is None:
+        tamanho_lote = int(os.environ.get('INGESTAO_LOTE', 100))
+    if retencao is None:
+        retencao = float(os.environ.get('INGESTAO_RETENCAO', 604800))
+    fila = FilaIngestao(caminho)
+    app.app.config['ingestao'] = fila
+    app.app.config['ingestao_trabalhadores'] = []
+    for _ in range(trabalhadores):
+        trabalhador = TrabalhadorIngestao(
+            fila, app.app.config['db_session'], app.app.config['UPLOAD_FOLDER'],
+            tamanho_lote, duplicados=app.app.config.get('duplicados'),
+            retencao=retencao,
+            por_hash=app.app.config.get('ANEXOS_POR_HASH', False))
+        trabalhador.start()
+        app.app.config['ingestao_trabalhadores'].append(trabalhador)
+    logging.info('Ingestão assíncrona ativa: fila %s, %d trabalhadores',
+                 caminho, trabalhadores)
+    return fila
@@ -0,0 +1,222 @@
+"""Limite de taxa de gravação por recinto (token bucket).
+
+Cada recinto tem um balde com até LIMITE_RAJADA fichas, reabastecido a
+LIMITE_TAXA fichas por segundo. Cada POST de gravação consome uma ficha
+por evento enviado; o upload de arquivo de eventos, uma ficha a cada
+LIMITE_BYTES_FICHA bytes do arquivo (descompactado, se zip); o upload de
+anexo, uma ficha. Sem fichas suficientes, a resposta é 429 com
+Retry-After, sem tocar o Banco: um recinto descarregando atraso de
+contingência não atrasa os demais.
+Requisição maior que a rajada deixa o balde negativo, e o Retry-After das
+seguintes cresce com o tamanho dela.
+
+O recinto vem do token JWT (g.recinto) ou, sem autenticação, do
+codRecinto do evento enviado. Requisição sem recinto identificado usa o
+balde do endereço do cliente. Os baldes ficam em arquivo SQLite local,
+compartilhado pelos workers do gunicorn da máquina.
+
+Variáveis de ambiente:
+    LIMITE_RECINTO: YES para ligar (padrão NO)
+    LIMITE_TAXA: fichas (eventos) por segundo por recinto (padrão 20)
+    LIMITE_RAJADA: fichas acumuladas no máximo por recinto (padrão 200)
+    LIMITE_BYTES_FICHA: bytes de arquivo de eventos por ficha, o tamanho
+        típico de um evento (padrão 2048)
+    LIMITE_DB: caminho do arquivo SQLite dos baldes
+"""
+import logging
+import math
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from zipfile import BadZipFile, ZipFile
+
+from flask import g, jsonify, request
+
+from apiserver.api import _response
+
+# POSTs que apenas consultam, fora do limite, relativos à raiz da API
+CONSULTAS = ('/auth', '/privatekey', '/eventos/filter', '/eventos/timeline',
+             '/eventosnovos/list')
+# Upload de arquivo de eventos, cobrado pelo tamanho do arquivo
+UPLOAD_EVENTOS = '/eventosnovos/upload'
+
+
+class BaldesRecinto:
+    """Baldes de fichas por recinto, em arquivo SQLite.
+
+    Pode ser compartilhado por threads e processos: cada thread de cada
+    processo usa sua própria conexão, e o consumo de fichas é feito em
+    transação exclusiva. O estado é descartável, portanto o arquivo é
+    gravado sem fsync.
+    """
+
+    def __init__(self, caminho: str, taxa: float, rajada: float):
+        self.caminho = caminho
+        self.taxa = taxa
+        self.rajada = rajada
+        self.local = threading.local()
+        conn = self._conexao()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS baldes ('
+            'recinto TEXT PRIMARY KEY, '
+            'fichas REAL NOT NULL, '
+            'atualizado REAL NOT NULL)'
+        )
+
+    def _conexao(self) -> sqlite3.Connection:
+        # Conexão não pode passar por fork: nova conexão em cada processo
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.conn = sqlite3.connect(self.caminho, timeout=5,
+                                              isolation_level=None)
+            self.local.conn.execute('PRAGMA synchronous=OFF')
+            self.local.pid = os.getpid()
+        return self.local.conn
+
+    def consome(self, recinto: str, fichas: int = 1,
+                agora: float = None) -> float:
+        """Consome fichas do balde do recinto.
+
+        Pedido maior que a rajada só é admitido com o balde cheio, e deixa o
+        saldo negativo: as requisições seguintes esperam pelo que passou
+        da rajada, e o pedido grande paga por todo o seu tamanho.
+
+        :return: 0 se admitido, senão segundos até haver fichas suficientes
+        """
+        if agora is None:
+            agora = time.time()
+        necessarias = min(fichas, self.rajada)
+        conn = self._conexao()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            linha = conn.execute(
+                'SELECT fichas, atualizado FROM baldes WHERE recinto = ?',
+                (recinto,)
+            ).fetchone()
+            if linha is None:
+                disponiveis = self.rajada
+            else:
+                decorrido = max(0., agora - linha[1])
+                disponiveis = min(self.rajada, linha[0] + decorrido * self.taxa)
+            if disponiveis >= necessarias:
+                disponiveis -= fichas
+                espera = 0.
+            else:
+                espera = (necessarias - disponiveis) / self.taxa
+            conn.execute(
+                'INSERT OR REPLACE INTO baldes (recinto, fichas, atualizado) '
+                'VALUES (?, ?, ?)', (recinto, disponiveis, agora))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return espera
+
+
+def recinto_da_requisicao() -> str:
+    """codRecinto do token JWT ou, sem autenticação, do corpo enviado.
+
+    Sem recinto, o endereço do cliente: requisições anônimas de clientes
+    diferentes não dividem o mesmo balde.
+    """
+    recinto = g.get('recinto')
+    if recinto:
+        return recinto
+    corpo = request.get_json(silent=True)
+    if isinstance(corpo, list):
+        corpo = corpo[0] if corpo else None
+    if isinstance(corpo, dict) and corpo.get('codRecinto'):
+        return str(corpo['codRecinto'])
+    return request.form.get('codRecinto') or 'ip:%s' % request.remote_addr
+
+
+def tamanho_arquivo(arquivo) -> int:
+    """Bytes do arquivo enviado; de zip, a soma dos membros descompactados."""
+    stream = arquivo.stream
+    inicio = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    tamanho = stream.tell() - inicio
+    if (arquivo.filename or '').lower().endswith('.zip'):
+        # Só o diretório central do zip é lido
+        stream.seek(inicio)
+        try:
+            with ZipFile(stream) as arquivozip:
+                tamanho = sum([membro.file_size
+                               for membro in arquivozip.infolist()])
+        except BadZipFile:
+            pass
+    stream.seek(inicio)
+    return tamanho
+
+
+def fichas_da_requisicao(bytes_por_ficha: int = 2048) -> int:
+    """Uma ficha por evento: lotes pagam pelo tamanho do lote.
+
+    Arquivos de eventos, que não são lidos aqui, pagam pelo tamanho: uma
+    ficha a cada bytes_por_ficha bytes. Upload de anexo paga uma ficha.
+    """
+    arquivo = request.files.get('file')
+    if arquivo is not None and request.path == UPLOAD_EVENTOS:
+        return max(1, math.ceil(tamanho_arquivo(arquivo) / bytes_por_ficha))
+    corpo = request.get_json(silent=True)
+    if isinstance(corpo, list):
+        return max(1, len(corpo))
+    return 1
+
+
+def configure_limites(app, ativo: bool = None, taxa: float = None,
+                      rajada: float = None, caminho: str = None,
+                      bytes_por_ficha: int = None):
+    """Liga o limite de gravação por recinto no app, se configurado.
+
+    Parâmetros não informados são lidos das variáveis de ambiente. Deve
+    ser chamado depois de configure_signature, que preenche g.recinto.
+    """
+    if ativo is None:
+        ativo = os.environ.get('LIMITE_RECINTO', 'NO').lower() == 'yes'
+    app.app.config['limites'] = None
+    if not ativo:
+        return None
+    if taxa is None:
+        taxa = float(os.environ.get('LIMITE_TAXA', 20))
+    if rajada is None:
+        rajada = float(os.environ.get('LIMITE_RAJADA', 200))
+    if bytes_por_ficha is None:
+        bytes_por_ficha = int(os.environ.get('LIMITE_BYTES_FICHA', 2048))
+    if caminho is None:
+        caminho = os.environ.get(
+            'LIMITE_DB',
+            os.path.join(tempfile.gettempdir(), 'apirecintos_limites.db'))
+    baldes = BaldesRecinto(caminho, taxa, rajada)
+    app.app.config['limites'] = baldes
+
+    @app.app.before_request
+    def limita_recinto():
+        if request.method != 'POST':
+            return
+        caminho_api = request.path.split('/apirecintos', 1)[-1] or '/'
+        if caminho_api in CONSULTAS:
+            return
+        recinto = recinto_da_requisicao()
+        try:
+            espera = baldes.consome(recinto,
+                                    fichas_da_requisicao(bytes_por_ficha))
+        except sqlite3.Error as err:
+            # Falha no controle não deve derrubar a gravação
+            logging.error('Erro no limite por recinto: %s', err, exc_info=True)
+            return
+        if espera > 0:
+            logging.warning('Recinto %s acima do limite: %s', recinto,
+                            request.path)
+            response = jsonify(_response(
+                'Limite de gravação do recinto %s excedido. Tente novamente '
+                'em %.1f segundos.' % (recinto, espera), 429))
+            response.status_code = 429
+            response.headers['Retry-After'] = str(math.ceil(espera))
+            return response
+
+    logging.info('Limite por recinto ativo: %s eventos/s, rajada %s, %s',
+                 taxa, rajada, caminho)
+    return baldes
@@ -1,8 +1,15 @@
+import os
+
 import connexion
 
 from apiserver.models import orm
 from apiserver.views import create_views
 from apiserver.authentication import configure_signature
+from apiserver.duplicados import configure_duplicados
+from apiserver.ingestao import configure_ingestao
+from apiserver.limites import configure_limites
+from apiserver.respostas import configure_compressao, configure_json
+from apiserver.sessao import configure_sessao
 
 
 def create_app(session, engine):  # pragma: no cover
@@ -12,11 +19,34 @@ def create_app(session, engine):  # pragma: no cover
     app.app.config['engine'] = engine
     print('Configurou app')
     create_views(app)
+    configure_sessao(app)
     configure_signature(app)
+    configure_limites(app)
+    configure_duplicados(app)
+    configure_ingestao(app)
+    configure_json(app)
+    configure_compressao(app)
     print('Configurou views')
     return app
 
 
+def create_app_producao(uri: str = None):
+    """App para servidor WSGI com vários processos (ver gunicorn.conf.py).
+
+    Cria engine e pool de conexões próprios, mesmo que o processo já tenha
+    os de orm.init_db: criado em cada worker, depois do fork, cada worker
+    usa as suas conexões. Não cria nem apaga tabelas (schema é criado à
+    parte, ex: create_mysql.py).
+
+    :param uri: URI do Banco; se None, lê DATABASE_URL ou JAWSDB_URL
+    """
+    if uri is None:
+        uri = os.environ.get('DATABASE_URL',
+                             os.environ.get('JAWSDB_URL', 'sqlite:///test.db'))
+    session, engine = orm.cria_sessao(uri)
+    return create_app(session, engine)
+
+
 def main():  # pragma: no cover
     # session, engine = orm.init_db('sqlite:///:memory:')
     # orm.Base.metadata.create_all(bind=engine)
@@ -1,44 +1,182 @@
-import collections
+import hashlib
+import json
 import logging
 import mimetypes
 import os
 from base64 import b64decode, b64encode
+from datetime import datetime
+from functools import lru_cache
+from operator import attrgetter
+from urllib.parse import quote
+from uuid import uuid4
 
 from dateutil.parser import parse
 from sqlalchemy import Boolean, Column, DateTime, Integer, \
-    String, create_engine, ForeignKey, Index, Table
+    String, create_engine, ForeignKey, Index, Table, inspect
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session, sessionmaker, relationship, backref
 
+from apiserver.models.pool import TelemetriaPool, opcoes_pool, protege_fork
+
 Base = declarative_base()
 db_session = None
 engine = None
 
 
+def parse_datahora(valor):
+    """Converte data e hora ISO-8601 (ex: 2019-08-07T13:36:51.809Z).
+
+    Usa datetime.fromisoformat, bem mais rápido, e só recorre ao parse do
+    dateutil para formatos que ele não aceita.
+    """
+    if isinstance(valor, datetime):
+        return valor
+    try:
+        if valor.endswith('Z'):
+            valor = valor[:-1] + '+00:00'
+        return datetime.fromisoformat(valor)
+    except (AttributeError, TypeError, ValueError):
+        return parse(valor)
+
+
+def digest_evento(evento: dict) -> str:
+    """Hash SHA-256 do evento recebido, em serialização JSON canônica.
+
+    Chaves ordenadas, sem espaços, UTF-8 e sem o próprio campo hash. O valor
+    é o mesmo em qualquer processo, ao contrário do hash() do Python.
+    """
+    conteudo = dict([(k, v) for k, v in evento.items() if k != 'hash'])
+    canonico = json.dumps(conteudo, sort_keys=True, separators=(',', ':'),
+                          ensure_ascii=False, default=str)
+    return hashlib.sha256(canonico.encode('utf-8')).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def campos_classe(aclass) -> frozenset:
+    """Nomes definidos na classe, calculados uma única vez por classe."""
+    return frozenset(vars(aclass).keys())
+
+
+@lru_cache(maxsize=None)
+def campos_dump(aclass) -> frozenset:
+    """Colunas e atributos em _extras_dump da classe: o que pode ir no dump."""
+    return frozenset([coluna.key for coluna in inspect(aclass).column_attrs] +
+                     list(aclass._extras_dump))
+
+
+# fields vem do cliente: o cache de serializadores precisa de limite
+@lru_cache(maxsize=256)
+def serializador(aclass, exclude: frozenset = frozenset(),
+                 selecionados: frozenset = None):
+    """Monta, uma única vez por classe e exclude, a função de dump.
+
+    Os campos são as colunas do mapper mais os atributos em _extras_dump,
+    portanto a saída não depende de quais relacionamentos já foram carregados.
+    Se selecionados for informado, apenas esses campos entram no dump.
+    Datas saem em ISO-8601.
+    """
+    mapper = inspect(aclass)
+    campos = tuple([coluna.key for coluna in mapper.column_attrs
+                    if coluna.key not in exclude and
+                    (selecionados is None or coluna.key in selecionados)])
+    datas = tuple([ind for ind, campo in enumerate(campos)
+                   if isinstance(mapper.columns[campo].type, DateTime)])
+    extras = tuple([campo for campo in aclass._extras_dump
+                    if campo not in exclude and
+                    (selecionados is None or campo in selecionados)])
+    valores_colunas = attrgetter(*campos) if len(campos) > 1 else \
+        (lambda objeto: (getattr(objeto, campos[0]),) if campos else ())
+
+    def dump(objeto) -> dict:
+        valores = list(valores_colunas(objeto))
+        for ind in datas:
+            if valores[ind] is not None:
+                valores[ind] = valores[ind].isoformat()
+        resultado = dict(zip(campos, valores))
+        for campo in extras:
+            resultado[campo] = getattr(objeto, campo, None)
+        return resultado
+
+    return dump
+
+
+# Bytes lidos e gravados por vez ao salvar arquivos de anexos
+TAMANHO_PEDACO = 64 * 1024
+# Subdiretório de basepath do armazenamento de anexos por hash
+DIRETORIO_HASH = 'sha256'
+
+
+# Diretórios de anexos que este processo já criou ou viu existir
+_diretorios_criados = set()
+
+
+def cria_diretorio(filepath: str):
+    """Cria filepath (e intermediários) uma única vez por processo.
+
+    Depois da primeira chamada não há nenhum acesso ao sistema de arquivos,
+    o que importa com UPLOAD_FOLDER em NFS.
+    """
+    if filepath not in _diretorios_criados:
+        os.makedirs(filepath, exist_ok=True)
+        _diretorios_criados.add(filepath)
+
+
+def caminho_por_hash(basepath: str, hashArquivo: str) -> str:
+    """Caminho do arquivo no armazenamento por conteúdo (hash SHA-256).
+
+    Dois níveis de subdiretórios (ex: sha256/ab/cd/abcd...) evitam
+    diretórios com milhões de arquivos.
+    """
+    return os.path.join(basepath, DIRETORIO_HASH, hashArquivo[:2],
+                        hashArquivo[2:4], hashArquivo)
+
+
+def decodifica_base64(pedacos):
+    """Decodifica base64 que chega em pedaços, gerando pedaços de bytes.
+
+    Quebras de linha e espaços são ignorados. Sobras que não fecham um
+    grupo de 4 caracteres passam para o pedaço seguinte.
+    """
+    resto = b''
+    for pedaco in pedacos:
+        if isinstance(pedaco, str):
+            pedaco = pedaco.encode('ascii')
+        dados = resto + b''.join(pedaco.split())
+        corte = len(dados) - len(dados) % 4
+        resto = dados[corte:]
+        if corte:
+            yield b64decode(dados[:corte], validate=True)
+    if resto:
+        yield b64decode(resto, validate=True)
+
+
+def pedacos_arquivo(file, tamanho: int = TAMANHO_PEDACO):
+    """Gera o conteúdo de file em pedaços de bytes.
+
+    :param file: texto em base64, bytes ou objeto arquivo (lido em pedaços)
+    """
+    if isinstance(file, str):
+        yield from decodifica_base64(file[inicio:inicio + tamanho]
+                                     for inicio in range(0, len(file), tamanho))
+    elif isinstance(file, (bytes, bytearray)):
+        conteudo = memoryview(file)
+        for inicio in range(0, len(conteudo), tamanho):
+            yield conteudo[inicio:inicio + tamanho]
+    else:
+        yield from iter(lambda: file.read(tamanho), b'')
+
+
 class BaseDumpable(Base):
     __abstract__ = True
+    # Atributos que não são colunas mas entram no dump
+    _extras_dump = ()
 
-    def dump(self, exclude=None):
-        dump = dict([(k, v) for k, v in vars(self).items() if not k.startswith('_')])
-        if exclude:
-            for key in exclude:
-                if dump.get(key):
-                    dump.pop(key)
-        return dump
-
-    def __hash__(self):
-        dump = self.dump()
-        clean_dump = {}
-        for k, v in dump.items():
-            if isinstance(v, collections.Hashable):
-                clean_dump[k] = v
-        _sorted = sorted([(k, v) for k, v in clean_dump.items()])
-        # print('Sorted dump:', _sorted)
-        ovalues = tuple([s[1] for s in _sorted])
-        # print('Sorted ovalues:', ovalues)
-        ohash = hash(ovalues)
-        # print(ohash)
-        return ohash
+    def dump(self, exclude=None, campos=None):
+        if campos is not None:
+            # Só o que existe na classe: nomes de listas de filhos não
+            # multiplicam as entradas do cache
+            campos = frozenset(campos) & campos_dump(type(self))
+        return serializador(type(self), frozenset(exclude or ()), campos)(self)
 
 
 class Manifesto(BaseDumpable):
@@ -65,8 +203,9 @@ class EventoBase(BaseDumpable):
     hash = Column(String, index=True)
 
     def __init__(self, **kwargs):
+        campos = campos_classe(BaseDumpable)
         superkwargs = dict([
-            (k, v) for k, v in kwargs.items() if k in vars(BaseDumpable).keys()
+            (k, v) for k, v in kwargs.items() if k in campos
         ])
         super().__init__(**superkwargs)
         self.cnpjTransmissor = kwargs.get('cnpjTransmissor')
@@ -75,11 +214,11 @@ class EventoBase(BaseDumpable):
         self.cpfOperOcor = kwargs.get('cpfOperOcor')
         self.cpfOperReg = kwargs.get('cpfOperReg')
         if kwargs.get('dtHrOcorrencia') is not None:
-            self.dtHrOcorrencia = parse(kwargs.get('dtHrOcorrencia'))
+            self.dtHrOcorrencia = parse_datahora(kwargs.get('dtHrOcorrencia'))
         if kwargs.get('dtHrTransmissao') is not None:
-            self.dtHrTransmissao = parse(kwargs.get('dtHrTransmissao'))
+            self.dtHrTransmissao = parse_datahora(kwargs.get('dtHrTransmissao'))
         if kwargs.get('dtHrRegistro') is not None:
-            self.dtHrRegistro = parse(kwargs.get('dtHrRegistro'))
+            self.dtHrRegistro = parse_datahora(kwargs.get('dtHrRegistro'))
         self.idEvento = kwargs.get('idEvento')
         self.idEventoRetif = kwargs.get('idEventoRetif')
         self.retificador = kwargs.get('retificador')
@@ -101,8 +240,9 @@ class PesagemVeiculoCarga(EventoBase):
     idCamera = Column(String)
 
     def __init__(self, **kwargs):
+        campos = campos_classe(EventoBase)
         superkwargs = dict([
-            (k, v) for k, v in kwargs.items() if k in vars(EventoBase).keys()
+            (k, v) for k, v in kwargs.items() if k in campos
         ])
         super().__init__(**superkwargs)
         self.placaCavalo = kwargs.get('placaCavalo')
@@ -164,8 +304,9 @@ class InspecaonaoInvasiva(EventoBase):
     idScanner = Column(Integer)
 
     def __init__(self, **kwargs):
+        campos = campos_classe(EventoBase)
         superkwargs = dict([
-            (k, v) for k, v in kwargs.items() if k in vars(EventoBase).keys()
+            (k, v) for k, v in kwargs.items() if k in campos
         ])
         super().__init__(**superkwargs)
         self.placa = kwargs.get('placa')
@@ -176,30 +317,43 @@ class InspecaonaoInvasiva(EventoBase):
 
 class AnexoBase(BaseDumpable):
     __abstract__ = True
+    _extras_dump = ('content', 'url')
     nomeArquivo = Column(String(100), default='')
     contentType = Column(String(40), default='')
+    tamanhoArquivo = Column(Integer)
+    hashArquivo = Column(String(64), index=True)
 
-    def __init__(self, nomeArquivo='', contentType=''):
+    def __init__(self, nomeArquivo='', contentType='', hashArquivo=None,
+                 tamanhoArquivo=None):
+        # tamanhoArquivo é ignorado: calculado ao gravar ou referenciar
         self.nomeArquivo = nomeArquivo
         self.contentType = contentType
+        self.hashArquivo = hashArquivo
 
     def monta_caminho_arquivo(self, basepath, eventobase):
-        filepath = basepath
-        for caminho in [eventobase.codRecinto,
-                        eventobase.dtHrOcorrencia.year,
-                        eventobase.dtHrOcorrencia.month,
-                        eventobase.dtHrOcorrencia.day]:
-            filepath = os.path.join(filepath, str(caminho))
-            if not os.path.exists(filepath):
-                print('making dir %s' % filepath)
-                os.mkdir(filepath)
-        return filepath
-
-    def save_file(self, basepath, file, filename, evento) -> (str, bool):
+        """Diretório do evento: basepath/codRecinto/ano/mes/dia.
+
+        Apenas monta o caminho; quem grava chama cria_diretorio.
         """
+        data = eventobase.dtHrOcorrencia
+        return os.path.join(basepath, str(eventobase.codRecinto),
+                            str(data.year), str(data.month), str(data.day))
+
+    def save_file(self, basepath, file, filename, evento,
+                  por_hash: bool = False) -> (str, bool):
+        """Grava o arquivo do anexo no diretório do evento ou por hash.
+
+        O conteúdo é gravado em pedaços num arquivo temporário, calculando
+        tamanho e hash no caminho, e só então renomeado para o nome final:
+        leitores nunca veem arquivo pela metade.
+
+        Com por_hash, o arquivo é guardado uma única vez por conteúdo em
+        caminho_por_hash; se o conteúdo já existir, o temporário é apenas
+        descartado. Nome do arquivo e data do evento ficam só no registro.
 
         :param basepath: diretorio onde guardar arquivos
-        :param file: objeto arquivo
+        :param file: texto em base64, bytes ou objeto arquivo
+        :param por_hash: usar o armazenamento por conteúdo
         :return:
             mensagem de sucesso ou mensagem de erro
             True se sucesso, False se houve erro
@@ -211,33 +365,111 @@ class AnexoBase(BaseDumpable):
             raise AttributeError('Arquivo vazio')
         if not filename:
             raise AttributeError('Nome arquivo não informado!')
-        filepath = self.monta_caminho_arquivo(
-            basepath, evento)
+        if por_hash:
+            filepath = os.path.join(basepath, DIRETORIO_HASH)
+        else:
+            filepath = self.monta_caminho_arquivo(
+                basepath, evento)
+        cria_diretorio(filepath)
+        temporario = os.path.join(filepath, '.%s.%s.parcial' %
+                                  (filename, uuid4().hex))
+        digest = hashlib.sha256()
+        tamanho = 0
         try:
-            with open(os.path.join(filepath, filename), 'wb') as file_out:
-                try:
-                    file = b64decode(file.encode())
-                except AttributeError:
-                    pass
-                file_out.write(file)
-        except FileNotFoundError as err:
-            logging.error(str(err), exc_info=True)
-            raise (err)
+            with open(temporario, 'xb') as file_out:
+                for pedaco in pedacos_arquivo(file):
+                    file_out.write(pedaco)
+                    digest.update(pedaco)
+                    tamanho += len(pedaco)
+            if tamanho == 0:
+                raise AttributeError('Arquivo vazio')
+            if por_hash:
+                destino = caminho_por_hash(basepath, digest.hexdigest())
+                if os.path.exists(destino):
+                    os.remove(temporario)  # Conteúdo já armazenado
+                else:
+                    cria_diretorio(os.path.dirname(destino))
+                    os.replace(temporario, destino)
+            else:
+                os.replace(temporario, os.path.join(filepath, filename))
+        except Exception as err:
+            if os.path.exists(temporario):
+                os.remove(temporario)
+            if isinstance(err, FileNotFoundError):
+                # Diretório removido por fora: recria na próxima gravação
+                _diretorios_criados.clear()
+                logging.error(str(err), exc_info=True)
+            raise
         self.contentType = mimetypes.guess_type(filename)[0]
         self.nomeArquivo = filename
+        self.tamanhoArquivo = tamanho
+        self.hashArquivo = digest.hexdigest()
         return 'Arquivo salvo no anexo'
 
-    def load_file(self, basepath, evento):
+    def referencia_arquivo(self, basepath) -> bool:
+        """Aponta o anexo para arquivo já existente no armazenamento por hash.
+
+        Permite reenviar conteúdo idêntico informando só hashArquivo, sem
+        transmitir nem gravar o arquivo de novo.
+
+        :return: False se não há arquivo com hashArquivo no armazenamento
+        """
+        if not self.hashArquivo:
+            return False
+        try:
+            tamanho = os.path.getsize(caminho_por_hash(basepath,
+                                                       self.hashArquivo))
+        except OSError:
+            return False
+        self.contentType = mimetypes.guess_type(self.nomeArquivo or '')[0]
+        self.tamanhoArquivo = tamanho
+        return True
+
+    def caminhos_arquivo(self, basepath, evento,
+                         por_hash: bool = False) -> list:
+        """Caminhos possíveis do arquivo do anexo, em ordem de procura.
+
+        Primeiro onde o app grava (armazenamento por hash, com por_hash, ou
+        diretório do evento); o outro local só é tentado se o arquivo não
+        estiver no primeiro. Nenhum acesso ao disco é feito aqui: quem lê
+        tenta os caminhos em ordem.
+        """
+        caminhos = [os.path.join(self.monta_caminho_arquivo(basepath, evento),
+                                 self.nomeArquivo)]
+        if self.hashArquivo:
+            por_conteudo = caminho_por_hash(basepath, self.hashArquivo)
+            if por_hash:
+                caminhos.insert(0, por_conteudo)
+            else:
+                caminhos.append(por_conteudo)
+        return caminhos
+
+    def monta_url(self, evento) -> str:
+        """URL de download do arquivo, relativa à raiz da API.
+
+        Permite ao cliente baixar o arquivo sob demanda, em vez de receber
+        o conteúdo em base64 no JSON do evento.
+        """
+        if not self.nomeArquivo:
+            return None
+        return '/%s/%s/%s/anexos/%s' % (type(evento).__name__.lower(),
+                                        quote(evento.codRecinto, safe=''),
+                                        quote(evento.idEvento, safe=''),
+                                        quote(self.nomeArquivo, safe=''))
+
+    def load_file(self, basepath, evento, por_hash: bool = False):
         if not self.nomeArquivo:
             return ''
-        try:
-            filepath = self.monta_caminho_arquivo(basepath, evento)
-            content = open(os.path.join(filepath, self.nomeArquivo), 'rb')
-            base64_bytes = b64encode(content.read())
-            base64_string = base64_bytes.decode('utf-8')
-        except FileNotFoundError as err:
-            logging.error(str(err), exc_info=True)
-            base64_string = None
+        base64_string = None
+        for caminho in AnexoBase.caminhos_arquivo(self, basepath, evento,
+                                                  por_hash):
+            try:
+                with open(caminho, 'rb') as content:
+                    base64_bytes = b64encode(content.read())
+                base64_string = base64_bytes.decode('utf-8')
+                break
+            except FileNotFoundError as err:
+                logging.error(str(err), exc_info=True)
         self.content = base64_string
 
 
@@ -254,21 +486,31 @@ class AnexoInspecao(AnexoBase):
 
     # TODO: Fazer coordenadas
     def __init__(self, **kwargs):
+        campos = campos_classe(AnexoBase)
         superkwargs = dict([
-            (k, v) for k, v in kwargs.items() if k in vars(AnexoBase).keys()
+            (k, v) for k, v in kwargs.items() if k in campos
         ])
         super().__init__(**superkwargs)
         if kwargs.get('datacriacao') is not None:
-            self.datacriacao = parse(kwargs.get('datacriacao'))
+            self.datacriacao = parse_datahora(kwargs.get('datacriacao'))
         if kwargs.get('datamodificacao') is not None:
-            self.datamodificacao = parse(kwargs.get('datamodificacao'))
+            self.datamodificacao = parse_datahora(kwargs.get('datamodificacao'))
         self.inspecao = kwargs.get('inspecao')
 
-    def save_file(self, basepath, file, filename=None) -> (str, bool):
-        return super().save_file(basepath, file, filename, self.inspecao)
+    def save_file(self, basepath, file, filename=None,
+                  por_hash=False) -> (str, bool):
+        return super().save_file(basepath, file, filename, self.inspecao,
+                                 por_hash)
+
+    def load_file(self, basepath, por_hash=False):
+        return super().load_file(basepath, self.inspecao, por_hash)
+
+    def caminhos_arquivo(self, basepath, por_hash=False):
+        return super().caminhos_arquivo(basepath, self.inspecao, por_hash)
 
-    def load_file(self, basepath):
-        return super().load_file(basepath, self.inspecao)
+    @property
+    def url(self):
+        return self.monta_url(self.inspecao)
 
     @classmethod
     def create(cls, parent):
@@ -361,8 +603,9 @@ class AcessoVeiculo(EventoBase):
 
 
     def __init__(self, **kwargs):
+        campos = campos_classe(EventoBase)
         superkwargs = dict([
-            (k, v) for k, v in kwargs.items() if k in vars(EventoBase).keys()
+            (k, v) for k, v in kwargs.items() if k in campos
         ])
         super().__init__(**superkwargs)
         self.direcao = kwargs.get('direcao')
@@ -522,25 +765,52 @@ class NfeGate(BaseDumpable):
     )
 
 
-def init_db(uri='sqlite:///test.db'):
+def define_indices():
+    """Índices das tabelas de eventos, incluídos uma só vez no metadata."""
+    for table in ['pesagensveiculocarga', 'acessosveiculo',
+                  'inspecoesnaoinvasivas']:
+        # print(table)
+        nomes = [index.name for index in Base.metadata.tables[table].indexes]
+        if table + '_ideventorecinto_idx' in nomes:
+            continue
+        Table(table, Base.metadata,
+              Index(table + '_ideventorecinto_idx',
+                    'codRecinto', 'idEvento',
+                    unique=True,
+                    ),
+              # Linha do tempo do recinto: ordem de dtHrOcorrencia
+              Index(table + '_recintodata_idx',
+                    'codRecinto', 'dtHrOcorrencia'),
+              extend_existing=True
+              )
+
+
+def cria_sessao(uri: str, opcoes: dict = None):
+    """Cria engine e sessão novas, sem reaproveitar as do processo.
+
+    :param opcoes: parâmetros extras do create_engine; se None, os do pool
+        são lidos do ambiente (ver models/pool.py)
+    """
+    print('Conectando banco %s' % uri)
+    if opcoes is None:
+        opcoes = opcoes_pool(uri)
+    nova_engine = create_engine(uri, **opcoes)
+    TelemetriaPool().registra(nova_engine)
+    if not uri.startswith('sqlite'):
+        protege_fork(nova_engine)
+    nova_sessao = scoped_session(sessionmaker(autocommit=False, autoflush=False,
+                                              bind=nova_engine))
+    define_indices()
+    return nova_sessao, nova_engine
+
+
+def init_db(uri='sqlite:///test.db', opcoes: dict = None):
+    """Cria engine e sessão, uma vez por processo (ver cria_sessao)."""
     global db_session
     global engine
     if db_session is None:
-        print('Conectando banco %s' % uri)
-        engine = create_engine(uri)
-        db_session = scoped_session(sessionmaker(autocommit=False, autoflush=False,
-                                                 bind=engine))
+        db_session, engine = cria_sessao(uri, opcoes)
         Base.query = db_session.query_property()
-        for table in ['pesagensveiculocarga', 'acessosveiculo',
-                      'inspecoesnaoinvasivas']:
-            # print(table)
-            Table(table, Base.metadata,
-                  Index(table + '_ideventorecinto_idx',
-                        'codRecinto', 'idEvento',
-                        unique=True,
-                        ),
-                  extend_existing=True
-                  )
     return db_session, engine
 
 
@@ -0,0 +1,147 @@
+"""Pool de conexões ao Banco: configuração e telemetria.
+
+Variáveis de ambiente (ignoradas para SQLite, que usa pool próprio):
+    DB_POOL_SIZE: conexões mantidas abertas (padrão 5)
+    DB_MAX_OVERFLOW: conexões extras em picos (padrão 10)
+    DB_POOL_TIMEOUT: segundos de espera por conexão livre (padrão 30)
+    DB_POOL_RECYCLE: segundos até reabrir a conexão, abaixo do
+        wait_timeout do MySQL (padrão 1800)
+    DB_POOL_PRE_PING: NO para não testar a conexão antes do uso (padrão YES)
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+# Limites, em milissegundos, das faixas do histograma de espera
+FAIXAS_ESPERA_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+class TelemetriaPool:
+    """Contadores de uso do pool, alimentados pelos eventos do SQLAlchemy.
+
+    Conta checkouts, mantém histograma do tempo de espera por conexão
+    (inclui abrir conexão nova, quando o pool cresce) e a data de abertura
+    de cada conexão viva, para a idade das conexões.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.invalidadas = 0
+        self.espera_total = 0.
+        self.histograma = [0] * (len(FAIXAS_ESPERA_MS) + 1)
+        self.abertas = {}
+
+    def registra(self, engine):
+        event.listen(engine, 'connect', self._conectou)
+        event.listen(engine, 'checkout', self._checkout)
+        event.listen(engine, 'invalidate', self._invalidou)
+        event.listen(engine, 'close', self._fechou)
+        engine.pool.telemetria = self
+
+    def _conectou(self, dbapi_connection, connection_record):
+        with self.lock:
+            self.abertas[id(connection_record)] = time.time()
+
+    def _checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self.lock:
+            self.checkouts += 1
+
+    def _invalidou(self, dbapi_connection, connection_record, exception):
+        with self.lock:
+            self.invalidadas += 1
+            self.abertas.pop(id(connection_record), None)
+
+    def _fechou(self, dbapi_connection, connection_record):
+        with self.lock:
+            self.abertas.pop(id(connection_record), None)
+
+    def espera(self, segundos: float):
+        with self.lock:
+            self.espera_total += segundos
+            self.histograma[bisect_left(FAIXAS_ESPERA_MS,
+                                        segundos * 1000)] += 1
+
+    def estatisticas(self, pool) -> dict:
+        agora = time.time()
+        with self.lock:
+            idades = [agora - aberta for aberta in self.abertas.values()]
+            faixas = ['<=%dms' % limite for limite in FAIXAS_ESPERA_MS] + \
+                ['>%dms' % FAIXAS_ESPERA_MS[-1]]
+            esperas = sum(self.histograma)
+            resultado = {
+                'checkouts': self.checkouts,
+                'invalidadas': self.invalidadas,
+                'espera_ms': dict(zip(faixas, self.histograma)),
+                'espera_media_ms': round(self.espera_total / esperas * 1000, 3)
+                if esperas else 0.,
+                'conexoes': len(idades),
+                'idade_max_s': round(max(idades), 1) if idades else 0.,
+                'idade_media_s': round(sum(idades) / len(idades), 1)
+                if idades else 0.,
+            }
+        # Situação atual, apenas nos pools com tamanho fixo
+        if isinstance(pool, QueuePool):
+            resultado.update({'tamanho': pool.size(),
+                              'em_uso': pool.checkedout(),
+                              'overflow': pool.overflow()})
+        return resultado
+
+
+class QueuePoolMedido(QueuePool):
+    """QueuePool que mede o tempo de espera por conexão livre."""
+
+    telemetria = None
+
+    def _do_get(self):
+        inicio = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            if self.telemetria is not None:
+                self.telemetria.espera(time.perf_counter() - inicio)
+
+    def recreate(self):
+        # engine.dispose() troca o pool: mantém a mesma telemetria
+        pool = super().recreate()
+        pool.telemetria = self.telemetria
+        return pool
+
+
+def protege_fork(engine):
+    """Impede que um processo use conexão aberta por outro (antes do fork).
+
+    Conexão do pool herdada do processo pai é descartada no checkout, sem
+    ser fechada (fechá-la derrubaria a do pai), e o pool abre outra.
+    """
+    @event.listens_for(engine, 'connect')
+    def _conectou(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def _checkout(dbapi_connection, connection_record, connection_proxy):
+        if connection_record.info['pid'] != os.getpid():
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError(
+                'Conexão do processo %s usada no processo %s' %
+                (connection_record.info['pid'], os.getpid()))
+
+
+def opcoes_pool(uri: str, environ=os.environ) -> dict:
+    """Parâmetros do pool para create_engine, lidos do ambiente."""
+    opcoes = {'pool_pre_ping':
+              environ.get('DB_POOL_PRE_PING', 'YES').lower() == 'yes'}
+    if uri.startswith('sqlite'):
+        return opcoes
+    opcoes.update({
+        'poolclass': QueuePoolMedido,
+        'pool_size': int(environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(environ.get('DB_POOL_RECYCLE', 1800)),
+    })
+    return opcoes
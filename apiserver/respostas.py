@@ -0,0 +1,203 @@
+"""Serialização JSON e compressão das respostas.
+
+Listas de eventos são JSON muito repetitivo (mesmas chaves, CNPJs e códigos
+de recinto) e comprimem bem. As respostas são comprimidas com brotli (se o
+pacote brotli estiver instalado) ou gzip, conforme o Accept-Encoding do
+cliente, quando passam do tamanho mínimo. Respostas em streaming são
+comprimidas pedaço a pedaço, sem juntar o corpo em memória, e cada pedaço
+comprimido é enviado logo (flush do compressor).
+
+Se o pacote orjson estiver instalado, ele substitui o json da biblioteca
+padrão na serialização das respostas.
+
+Arquivos dos anexos são enviados em streaming por envia_arquivo, sem passar
+por base64 nem pela memória.
+
+Variáveis de ambiente:
+    COMPRESSAO: NO para desligar (padrão YES)
+    COMPRESSAO_MINIMO: tamanho mínimo, em bytes, para comprimir (padrão 1024)
+"""
+import json
+import logging
+import os
+import zlib
+from urllib.parse import quote
+
+from flask import current_app, request, send_file
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import NoResultFound
+
+from apiserver.use_cases.usecases import EventoDuplicado
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+TAMANHO_MINIMO = 1024
+NIVEL_GZIP = 6
+NIVEL_BROTLI = 5
+TIPOS_COMPRIMIVEIS = {'application/json', 'application/x-ndjson',
+                      'application/problem+json', 'text/html', 'text/plain',
+                      'text/css', 'application/javascript'}
+
+
+# Tipos que nem orjson nem json serializam: mesmo tratamento do Flask
+_padrao = DefaultJSONProvider.default
+
+
+def codifica_json(objeto) -> bytes:
+    """Serializa objeto em JSON UTF-8, com orjson se disponível."""
+    if orjson is not None:
+        return orjson.dumps(objeto, default=_padrao,
+                            option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(objeto, default=_padrao, ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
+class ProvedorJSON(DefaultJSONProvider):
+    """Provedor JSON do Flask que usa orjson, se instalado.
+
+    orjson serializa datetime nativamente (ISO-8601). Opções que ele não
+    suporta (ex: indent do modo debug) caem no provedor padrão.
+    """
+
+    def dumps(self, obj, **kwargs) -> str:
+        if orjson is None or set(kwargs) - {'separators'}:
+            return super().dumps(obj, **kwargs)
+        opcoes = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            opcoes |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=_padrao,
+                            option=opcoes).decode('utf-8')
+
+
+def escolhe_codificacao(accept_encoding) -> str:
+    """Codificação a usar conforme o Accept-Encoding, ou None."""
+    if brotli is not None and accept_encoding['br']:
+        return 'br'
+    if accept_encoding['gzip']:
+        return 'gzip'
+    return None
+
+
+def _compressor(codificacao):
+    """Funções (comprime pedaço, descarrega buffer, finaliza) do compressor."""
+    if codificacao == 'br':
+        compressor = brotli.Compressor(quality=NIVEL_BROTLI)
+        return compressor.process, compressor.flush, compressor.finish
+    # wbits 31: formato gzip (cabeçalho e CRC)
+    compressor = zlib.compressobj(NIVEL_GZIP, zlib.DEFLATED, 31)
+    return (compressor.compress,
+            lambda: compressor.flush(zlib.Z_SYNC_FLUSH),
+            compressor.flush)
+
+
+def comprime(dados: bytes, codificacao: str) -> bytes:
+    comprime_pedaco, _, finaliza = _compressor(codificacao)
+    return comprime_pedaco(dados) + finaliza()
+
+
+def comprime_stream(pedacos, codificacao: str):
+    """Comprime um gerador de pedaços, gerando pedaços comprimidos.
+
+    O buffer do compressor é descarregado a cada pedaço: o cliente recebe
+    cada lote assim que é gerado, sem esperar o buffer encher.
+    """
+    comprime_pedaco, descarrega, finaliza = _compressor(codificacao)
+    for pedaco in pedacos:
+        if isinstance(pedaco, str):
+            pedaco = pedaco.encode('utf-8')
+        saida = comprime_pedaco(pedaco) + descarrega()
+        if saida:
+            yield saida
+    yield finaliza()
+
+
+def status_excecao(exception) -> int:
+    """Status HTTP da resposta de erro para a exceção."""
+    if isinstance(exception, (IntegrityError, EventoDuplicado)):
+        return 409
+    if isinstance(exception, (NoResultFound, FileNotFoundError)):
+        return 404
+    return 400
+
+
+def envia_arquivo(caminho, mimetype: str = None, etag: str = None):
+    """Resposta que envia o arquivo do disco em streaming.
+
+    Se X_ACCEL_REDIRECT estiver configurado (location internal do nginx
+    que aponta para UPLOAD_FOLDER), apenas indica o arquivo e o nginx o
+    envia. Senão usa send_file, que atende Range (206) e requisições
+    condicionais (304) e, com USE_X_SENDFILE, usa X-Sendfile.
+
+    :param caminho: caminho do arquivo ou lista de caminhos possíveis, em
+        ordem de procura; é enviado o primeiro que existir
+    :param etag: ETag do arquivo (ex: hash do conteúdo); se None, o
+        send_file monta uma a partir da data de modificação e do tamanho
+    :raises FileNotFoundError: arquivo não existe no disco
+    """
+    caminhos = [caminho] if isinstance(caminho, str) else caminho
+    caminho = next((caminho for caminho in caminhos
+                    if os.path.isfile(caminho)), None)
+    if caminho is None:
+        raise FileNotFoundError('Arquivo não encontrado: %s' %
+                                os.path.basename(caminhos[0]))
+    prefixo = current_app.config.get('X_ACCEL_REDIRECT')
+    if prefixo:
+        relativo = os.path.relpath(caminho, current_app.config['UPLOAD_FOLDER'])
+        response = current_app.response_class(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = '%s/%s' % (
+            prefixo.rstrip('/'), quote(relativo.replace(os.sep, '/')))
+        if etag:
+            response.set_etag(etag)
+        return response
+    return send_file(caminho, mimetype=mimetype or None, conditional=True,
+                     etag=etag or True)
+
+
+def configure_json(app):
+    """Troca o provedor JSON do Flask pelo ProvedorJSON."""
+    app.app.json = ProvedorJSON(app.app)
+    logging.info('Serialização JSON: %s',
+                 'orjson' if orjson is not None else 'json')
+
+
+def configure_compressao(app, ativa: bool = None, minimo: int = None):
+    """Registra compressão das respostas no app, se configurada."""
+    if ativa is None:
+        ativa = os.environ.get('COMPRESSAO', 'YES').lower() == 'yes'
+    if not ativa:
+        return
+    if minimo is None:
+        minimo = int(os.environ.get('COMPRESSAO_MINIMO', TAMANHO_MINIMO))
+
+    @app.app.after_request
+    def comprime_resposta(response):
+        # direct_passthrough: arquivo (send_file), que aceita Range
+        if response.mimetype not in TIPOS_COMPRIMIVEIS or \
+                response.status_code not in (200, 201) or \
+                response.direct_passthrough or \
+                'Content-Encoding' in response.headers:
+            return response
+        response.vary.add('Accept-Encoding')
+        codificacao = escolhe_codificacao(request.accept_encodings)
+        if codificacao is None:
+            return response
+        if response.is_streamed:
+            response.response = comprime_stream(response.response,
+                                                codificacao)
+            response.headers.pop('Content-Length', None)
+        else:
+            dados = response.get_data()
+            if len(dados) < minimo:
+                return response
+            response.set_data(comprime(dados, codificacao))
+        response.headers['Content-Encoding'] = codificacao
+        return response
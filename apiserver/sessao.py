@@ -0,0 +1,120 @@
+"""Ciclo de vida da sessão do Banco por requisição (unidade de trabalho).
+
+A sessão (scoped_session, uma por thread) só é criada no primeiro uso e só
+pega conexão do pool na primeira consulta. Use cases e handlers não fazem
+commit nem rollback: a transação é gravada num único lugar, depois do
+handler e antes de a resposta sair, se o método for de escrita (POST, PUT,
+PATCH, DELETE) e a resposta de sucesso. Se o commit falhar, a resposta vira
+erro: o recinto não recebe recibo de evento que não foi gravado. Em
+qualquer outro caso (exceção, status >= 400, GET e demais métodos de
+leitura) a transação é desfeita, e alteração acidental feita numa consulta
+não é persistida. Respostas de gravação em streaming não são gravadas aqui:
+o handler confirma o que gravou antes de responder.
+
+Ao fim de cada requisição a sessão é liberada, devolvendo a conexão ao
+pool. Assim uma transação que falhou não contamina a próxima requisição da
+mesma thread do worker.
+
+Requisição que segura uma conexão por mais de SESSAO_ALERTA_SEGUNDOS gera
+aviso no log, com o caminho da requisição.
+
+Variáveis de ambiente:
+    SESSAO_ALERTA_SEGUNDOS: tempo máximo de uso de uma conexão antes do
+        aviso (padrão 2; 0 desliga)
+"""
+import logging
+import os
+import time
+
+from flask import has_request_context, jsonify, request
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+
+from apiserver.api import _response
+
+
+METODOS_ESCRITA = {'POST', 'PUT', 'PATCH', 'DELETE'}
+
+
+def grava_requisicao(db_session):
+    """Commit da transação da requisição. Retorna a exceção, se falhar."""
+    if not db_session.registry.has():
+        # Requisição não usou o Banco
+        return None
+    try:
+        db_session.commit()
+    except Exception as err:
+        logging.error('Erro ao gravar sessão: %s', err, exc_info=True)
+        db_session.rollback()
+        return err
+    return None
+
+
+def fim_requisicao(db_session):
+    """Desfaz o que não foi gravado e libera a sessão."""
+    if not db_session.registry.has():
+        return
+    try:
+        db_session.rollback()
+    except Exception as err:
+        logging.error('Erro ao encerrar sessão: %s', err, exc_info=True)
+    finally:
+        db_session.remove()
+
+
+def configure_sessao(app, alerta: float = None):
+    """Liga a sessão por requisição no app e o aviso de conexão retida.
+
+    :param alerta: segundos de uso de uma conexão antes do aviso; se None,
+        lido de SESSAO_ALERTA_SEGUNDOS
+    """
+    if alerta is None:
+        alerta = float(os.environ.get('SESSAO_ALERTA_SEGUNDOS', 2))
+    db_session = app.app.config['db_session']
+    app.app.config['SESSAO_ALERTA_SEGUNDOS'] = alerta
+
+    @app.app.after_request
+    def grava_sessao(response):
+        if request.method not in METODOS_ESCRITA or \
+                response.status_code >= 400 or response.is_streamed:
+            return response
+        err = grava_requisicao(db_session)
+        if err is None:
+            return response
+        resposta, status_code = _response(
+            'Erro ao gravar: %s' % err,
+            409 if isinstance(err, IntegrityError) else 500)
+        response = jsonify(resposta)
+        response.status_code = status_code
+        return response
+
+    @app.app.teardown_request
+    def encerra_sessao(exception=None):
+        fim_requisicao(db_session)
+
+    engine = app.app.config.get('engine')
+    if engine is None:
+        return
+    registrado = hasattr(engine, 'alerta_sessao')
+    engine.alerta_sessao = alerta
+    if registrado:
+        # Engine compartilhada por mais de um app: ouvintes já registrados
+        return
+
+    @event.listens_for(engine, 'checkout')
+    def _checkout(dbapi_connection, connection_record, connection_proxy):
+        connection_record.info['inicio_uso'] = time.perf_counter()
+        connection_record.info['caminho'] = \
+            request.path if has_request_context() else None
+
+    @event.listens_for(engine, 'checkin')
+    def _checkin(dbapi_connection, connection_record):
+        inicio = connection_record.info.pop('inicio_uso', None)
+        caminho = connection_record.info.pop('caminho', None)
+        if inicio is None or caminho is None or not engine.alerta_sessao:
+            return
+        segundos = time.perf_counter() - inicio
+        if segundos > engine.alerta_sessao:
+            logging.warning('Requisição %s segurou conexão do Banco por '
+                            '%.2f s (limite %.2f s)', caminho, segundos,
+                            engine.alerta_sessao)
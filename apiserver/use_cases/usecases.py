@@ -1,27 +1,221 @@
+import io
 import json
 import logging
+import os
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import namedtuple
+from datetime import datetime
+from functools import lru_cache
+from heapq import merge
 from zipfile import ZipFile
 
+from sqlalchemy import and_, inspect, or_, tuple_
 from sqlalchemy.orm import load_only
 
 from apiserver.models import orm
 
+# Máximo de parâmetros por consulta IN (...) - SQLite aceita 999 por comando
+TAMANHO_LOTE_CONSULTA = 400
+# Eventos por transação ao inserir arquivos de eventos
+TAMANHO_LOTE_ARQUIVO = 500
+# Eventos por página no feed de eventos novos
+TAMANHO_PAGINA = 100
+# Colunas do evento lidas mesmo fora de fields: caminho e URL dos anexos e
+# chave da linha do tempo
+COLUNAS_CHAVE = ('codRecinto', 'dtHrOcorrencia', 'idEvento')
+
+Filho = namedtuple('Filho', ['campo', 'classe', 'fk', 'atributo', 'netos'],
+                   defaults=[None, ()])
+Filho.__doc__ = """Lista de filhos de um Evento no JSON e sua Classe ORM.
+
+campo: nome da lista no JSON do evento pai
+classe: Classe ORM do filho
+fk: nome do campo que referencia o pai na Classe filha
+atributo: se a lista for de valores simples, campo da Classe que recebe o valor
+netos: filhos do filho (ex: listaLacres de cada conteiner)
+"""
+
+FILHOS = {
+    orm.PesagemVeiculoCarga: [
+        Filho('listaSemirreboque', orm.ReboquePesagemVeiculoCarga, 'pesagem_id'),
+        Filho('listaConteineresUld', orm.ConteinerPesagemVeiculoCarga,
+              'pesagem_id'),
+        Filho('listaManifestos', orm.ManifestoPesagemVeiculoCarga, 'pesagem_id'),
+    ],
+    orm.AcessoVeiculo: [
+        Filho('listaSemirreboque', orm.ReboqueGate, 'acessoveiculo_id',
+              netos=[Filho('listaLacres', orm.LacreReboque, 'reboquegate_id')]),
+        Filho('listaConteineresUld', orm.ConteineresGate, 'acessoveiculo_id',
+              netos=[Filho('listaLacres', orm.LacreConteiner,
+                           'conteineresgate_id')]),
+        Filho('listaManifestos', orm.ManifestoGate, 'acessoveiculo_id'),
+        Filho('listaDiDue', orm.DiDueGate, 'acessoveiculo_id'),
+        Filho('listaChassi', orm.ChassiGate, 'acessoveiculo_id', 'num'),
+        Filho('listaNfe', orm.NfeGate, 'acessoveiculo_id', 'chavenfe'),
+    ],
+    orm.InspecaonaoInvasiva: [
+        Filho('listaConteineresUld', orm.ConteinerUld, 'inspecao_id'),
+        Filho('listaSemirreboque', orm.Semirreboque, 'inspecao_id'),
+        Filho('listaManifestos', orm.ManifestoInspecaonaoInvasiva,
+              'inspecao_id'),
+        Filho('anexos', orm.AnexoInspecao, 'inspecao_id',
+              netos=[Filho('coordenadasAlerta', orm.CoordenadasAlerta,
+                           'anexo_id')]),
+        Filho('listaCarga', orm.IdentificadorInspecao, 'inspecao_id',
+              'identificador'),
+    ],
+}
+
+
+class EventoDuplicado(Exception):
+    """Já existe Evento com o mesmo (codRecinto, idEvento)."""
+
+
+def colunas(aclass) -> list:
+    """Nomes dos campos (colunas) mapeados na Classe ORM."""
+    return [attr.key for attr in inspect(aclass).column_attrs]
+
+
+def linha_para_insert(objeto) -> dict:
+    """Valores de colunas atribuídos ao objeto ORM (não persistido)."""
+    estado = inspect(objeto).dict
+    return dict([(k, estado[k]) for k in colunas(objeto.__class__)
+                 if k in estado])
+
+
+@lru_cache(maxsize=None)
+def relacao_com_pai(classefilho, fk: str) -> str:
+    """Nome da relationship da Classe filha que usa a fk para o pai."""
+    for relacao in inspect(classefilho).relationships:
+        if fk in [coluna.key for coluna in relacao.local_columns]:
+            return relacao.key
+    raise AttributeError('%s sem relationship para %s' %
+                         (classefilho.__name__, fk))
+
+
+def codifica_cursor(*valores) -> str:
+    """Cursor opaco com os valores da chave do último item entregue."""
+    conteudo = json.dumps(list(valores)).encode('utf-8')
+    return urlsafe_b64encode(conteudo).decode('ascii').rstrip('=')
+
+
+def _valores_cursor(cursor: str, tipos: tuple) -> list:
+    try:
+        conteudo = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        valores = json.loads(conteudo.decode('utf-8'))
+    except Exception:
+        raise ValueError('Cursor inválido: %s' % cursor)
+    if not isinstance(valores, list) or len(valores) != len(tipos) or \
+            not all([isinstance(valor, tipo)
+                     for valor, tipo in zip(valores, tipos)]):
+        raise ValueError('Cursor inválido: %s' % cursor)
+    return valores
+
+
+def decodifica_cursor(cursor: str) -> (str, int):
+    """Retorna (tipoevento, ID) do cursor. Levanta ValueError se inválido."""
+    tipoevento, ID = _valores_cursor(cursor, (str, int))
+    return tipoevento, ID
+
+
+def decodifica_cursor_linha_tempo(cursor: str) -> (datetime, str, int):
+    """Retorna (dtHrOcorrencia, tipoevento, ID) do cursor da linha do tempo.
+
+    Levanta ValueError se inválido.
+    """
+    dtHrOcorrencia, tipoevento, ID = _valores_cursor(cursor, (str, str, int))
+    try:
+        dtHrOcorrencia = datetime.fromisoformat(dtHrOcorrencia)
+    except ValueError:
+        raise ValueError('Cursor inválido: %s' % cursor)
+    return dtHrOcorrencia, tipoevento, ID
+
+
+def depois_de(colunas: list, valores: list):
+    """Condição (colunas) > (valores), em ordem lexicográfica (keyset)."""
+    condicao = colunas[-1] > valores[-1]
+    for coluna, valor in zip(reversed(colunas[:-1]), reversed(valores[:-1])):
+        condicao = or_(coluna > valor, and_(coluna == valor, condicao))
+    return condicao
+
+
+def arvore_campos(aclass, fields) -> dict:
+    """Converte fields em árvore de campos a trazer de aclass e dos filhos.
+
+    fields é lista ou texto separado por vírgulas. Filhos são pedidos pelo
+    nome da lista (lista inteira) ou por caminho pontuado, ex:
+    ['placa', 'listaConteineresUld.num'] ->
+    {'placa': None, 'listaConteineresUld': {'num': None}}
+
+    :return: árvore ou None (todos os campos) se fields for vazio
+    :raises ValueError: campo que não existe em aclass ou nos filhos
+    """
+    if not fields:
+        return None
+    if isinstance(fields, str):
+        fields = fields.split(',')
+    arvore = {}
+    for campo in fields:
+        partes = campo.strip().split('.')
+        no = arvore
+        for parte in partes[:-1]:
+            if parte in no and no[parte] is None:
+                break  # Lista inteira já pedida
+            no = no.setdefault(parte, {})
+        else:
+            no[partes[-1]] = None
+    _valida_campos(aclass, FILHOS.get(aclass, []), arvore, '')
+    return arvore
+
+
+def _valida_campos(aclass, filhos: list, arvore: dict, prefixo: str):
+    validos = set(colunas(aclass)) | set(aclass._extras_dump)
+    por_campo = dict([(filho.campo, filho) for filho in filhos])
+    for campo, subcampos in arvore.items():
+        filho = por_campo.get(campo)
+        if filho is None:
+            if campo not in validos or subcampos is not None:
+                raise ValueError('Campo inválido: %s%s' % (prefixo, campo))
+        elif subcampos is not None:
+            if filho.atributo:
+                raise ValueError('Campo inválido: %s%s.%s' %
+                                 (prefixo, campo, list(subcampos)[0]))
+            _valida_campos(filho.classe, filho.netos, subcampos,
+                           prefixo + campo + '.')
+
+
+def opcoes_campos(aclass, campos: dict, obrigatorias=()) -> list:
+    """Opção load_only para ler do Banco apenas as colunas dos campos.
+
+    :param campos: árvore de arvore_campos ou None (todas as colunas)
+    :param obrigatorias: colunas lidas mesmo que não pedidas
+    """
+    if campos is None:
+        return []
+    nomes = colunas(aclass)
+    carga = [campo for campo in campos if campo in nomes]
+    if issubclass(aclass, orm.AnexoBase) and \
+            ('content' in campos or 'url' in campos):
+        carga.append('nomeArquivo')
+    carga.extend(obrigatorias)
+    return [load_only(*dict.fromkeys(carga))]
+
 
 class UseCases:
 
-    def __init__(self, db_session, basepath: str):
+    def __init__(self, db_session, basepath: str, duplicados=None,
+                 por_hash: bool = False):
         """Init
 
         :param db_session: Conexao ao Banco
-        :param recinto: codigo do recinto
-        :param request_IP: IP de origem
         :param basepath: Diretório raiz para gravar arquivos
+        :param duplicados: FiltroDuplicados, opcional
+        :param por_hash: gravar anexos no armazenamento por conteúdo
         """
         self.db_session = db_session
         self.basepath = basepath
-        self.eventos_com_filhos = {
-            orm.InspecaonaoInvasiva: self.load_inspecaonaoinvasiva,
-        }
+        self.duplicados = duplicados
+        self.por_hash = por_hash
 
     def allowed_file(self, filename, extensions):
         """Checa extensões permitidas."""
@@ -40,20 +234,315 @@ class UseCases:
                    file.filename
         return erro is None, erro
 
-    def insert_evento(self, aclass, evento: dict, commit=True) -> orm.EventoBase:
+    def insert_evento(self, aclass, evento: dict) -> orm.EventoBase:
+        """Insere evento na sessão. O commit fica com quem chama."""
         logging.info('Creating evento %s %s' %
                      (aclass.__name__,
                       evento.get('IDEvento'))
                      )
         novo_evento = aclass(**evento)
+        novo_evento.hash = orm.digest_evento(evento)
         self.db_session.add(novo_evento)
-        if commit:
-            self.db_session.commit()
+        self.db_session.flush()
+        self.db_session.refresh(novo_evento)
+        return novo_evento
+
+    def valores_por_chave(self, aclass, chaves, campo: str = 'ID') -> dict:
+        """Busca no Banco campo dos eventos com (codRecinto, idEvento) em chaves.
+
+        Consulta em partes de TAMANHO_LOTE_CONSULTA chaves.
+
+        :param aclass: Classe ORM do evento
+        :param chaves: lista de tuplas (codRecinto, idEvento)
+        :param campo: nome do campo a retornar
+        :return: dict (codRecinto, idEvento): valor do campo
+        """
+        chaves = list(chaves)
+        valores = {}
+        for inicio in range(0, len(chaves), TAMANHO_LOTE_CONSULTA):
+            parte = chaves[inicio:inicio + TAMANHO_LOTE_CONSULTA]
+            query = self.db_session.query(
+                getattr(aclass, campo), aclass.codRecinto, aclass.idEvento
+            ).filter(
+                # Pares exatos: IN separados casariam combinações cruzadas
+                tuple_(aclass.codRecinto, aclass.idEvento).in_(parte)
+            )
+            for valor, codRecinto, idEvento in query.all():
+                valores[(codRecinto, idEvento)] = valor
+        return valores
+
+    def chaves_existentes(self, aclass, chaves: list) -> set:
+        """Retorna as chaves (codRecinto, idEvento) já gravadas no Banco.
+
+        Com filtro de duplicados, só consulta o Banco para as chaves que
+        o filtro não descarta.
+        """
+        def consulta(chaves):
+            return self.valores_por_chave(aclass, chaves).keys()
+
+        if self.duplicados is None:
+            return set(consulta(chaves))
+        return self.duplicados.existentes(aclass, chaves, consulta)
+
+    def verifica_duplicado(self, aclass, evento: dict):
+        """Levanta EventoDuplicado se o filtro de duplicados confirmar o evento.
+
+        Sem filtro de duplicados não faz nada: o índice único do Banco barra
+        o evento repetido no commit.
+        """
+        if self.duplicados is None:
+            return
+        chave = (evento.get('codRecinto'), evento.get('idEvento'))
+        if self.chaves_existentes(aclass, [chave]):
+            raise EventoDuplicado(
+                'Evento já existente: codRecinto %s idEvento %s' % chave)
+
+    def registra_gravados(self, aclass, chaves):
+        """Inclui no filtro de duplicados chaves de eventos gravados."""
+        if self.duplicados is not None:
+            for chave in chaves:
+                self.duplicados.adiciona(aclass, chave)
+
+    def insert_eventos_lote(self, aclass, eventos: list) -> list:
+        """Insere lote de eventos, com filhos, em um único savepoint.
+
+        Os INSERTs são feitos por tabela, em lote (executemany). Eventos
+        inválidos (inclusive nos filhos) ou repetidos (codRecinto, idEvento)
+        não impedem a gravação dos demais: as linhas dos filhos são montadas
+        e validadas antes de gravar. Se a gravação do lote falhar no Banco,
+        os eventos são gravados um a um, cada um em seu savepoint, e só os
+        que falharem recebem o erro. O commit fica com quem chama.
+
+        :param aclass: Classe ORM do evento
+        :param eventos: lista de dicts recebidos do JSON
+        :return: lista, na ordem de eventos, com o objeto evento criado
+            ou a exceção que impediu sua inclusão
+        """
+        logging.info('Creating lote %s com %d eventos',
+                     aclass.__name__, len(eventos))
+        resultados = [None] * len(eventos)
+        pendentes = {}
+        for ind, evento in enumerate(eventos):
+            chave = (evento.get('codRecinto'), evento.get('idEvento'))
+            if chave in pendentes:
+                resultados[ind] = EventoDuplicado(
+                    'Evento repetido no lote: codRecinto %s idEvento %s' % chave)
+                continue
+            try:
+                resultados[ind] = aclass(**evento)
+                resultados[ind].hash = orm.digest_evento(evento)
+            except Exception as err:
+                resultados[ind] = err
+                continue
+            pendentes[chave] = ind
+        for chave in self.chaves_existentes(aclass, list(pendentes.keys())):
+            resultados[pendentes.pop(chave)] = EventoDuplicado(
+                'Evento já existente: codRecinto %s idEvento %s' % chave)
+        filhos = FILHOS.get(aclass, [])
+        linhas_filhos = {}
+        for chave, ind in list(pendentes.items()):
+            try:
+                linhas_filhos[chave] = self.monta_linhas_filhos(
+                    resultados[ind], eventos[ind], filhos)
+            except Exception as err:
+                resultados[ind] = err
+                del pendentes[chave]
+        if len(pendentes) == 0:
+            return resultados
+        try:
+            self.grava_lote(aclass, pendentes, resultados, linhas_filhos)
+        except Exception as err:
+            logging.error(err, exc_info=True)
+            # Lote recusado pelo Banco: um savepoint por evento isola o erro
+            for chave, ind in pendentes.items():
+                try:
+                    self.grava_lote(aclass, {chave: ind}, resultados,
+                                    linhas_filhos)
+                except Exception as err_evento:
+                    logging.error(err_evento, exc_info=True)
+                    resultados[ind] = err_evento
+        return resultados
+
+    def grava_lote(self, aclass, pendentes: dict, resultados: list,
+                   linhas_filhos: dict):
+        """Grava eventos já validados e seus filhos, em um savepoint.
+
+        :param pendentes: dict (codRecinto, idEvento): índice em resultados
+        :param resultados: objetos evento, recebem o ID gravado
+        :param linhas_filhos: dict chave: linhas de monta_linhas_filhos
+        """
+        savepoint = self.db_session.begin_nested()
+        try:
+            self.db_session.bulk_insert_mappings(
+                aclass,
+                [linha_para_insert(resultados[ind]) for ind in pendentes.values()]
+            )
+            ids = self.valores_por_chave(aclass, pendentes.keys())
+            pais = []
+            for chave, ind in pendentes.items():
+                pais.append((ids[chave], linhas_filhos[chave]))
+            self.insert_filhos_lote(pais, FILHOS.get(aclass, []))
+            savepoint.commit()
+        except Exception:
+            savepoint.rollback()
+            raise
+        for chave, ind in pendentes.items():
+            resultados[ind].ID = ids[chave]
+        self.registra_gravados(aclass, pendentes.keys())
+
+    def monta_linhas_filhos(self, pai, evento: dict, filhos: list) -> dict:
+        """Cria e valida as linhas de INSERT dos filhos (e netos) de um evento.
+
+        Nada é gravado no Banco aqui (anexos com content são gravados em
+        disco). Levanta exceção se algum filho for inválido.
+
+        :param pai: objeto ORM pai (usado para montar caminho do anexo)
+        :param evento: dict do JSON do pai
+        :param filhos: lista de Filho a processar
+        :return: dict campo do Filho: lista de (linha, linhas dos netos)
+        """
+        linhas = {}
+        for filho in filhos:
+            linhas[filho.campo] = [
+                (linha_para_insert(self.cria_filho(filho, pai, item)),
+                 self.monta_linhas_filhos(None, item, filho.netos)
+                 if filho.netos else {})
+                for item in evento.get(filho.campo) or []]
+        return linhas
+
+    def insert_filhos_lote(self, pais: list, filhos: list):
+        """Insere, um INSERT em lote por tabela, os filhos de uma lista de pais.
+
+        :param pais: lista de tuplas (ID do pai, linhas de monta_linhas_filhos)
+        :param filhos: lista de Filho a processar
+        :return: None, apenas levanta exceção se acontecer
+        """
+        for filho in filhos:
+            linhas = []
+            for pai_id, linhas_filhos in pais:
+                for linha, _ in linhas_filhos[filho.campo]:
+                    linhas.append({**linha, filho.fk: pai_id})
+            if len(linhas) == 0:
+                continue
+            self.db_session.bulk_insert_mappings(filho.classe, linhas)
+            if filho.netos:
+                # IDs gerados em ordem de inserção: casa itens por pai, na ordem
+                fk = getattr(filho.classe, filho.fk)
+                ids_filhos = {}
+                for inicio in range(0, len(pais), TAMANHO_LOTE_CONSULTA):
+                    parte = [pai_id for pai_id, _ in
+                             pais[inicio:inicio + TAMANHO_LOTE_CONSULTA]]
+                    query = self.db_session.query(
+                        filho.classe.ID, fk
+                    ).filter(fk.in_(parte)).order_by(filho.classe.ID)
+                    for ID, pai_id in query.all():
+                        ids_filhos.setdefault(pai_id, []).append(ID)
+                netos_pais = []
+                for pai_id, linhas_filhos in pais:
+                    itens = zip(ids_filhos.get(pai_id, []),
+                                linhas_filhos[filho.campo])
+                    for ID, (_, linhas_netos) in itens:
+                        netos_pais.append((ID, linhas_netos))
+                self.insert_filhos_lote(netos_pais, filho.netos)
+
+    def cria_filho(self, filho: Filho, pai, item, pai_id: int = None):
+        """Cria objeto ORM do filho a partir do item do JSON e grava anexo.
+
+        :param filho: Filho a criar
+        :param pai: objeto ORM pai (usado para montar caminho do anexo)
+        :param item: dict do JSON ou valor simples (se filho.atributo)
+        :param pai_id: ID do pai, se já conhecido
+        :return: objeto ORM do filho, ainda fora da sessão
+        """
+        if filho.atributo:
+            params = {filho.fk: pai_id, filho.atributo: item}
         else:
-            self.db_session.flush()
+            params = {**{filho.fk: pai_id}, **item}
+        novofilho = filho.classe(**params)
+        if isinstance(novofilho, orm.AnexoBase):
+            if item.get('content'):
+                orm.AnexoBase.save_file(novofilho, self.basepath,
+                                        item.get('content'), None, pai,
+                                        self.por_hash)
+            elif novofilho.hashArquivo and \
+                    not novofilho.referencia_arquivo(self.basepath):
+                raise ValueError('Arquivo com hashArquivo %s não existe: '
+                                 'envie content' % novofilho.hashArquivo)
+        return novofilho
+
+    def monta_grafo(self, pai, evento: dict, filhos: list):
+        """Cria filhos (e netos) de pai, ligados pelas relationships do ORM.
+
+        Nada é gravado aqui: o grafo inteiro é persistido em um único flush,
+        por cascata a partir do pai.
+
+        :param pai: objeto ORM pai
+        :param evento: dict do JSON do pai
+        :param filhos: lista de Filho a processar
+        """
+        for filho in filhos:
+            relacao = relacao_com_pai(filho.classe, filho.fk)
+            for item in evento.get(filho.campo) or []:
+                logging.info('Creating %s %s..', filho.classe.__name__,
+                             item if filho.atributo else item.get('num'))
+                novofilho = self.cria_filho(filho, pai, item)
+                setattr(novofilho, relacao, pai)
+                if filho.netos:
+                    self.monta_grafo(novofilho, item, filho.netos)
+
+    def insert_evento_com_filhos(self, aclass, evento: dict) -> orm.EventoBase:
+        """Insere evento e todos os seus filhos em um único flush.
+
+        O commit fica com quem chama.
+        """
+        self.verifica_duplicado(aclass, evento)
+        novo_evento = aclass(**evento)
+        novo_evento.hash = orm.digest_evento(evento)
+        self.monta_grafo(novo_evento, evento, FILHOS[aclass])
+        self.db_session.add(novo_evento)
+        self.db_session.flush()
+        self.registra_gravados(
+            aclass, [(evento.get('codRecinto'), evento.get('idEvento'))])
         self.db_session.refresh(novo_evento)
         return novo_evento
 
+    def load_evento_com_filhos(self, aclass, codRecinto: str,
+                               idEvento: str, campos: dict = None) -> dict:
+        """Retorna dump do evento (codRecinto, idEvento) com todos os filhos.
+
+        Faz sempre um SELECT do evento mais um por lista de filhos ou netos,
+        independente da quantidade de itens em cada lista.
+        Levanta NoResultFound se o evento não existir.
+
+        :param campos: árvore de arvore_campos, para trazer apenas esses
+            campos e listas de filhos
+        """
+        evento = self.db_session.query(aclass).options(
+            *opcoes_campos(aclass, campos, COLUNAS_CHAVE)
+        ).filter(
+            aclass.idEvento == idEvento,
+            aclass.codRecinto == codRecinto
+        ).one()
+        return self.dumps_com_filhos([evento], FILHOS.get(aclass, []),
+                                     [evento.ID], campos=campos)[0]
+
+    def load_anexo(self, aclass, codRecinto: str, idEvento: str,
+                   nomeArquivo: str) -> orm.AnexoBase:
+        """Retorna o anexo nomeArquivo do evento (codRecinto, idEvento).
+
+        Apenas o registro é lido; o arquivo fica no disco para ser enviado
+        em streaming. Levanta NoResultFound se o anexo não existir.
+        """
+        filho = [filho for filho in FILHOS.get(aclass, [])
+                 if issubclass(filho.classe, orm.AnexoBase)][0]
+        return self.db_session.query(filho.classe).join(
+            aclass, getattr(filho.classe, filho.fk) == aclass.ID
+        ).filter(
+            aclass.idEvento == idEvento,
+            aclass.codRecinto == codRecinto,
+            filho.classe.nomeArquivo == nomeArquivo
+        ).one()
+
     def load_evento(self, aclass, IDEvento: int, fields: list = None) -> orm.EventoBase:
         """
         Retorna Evento classe aclass encontrado único com recinto E IDEvento.
@@ -74,39 +563,240 @@ class UseCases:
         evento = query.one()
         return evento
 
+    def load_pagina_eventos(self, aclass, apos: int = 0,
+                            limite: int = TAMANHO_PAGINA,
+                            codRecinto: str = None,
+                            campos: dict = None) -> list:
+        """Página do feed de eventos de aclass, em ordem de ID (keyset).
+
+        Filtra ID > apos em vez de usar OFFSET: o índice em codRecinto (que
+        no InnoDB e no SQLite já termina na chave primária ID) entrega a
+        faixa em ordem de ID, e o custo da página não depende de quão
+        antigo é o ponto de partida.
+
+        :param aclass: Classe ORM do evento
+        :param apos: ID do último evento já recebido pelo consumidor
+        :param limite: máximo de eventos na página
+        :param codRecinto: se informado, apenas eventos deste recinto
+        :param campos: árvore de arvore_campos ou None (todos os campos)
+        :return: lista de dicts com os filhos, em ordem de ID
+        """
+        query = self.db_session.query(aclass).filter(aclass.ID > apos)
+        if codRecinto:
+            query = query.filter(aclass.codRecinto == codRecinto)
+        query = query.order_by(aclass.ID).limit(limite)
+        return self.load_eventos_com_filhos(aclass, query, campos)
+
     def load_eventosnovos(self, aclass, IDEvento, dataevento,
-                          fields: list = None) -> list:
+                          fields: list = None,
+                          limite: int = None) -> list:
         """
-        Retorna Evento classe aclass encontrado único com recinto E IDEvento.
+        Retorna Eventos da classe aclass gravados após IDEvento ou dataevento.
 
-        Levanta exceção NoResultFound(não encontrado) ou MultipleResultsFound.
+        Eventos com filhos vêm como dict, com todas as listas de filhos,
+        montados em lote por load_eventos_com_filhos.
 
         :param IDEvento: ID a partir do qual buscar
-        :param IDEvento: data a partir da qual buscar
-        :param fields: Trazer apenas estes campos
-        :return: lista de objetos
+        :param dataevento: data de ocorrência a partir da qual buscar
+        :param fields: Trazer apenas estes campos (ver arvore_campos)
+        :param limite: máximo de eventos retornados, em ordem de ID
+        :return: lista de dicts ou de objetos
         """
-        # TODO: Fazer para Todos os Eventos complexos, que possuem filhos
         if dataevento is None:
             query = self.db_session.query(aclass).filter(
-                aclass.IDEvento > IDEvento,
-                aclass.recinto == self.recinto
+                aclass.ID > IDEvento
             )
         else:
             query = self.db_session.query(aclass).filter(
-                aclass.dataevento > dataevento,
-                aclass.recinto == self.recinto
+                aclass.dtHrOcorrencia > dataevento
             )
-        if aclass in self.eventos_com_filhos:
-            loader_func = self.eventos_com_filhos[aclass]
-            idseventos = query.options(load_only(['ID'])).all()
-            result = []
-            for id in idseventos:
-                result.append(loader_func(id))
-        else:
-            if fields is not None:
-                query = query.options(load_only(fields))
-            return query.all()
+        query = query.order_by(aclass.ID)
+        if limite:
+            query = query.limit(limite)
+        if aclass in FILHOS:
+            return self.load_eventos_com_filhos(
+                aclass, query, arvore_campos(aclass, fields))
+        if fields is not None:
+            query = query.options(load_only(fields))
+        return query.all()
+
+    def load_eventos_com_filhos(self, aclass, query,
+                                campos: dict = None) -> list:
+        """Dumps dos eventos da query com todos os filhos, montados em lote.
+
+        :param aclass: Classe ORM do evento
+        :param query: consulta de eventos de aclass
+        :param campos: árvore de arvore_campos ou None (todos os campos)
+        :return: lista de dicts, na ordem da query
+        """
+        eventos = query.options(
+            *opcoes_campos(aclass, campos, COLUNAS_CHAVE)).all()
+        if not eventos:
+            return []
+        # IDs já lidos, e não subquery: MySQL não aceita LIMIT em IN (SELECT)
+        return self.dumps_com_filhos(eventos, FILHOS.get(aclass, []),
+                                     [evento.ID for evento in eventos],
+                                     campos=campos)
+
+    def gera_eventos_filtro(self, aclass, datainicial, datafinal,
+                            codRecinto: str = None,
+                            tamanho_lote: int = TAMANHO_LOTE_CONSULTA,
+                            campos: dict = None):
+        """Gera, em lotes, dumps dos eventos ocorridos entre as datas.
+
+        Os eventos são lidos do Banco em lotes, por keyset em ID, e os
+        filhos de cada lote em um SELECT por lista, de forma que a memória
+        usada não depende do total de eventos.
+
+        :param aclass: Classe ORM do evento
+        :param datainicial: início do intervalo de dtHrOcorrencia
+        :param datafinal: fim do intervalo de dtHrOcorrencia
+        :param codRecinto: se informado, apenas eventos deste recinto
+        :param tamanho_lote: eventos por lote
+        :param campos: árvore de arvore_campos ou None (todos os campos)
+        :return: gerador de listas de dicts, em ordem de ID
+        """
+        query = self.db_session.query(aclass).filter(
+            aclass.dtHrOcorrencia.between(datainicial, datafinal)
+        )
+        if codRecinto:
+            query = query.filter(aclass.codRecinto == codRecinto)
+        for lote in self.lotes_com_filhos(aclass, query, [aclass.ID],
+                                          tamanho_lote, campos):
+            yield [dump for _, dump in lote]
+
+    def gera_linha_tempo(self, classes: list, codRecinto: str,
+                         datainicial, datafinal, apos: tuple = None,
+                         tamanho_lote: int = TAMANHO_LOTE_CONSULTA):
+        """Gera eventos de vários tipos do recinto, em ordem de ocorrência.
+
+        Cada tabela é lida em ordem de (dtHrOcorrencia, ID) pelo índice
+        (codRecinto, dtHrOcorrencia), e as leituras são intercaladas (merge
+        de k fluxos ordenados) sem carregar nenhuma tabela inteira.
+
+        :param classes: Classes ORM dos eventos
+        :param codRecinto: Codigo do recinto
+        :param datainicial: início do intervalo de dtHrOcorrencia
+        :param datafinal: fim do intervalo de dtHrOcorrencia
+        :param apos: (dtHrOcorrencia, tipoevento, ID) do último evento já
+            entregue, para continuar a linha do tempo
+        :param tamanho_lote: eventos lidos por vez de cada tabela
+        :return: gerador de (dtHrOcorrencia, tipoevento, ID, dump)
+        """
+        fluxos = []
+        for aclass in classes:
+            tipoevento = aclass.__name__
+            query = self.db_session.query(aclass).filter(
+                aclass.codRecinto == codRecinto,
+                aclass.dtHrOcorrencia.between(datainicial, datafinal)
+            )
+            if apos is not None:
+                data, tipo, ID = apos
+                # Chave da ordem é (dtHrOcorrencia, tipoevento, ID)
+                if tipoevento < tipo:
+                    query = query.filter(aclass.dtHrOcorrencia > data)
+                elif tipoevento == tipo:
+                    query = query.filter(or_(
+                        aclass.dtHrOcorrencia > data,
+                        and_(aclass.dtHrOcorrencia == data, aclass.ID > ID)))
+                else:
+                    query = query.filter(aclass.dtHrOcorrencia >= data)
+            fluxos.append(self._itens_linha_tempo(aclass, query, tamanho_lote))
+        return merge(*fluxos, key=lambda item: item[:3])
+
+    def _itens_linha_tempo(self, aclass, query, tamanho_lote: int):
+        tipoevento = aclass.__name__
+        for lote in self.lotes_com_filhos(
+                aclass, query, [aclass.dtHrOcorrencia, aclass.ID],
+                tamanho_lote):
+            for evento, dump in lote:
+                yield evento.dtHrOcorrencia, tipoevento, evento.ID, dump
+
+    def lotes_com_filhos(self, aclass, query, ordem: list,
+                         tamanho_lote: int = TAMANHO_LOTE_CONSULTA,
+                         campos: dict = None):
+        """Percorre a query em lotes (keyset) e monta os dumps lote a lote.
+
+        Cada lote é um SELECT ... ORDER BY ordem LIMIT tamanho_lote lido por
+        inteiro, a partir da chave do último evento do lote anterior: nenhum
+        cursor fica aberto enquanto os filhos do lote são lidos (o cursor sem
+        buffer do MySQL não admite outra consulta na mesma conexão).
+
+        :param ordem: colunas da ordem dos eventos; a última deve ser única
+        :return: gerador de listas de (evento, dump), na ordem de ordem
+        """
+        filhos = FILHOS.get(aclass, [])
+        query = query.options(
+            *opcoes_campos(aclass, campos, COLUNAS_CHAVE)).order_by(*ordem)
+        pagina = query
+        while True:
+            lote = pagina.limit(tamanho_lote).all()
+            if not lote:
+                return
+            yield list(zip(lote, self.dumps_com_filhos(
+                lote, filhos, [evento.ID for evento in lote], campos=campos)))
+            if len(lote) < tamanho_lote:
+                return
+            ultimo = [getattr(lote[-1], coluna.key) for coluna in ordem]
+            pagina = query.filter(depois_de(ordem, ultimo))
+
+    def dumps_com_filhos(self, objetos: list, filhos: list, ids,
+                         exclude=None, campos: dict = None) -> list:
+        """Dumps de objetos de uma Classe com as listas de filhos (e netos).
+
+        Cada lista de filhos é lida com SELECT ... WHERE fk IN (ids), em
+        partes de TAMANHO_LOTE_CONSULTA IDs, e agrupada em memória pelo ID
+        do pai. Listas fora de campos não são lidas.
+
+        Anexos trazem a URL de download do arquivo; o conteúdo, em base64,
+        só é lido do disco se content for pedido explicitamente em campos.
+
+        :param objetos: objetos ORM de uma mesma Classe
+        :param filhos: lista de Filho da Classe dos objetos
+        :param ids: lista com os IDs dos objetos
+        :param exclude: campos dos objetos a omitir
+        :param campos: árvore de arvore_campos ou None (todos os campos)
+        :return: lista de dicts, na ordem de objetos
+        """
+        dumps = []
+        anexos = bool(objetos) and isinstance(objetos[0], orm.AnexoBase)
+        com_conteudo = anexos and campos is not None and 'content' in campos
+        if anexos and not com_conteudo:
+            exclude = [*(exclude or []), 'content']
+        for objeto in objetos:
+            if com_conteudo:
+                objeto.load_file(self.basepath, self.por_hash)
+            dumps.append(objeto.dump(exclude=exclude, campos=campos))
+        for filho in filhos:
+            if campos is not None and filho.campo not in campos:
+                continue
+            subcampos = None if campos is None else campos[filho.campo]
+            query = self.db_session.query(filho.classe)
+            if filho.atributo:
+                query = query.options(load_only(filho.atributo, filho.fk))
+            else:
+                query = query.options(
+                    *opcoes_campos(filho.classe, subcampos, [filho.fk]))
+            fk = getattr(filho.classe, filho.fk)
+            itens = []
+            for inicio in range(0, len(ids), TAMANHO_LOTE_CONSULTA):
+                parte = ids[inicio:inicio + TAMANHO_LOTE_CONSULTA]
+                itens.extend(query.filter(fk.in_(parte)).order_by(
+                    filho.classe.ID).all())
+            if filho.atributo:
+                valores = [getattr(item, filho.atributo) for item in itens]
+            else:
+                excluidos = ['ID', filho.fk,
+                             relacao_com_pai(filho.classe, filho.fk)]
+                valores = self.dumps_com_filhos(itens, filho.netos,
+                                                [item.ID for item in itens],
+                                                excluidos, subcampos)
+            por_pai = {}
+            for item, valor in zip(itens, valores):
+                por_pai.setdefault(getattr(item, filho.fk), []).append(valor)
+            for objeto, dump in zip(objetos, dumps):
+                dump[filho.campo] = por_pai.get(objeto.ID, [])
+        return dumps
 
     def load_filhos(self, osfilhos, campos_excluidos=['ID']):
         filhos = []
@@ -138,7 +828,7 @@ class UseCases:
         filhos = []
         if osfilhos and len(osfilhos) > 0:
             for filho in osfilhos:
-                filho.load_file(self.basepath)
+                filho.load_file(self.basepath, self.por_hash)
                 filhos.append(
                     filho.dump(
                         exclude=campos_excluidos)
@@ -159,7 +849,8 @@ class UseCases:
             novofilho = classefilho(**params)
             content = filho.get('content')
             if content:
-                novofilho.save_file(self.basepath, content)
+                novofilho.save_file(self.basepath, content,
+                                    por_hash=self.por_hash)
             self.db_session.add(novofilho)
 
     @classmethod
@@ -173,7 +864,7 @@ class UseCases:
         """
         if nomearquivo:
             for anexo in evento.anexos:
-                if anexo.nomearquivo == nomearquivo:
+                if anexo.nomeArquivo == nomearquivo:
                     return anexo
         else:  # Se nomearquivo não foi passado, considera que só tem um anexo
             if getattr(evento, 'anexos', False) and len(evento.anexos) > 0:
@@ -181,306 +872,166 @@ class UseCases:
         return None
 
     def insert_inspecaonaoinvasiva(self, evento: dict) -> orm.InspecaonaoInvasiva:
-        logging.info('Creating inspecaonaoinvasiva %s..', evento.get('IDEvento'))
-        inspecaonaoinvasiva = self.insert_evento(orm.InspecaonaoInvasiva, evento,
-                                                 commit=False)
-        listaconteineres = evento.get('listaConteineresUld', [])
-        for conteiner in listaconteineres:
-            conteiner['inspecao_id'] = inspecaonaoinvasiva.ID
-            logging.info('Creating ConteinerUld %s..',
-                         conteiner.get('num'))
-            conteineruld = orm.ConteinerUld(inspecao=inspecaonaoinvasiva,
-                                            **conteiner)
-            self.db_session.add(conteineruld)
-        listareboques = evento.get('listaSemirreboque', [])
-        for reboque in listareboques:
-            reboque['inspecao_id'] = inspecaonaoinvasiva.ID
-            logging.info('Creating Semirreboque %s..',
-                         reboque.get('placa'))
-            semirreboque = orm.Semirreboque(inspecao=inspecaonaoinvasiva,
-                                            **reboque)
-            self.db_session.add(semirreboque)
-        listamanifestos = evento.get('listaManifestos', [])
-        for manifesto in listamanifestos:
-            manifesto['inspecao_id'] = inspecaonaoinvasiva.ID
-            logging.info('Creating manifesto %s..',
-                         manifesto.get('num'))
-            ormmanifesto = orm.ManifestoInspecaonaoInvasiva(inspecao=inspecaonaoinvasiva,
-                                                            **manifesto)
-            self.db_session.add(ormmanifesto)
-        anexos = evento.get('anexos', [])
-        for anexo in anexos:
-            anexo['inspecao_id'] = inspecaonaoinvasiva.ID
-            logging.info('Creating anexoinspecaonaoinvasiva %s..',
-                         anexo.get('datamodificacao'))
-            anexoinspecao = orm.AnexoInspecao(inspecao=inspecaonaoinvasiva,
-                                              **anexo)
-            content = anexo.get('content')
-            if anexo.get('content'):
-                anexoinspecao.save_file(self.basepath, content)
-            self.db_session.add(anexoinspecao)
-            print(anexo.get('coordenadasAlerta'))
-            if anexo.get('coordenadasAlerta'):
-                self.db_session.flush()
-                self.db_session.refresh(anexoinspecao)
-                self.insert_filhos(anexoinspecao.ID,
-                                   anexo.get('coordenadasAlerta'),
-                                   orm.CoordenadasAlerta,
-                                   'anexo_id')
-
-        identificadores = evento.get('listaCarga', [])
-        for identificador in identificadores:
-            logging.info('Creating identificadorinspecaonaoinvasiva %s..',
-                         identificador)
-            oidentificador = orm.IdentificadorInspecao(
-                inspecao=inspecaonaoinvasiva,
-                identificador=identificador)
-            self.db_session.add(oidentificador)
-        self.db_session.commit()
-        self.db_session.refresh(inspecaonaoinvasiva)
-        return inspecaonaoinvasiva
+        logging.info('Creating inspecaonaoinvasiva %s..', evento.get('idEvento'))
+        return self.insert_evento_com_filhos(orm.InspecaonaoInvasiva, evento)
 
     def load_inspecaonaoinvasiva(self, codRecinto: str,
-                                 idEvento: str) -> orm.InspecaonaoInvasiva:
+                                 idEvento: str, campos: dict = None) -> dict:
         """
         Retorna InspecaonaoInvasiva encontrada única no filtro recinto E IDEvento.
 
         :param IDEvento: ID do Evento informado pelo recinto
-        :return: instância objeto orm.InspecaonaoInvasiva
-        """
-        print(idEvento, codRecinto)
-        inspecaonaoinvasiva = orm.InspecaonaoInvasiva.query.filter(
-            orm.InspecaonaoInvasiva.idEvento == idEvento,
-            orm.InspecaonaoInvasiva.codRecinto == codRecinto
-        ).outerjoin(
-            orm.AnexoInspecao
-        ).outerjoin(
-            orm.IdentificadorInspecao
-        ).outerjoin(
-            orm.ConteinerUld
-        ).outerjoin(
-            orm.Semirreboque
-        ).outerjoin(
-            orm.ManifestoInspecaonaoInvasiva
-        ).one()
-        inspecaonaoinvasiva_dump = inspecaonaoinvasiva.dump()
-        if inspecaonaoinvasiva.anexos and len(inspecaonaoinvasiva.anexos) > 0:
-            inspecaonaoinvasiva_dump['anexos'] = []
-            for anexo in inspecaonaoinvasiva.anexos:
-                anexo.load_file(self.basepath)
-                anexo_dump = anexo.dump(exclude=['ID', 'inspecao', 'inspecao_id'])
-                anexo_dump['coordenadasAlerta'] = []
-                for coordenadas in anexo.coordenadasAlerta:
-                    anexo_dump['coordenadasAlerta'].append(
-                        coordenadas.dump(exclude=['ID', 'anexo', 'anexo_id'])
-                    )
-                inspecaonaoinvasiva_dump['anexos'].append(anexo_dump)
-        if inspecaonaoinvasiva.listaConteineresUld and \
-                len(inspecaonaoinvasiva.listaConteineresUld) > 0:
-            inspecaonaoinvasiva_dump['listaConteineresUld'] = []
-            for conteiner in inspecaonaoinvasiva.listaConteineresUld:
-                inspecaonaoinvasiva_dump['listaConteineresUld'].append(
-                    conteiner.dump(exclude=['ID', 'inspecao', 'inspecao_id'])
-                )
-        if inspecaonaoinvasiva.listaSemirreboque and \
-                len(inspecaonaoinvasiva.listaSemirreboque) > 0:
-            inspecaonaoinvasiva_dump['listaSemirreboque'] = []
-            for semirreboque in inspecaonaoinvasiva.listaSemirreboque:
-                inspecaonaoinvasiva_dump['listaSemirreboque'].append(
-                    semirreboque.dump(exclude=['ID', 'inspecao', 'inspecao_id'])
-                )
-        if inspecaonaoinvasiva.listaManifestos and \
-                len(inspecaonaoinvasiva.listaManifestos) > 0:
-            inspecaonaoinvasiva_dump['listaManifestos'] = []
-            for manifesto in inspecaonaoinvasiva.listaManifestos:
-                inspecaonaoinvasiva_dump['listaManifestos'].append(
-                    manifesto.dump(exclude=['ID', 'inspecao', 'inspecao_id'])
-                )
-        if inspecaonaoinvasiva.identificadores and \
-                len(inspecaonaoinvasiva.identificadores) > 0:
-            inspecaonaoinvasiva_dump['listaCarga'] = []
-            for identificador in inspecaonaoinvasiva.identificadores:
-                inspecaonaoinvasiva_dump['listaCarga'].append(
-                    identificador.identificador
-                )
-        return inspecaonaoinvasiva_dump
+        :param campos: árvore de arvore_campos ou None (todos os campos)
+        :return: dict do evento com as listas de filhos
+        """
+        return self.load_evento_com_filhos(orm.InspecaonaoInvasiva,
+                                           codRecinto, idEvento, campos)
 
     def insert_pesagemveiculocarga(self, evento: dict) -> orm.PesagemVeiculoCarga:
-        logging.info('Creating PesagemVeiculoCarga %s..', evento.get('IDEvento'))
-        pesagemveiculocarga = self.insert_evento(orm.PesagemVeiculoCarga, evento,
-                                                 commit=False)
-        listareboques = evento.get('listaSemirreboque', [])
-        self.insert_filhos(pesagemveiculocarga.ID, listareboques,
-                           orm.ReboquePesagemVeiculoCarga, 'pesagem_id')
-        listaconteineres = evento.get('listaConteineresUld', [])
-        self.insert_filhos(pesagemveiculocarga.ID, listaconteineres,
-                           orm.ConteinerPesagemVeiculoCarga, 'pesagem_id')
-        listaManifestos = evento.get('listaManifestos', [])
-        self.insert_filhos(pesagemveiculocarga.ID, listaManifestos,
-                           orm.ManifestoPesagemVeiculoCarga, 'pesagem_id')
-        self.db_session.commit()
-        self.db_session.refresh(pesagemveiculocarga)
-        return pesagemveiculocarga
+        logging.info('Creating PesagemVeiculoCarga %s..', evento.get('idEvento'))
+        return self.insert_evento_com_filhos(orm.PesagemVeiculoCarga, evento)
 
     def load_pesagemveiculocarga(self, codRecinto: str,
-                                 idEvento: str) -> orm.PesagemVeiculoCarga:
+                                 idEvento: str, campos: dict = None) -> dict:
         """
         Retorna PesagemVeiculoCarga encontrada única no filtro recinto E IDEvento.
 
         :param codRecinto: Codigo do recinto
         :param IDEvento: ID do Evento informado pelo recinto
-        :return: instância objeto orm.InspecaonaoInvasiva
-        """
-        evento = orm.PesagemVeiculoCarga.query.filter(
-            orm.PesagemVeiculoCarga.idEvento == idEvento,
-            orm.PesagemVeiculoCarga.codRecinto == codRecinto
-        ).outerjoin(
-            orm.ReboquePesagemVeiculoCarga
-        ).outerjoin(
-            orm.ConteinerPesagemVeiculoCarga
-        ).outerjoin(
-            orm.ManifestoPesagemVeiculoCarga
-        ).one()
-        pesagemveiculocarga_dump = evento.dump()
-        lexclude = ['ID', 'pesagem', 'pesagem_id']
-        pesagemveiculocarga_dump['listaSemirreboque'] = \
-            self.load_filhos(evento.listaSemirreboque, lexclude)
-        pesagemveiculocarga_dump['listaConteineresUld'] = \
-            self.load_filhos(evento.listaConteineresUld, lexclude)
-        pesagemveiculocarga_dump['listaManifestos'] = \
-            self.load_filhos(evento.listaManifestos, lexclude)
-        return pesagemveiculocarga_dump
+        :param campos: árvore de arvore_campos ou None (todos os campos)
+        :return: dict do evento com as listas de filhos
+        """
+        return self.load_evento_com_filhos(orm.PesagemVeiculoCarga,
+                                           codRecinto, idEvento, campos)
 
     def insert_acessoveiculo(self, evento: dict) -> orm.AcessoVeiculo:
-        logging.info('Creating PesagemVeiculoCarga %s..', evento.get('IDEvento'))
-        acessoveiculo = self.insert_evento(orm.AcessoVeiculo, evento,
-                                           commit=False)
-
-        listareboques = evento.get('listaSemirreboque', [])
-        for reboque in listareboques:
-            # reboque['acessoveiculo_id'] = acessoveiculo.ID
-            logging.info('Creating semirreboque %s..',
-                         reboque.get('placa'))
-            ormreboque = orm.ReboqueGate(acessoveiculo_id=acessoveiculo.ID,
-                                         **reboque)
-            self.db_session.add(ormreboque)
-            if reboque.get('listaLacres'):
-                self.db_session.flush()
-                self.db_session.refresh(ormreboque)
-                self.insert_filhos(ormreboque.ID,
-                                   reboque.get('listaLacres'),
-                                   orm.LacreReboque,
-                                   'reboquegate_id')
-
-        listaconteineres = evento.get('listaConteineresUld', [])
-        for conteiner in listaconteineres:
-            # conteiner['acessoveiculo_id'] = acessoveiculo.ID
-            logging.info('Creating conteinergate %s..',
-                         conteiner.get('placa'))
-            ormconteiner = orm.ConteineresGate(acessoveiculo_id=acessoveiculo.ID,
-                                         **conteiner)
-            self.db_session.add(ormconteiner)
-            if conteiner.get('listaLacres'):
-                self.db_session.flush()
-                self.db_session.refresh(ormconteiner)
-                self.insert_filhos(ormconteiner.ID,
-                                   conteiner.get('listaLacres'),
-                                   orm.LacreConteiner,
-                                   'conteineresgate_id')
-
-        listamanifestos = evento.get('listaManifestos', [])
-        self.insert_filhos(acessoveiculo.ID, listamanifestos,
-                           orm.ManifestoGate, 'acessoveiculo_id')
-        listadidue = evento.get('listaDiDue', [])
-        self.insert_filhos(acessoveiculo.ID, listadidue,
-                           orm.DiDueGate, 'acessoveiculo_id')
-        for item in evento.get('listaChassi'):
-            ochassi = orm.ChassiGate(
-                acessoveiculo_id=acessoveiculo.ID, num=item
-            )
-            self.db_session.add(ochassi)
-        for item in evento.get('listaNfe'):
-            anfe = orm.NfeGate(
-                acessoveiculo=acessoveiculo, chavenfe=item
-            )
-            self.db_session.add(anfe)
-        self.db_session.commit()
-        self.db_session.refresh(acessoveiculo)
-        return acessoveiculo
+        logging.info('Creating AcessoVeiculo %s..', evento.get('idEvento'))
+        return self.insert_evento_com_filhos(orm.AcessoVeiculo, evento)
 
     def load_acessoveiculo(self, codRecinto: str,
-                           idEvento: str) -> orm.AcessoVeiculo:
+                           idEvento: str, campos: dict = None) -> dict:
         """
         Retorna PesagemVeiculoCarga encontrada única no filtro recinto E IDEvento.
 
         :param codRecinto: Codigo do recinto
         :param IDEvento: ID do Evento informado pelo recinto
-        :return: instância objeto orm.InspecaonaoInvasiva
-        """
-        evento = orm.AcessoVeiculo.query.filter(
-            orm.AcessoVeiculo.idEvento == idEvento,
-            orm.AcessoVeiculo.codRecinto == codRecinto
-        ).outerjoin(
-            orm.ReboqueGate
-        ).outerjoin(
-            orm.LacreReboque
-        ).outerjoin(
-            orm.ConteineresGate
-        ).outerjoin(
-            orm.LacreConteiner
-        ).outerjoin(
-            orm.ManifestoGate
-        ).outerjoin(
-            orm.DiDueGate
-        ).outerjoin(
-            orm.NfeGate
-        ).outerjoin(
-            orm.ChassiGate
-        ).one()
-        acessoveiculo_dump = evento.dump()
-        lexclude = ['ID', 'acessoveiculo', 'acessoveiculo_id']
-
-        semirreboques = self.load_filhos(evento.listaSemirreboque, lexclude)
-        for ind, reboque in enumerate(evento.listaSemirreboque):
-            listaLacres = self.load_filhos(reboque.listaLacres,
-                                           ['ID', 'reboquegate', 'reboquegate_id'])
-            semirreboques[ind]['listaLacres'] = listaLacres
-        acessoveiculo_dump['listaSemirreboque'] = semirreboques
-
-        conteineres = self.load_filhos(evento.listaConteineresUld, lexclude)
-        for ind, conteiner in enumerate(evento.listaConteineresUld):
-            listaLacres = self.load_filhos(conteiner.listaLacres,
-                                           ['ID', 'conteineresgate', 'conteineresgate_id'])
-            conteineres[ind]['listaLacres'] = listaLacres
-            print('Lista LACRES', listaLacres)
-        acessoveiculo_dump['listaConteineresUld'] = conteineres
-        acessoveiculo_dump['listaManifestos'] = \
-            self.load_filhos(evento.listaManifestos, lexclude)
-        acessoveiculo_dump['listaDiDue'] = \
-            self.load_filhos(evento.listaDiDue, lexclude)
-        if evento.listaChassi and len(evento.listaChassi) > 0:
-            acessoveiculo_dump['listaChassi'] = []
-            for item in evento.listaChassi:
-                acessoveiculo_dump['listaChassi'].append(
-                    item.num
-                )
-        if evento.listaNfe and len(evento.listaNfe) > 0:
-            acessoveiculo_dump['listaNfe'] = []
-            for item in evento.listaNfe:
-                acessoveiculo_dump['listaNfe'].append(
-                    item.chavenfe
-                )
-        return acessoveiculo_dump
+        :param campos: árvore de arvore_campos ou None (todos os campos)
+        :return: dict do evento com as listas de filhos
+        """
+        return self.load_evento_com_filhos(orm.AcessoVeiculo,
+                                           codRecinto, idEvento, campos)
 
-    def load_arquivo_eventos(self, file):
-        """Valida e carrega arquivo JSON de eventos."""
-        validfile, mensagem = self.valid_file(file,
-                                              extensions=['json', 'bson', 'zip'])
+    def load_arquivo_eventos(self, file, tipoevento: str = None,
+                             tamanho_lote: int = TAMANHO_LOTE_ARQUIVO):
+        """Valida arquivo de eventos e retorna gerador de lotes de eventos.
+
+        Formatos aceitos:
+            .json: {tipoevento: [eventos]}, carregado inteiro na memória
+            .ndjson ou .jsonl: um evento por linha, lido incrementalmente.
+            tipoevento é o nome do arquivo sem extensão ou o parâmetro
+            tipoevento
+            .zip: um membro por tipoevento, em qualquer dos formatos acima
+
+        :param file: arquivo recebido
+        :param tipoevento: tipo dos eventos, se NDJSON fora do padrão de nome
+        :param tamanho_lote: máximo de eventos por lote
+        :return: gerador de (tipoevento, lote). lote é lista de
+            (linha, evento), evento é a exceção se a linha for inválida
+        """
+        validfile, mensagem = self.valid_file(
+            file, extensions=['json', 'ndjson', 'jsonl', 'zip'])
         if not validfile:
             raise Exception(mensagem)
-        if 'zip' in file.filename:
-            file = ZipFile(file)
-        content = file.read()
-        content = content.decode('utf-8')
-        eventos = json.loads(content)
-        return eventos
+        return self._lotes_arquivo(file, tipoevento, tamanho_lote)
+
+    def _lotes_arquivo(self, file, tipoevento, tamanho_lote):
+        stream = getattr(file, 'stream', file)
+        if not file.filename.lower().endswith('.zip'):
+            yield from self._lotes_conteudo(stream, file.filename,
+                                            tipoevento, tamanho_lote)
+            return
+        with ZipFile(stream) as arquivozip:
+            for membro in arquivozip.infolist():
+                if membro.is_dir():
+                    continue
+                with arquivozip.open(membro) as conteudo:
+                    yield from self._lotes_conteudo(conteudo, membro.filename,
+                                                    None, tamanho_lote)
+
+    def _lotes_conteudo(self, conteudo, nomearquivo, tipoevento, tamanho_lote):
+        nome, extensao = os.path.splitext(os.path.basename(nomearquivo))
+        texto = io.TextIOWrapper(conteudo, encoding='utf-8')
+        if extensao.lower() == '.json':
+            for tipo, eventos in json.load(texto).items():
+                if isinstance(eventos, dict):
+                    eventos = [eventos]
+                for inicio in range(0, len(eventos), tamanho_lote):
+                    yield tipo, list(enumerate(
+                        eventos[inicio:inicio + tamanho_lote], inicio + 1))
+            return
+        tipoevento = tipoevento or nome
+        lote = []
+        for linha, conteudo_linha in enumerate(texto, 1):
+            if not conteudo_linha.strip():
+                continue
+            try:
+                evento = json.loads(conteudo_linha)
+                if not isinstance(evento, dict):
+                    raise ValueError('Linha não contém um objeto JSON')
+            except ValueError as err:
+                evento = err
+            lote.append((linha, evento))
+            if len(lote) >= tamanho_lote:
+                yield tipoevento, lote
+                lote = []
+        if lote:
+            yield tipoevento, lote
+
+    def insert_lote_arquivo(self, tipoevento: str, lote: list) -> list:
+        """Insere lote lido de arquivo de eventos.
+
+        Eventos já existentes no Banco retornam o hash gravado, para
+        conferência pelo recinto.
+
+        :param tipoevento: Nome da Classe ORM do evento
+        :param lote: lista de (linha, evento) gerada por load_arquivo_eventos
+        :return: lista de dicts com tipoevento, linha, IDEvento e
+            hash ou erro, na ordem do lote
+        """
+        aclass = getattr(orm, tipoevento, None)
+        if not (isinstance(aclass, type) and issubclass(aclass, orm.EventoBase)):
+            erro = AttributeError('tipoevento "%s" não existente' % tipoevento)
+            lote = [(linha, erro) for linha, _ in lote]
+        validos = [evento for _, evento in lote
+                   if not isinstance(evento, Exception)]
+        resultados = iter(self.insert_eventos_lote(aclass, validos)
+                          if validos else [])
+        repetidos = []
+        result = []
+        for linha, evento in lote:
+            item = {'tipoevento': tipoevento, 'linha': linha}
+            if isinstance(evento, Exception):
+                item['IDEvento'] = None
+                item['erro'] = str(evento)
+                result.append(item)
+                continue
+            item['IDEvento'] = evento.get('idEvento')
+            resultado = next(resultados)
+            if isinstance(resultado, EventoDuplicado):
+                repetidos.append((evento.get('codRecinto'), item, resultado))
+            elif isinstance(resultado, Exception):
+                item['erro'] = str(resultado)
+            else:
+                item['hash'] = resultado.hash
+            result.append(item)
+        hashes_gravados = self.valores_por_chave(
+            aclass,
+            [(codRecinto, item['IDEvento']) for codRecinto, item, _ in repetidos],
+            'hash')
+        for codRecinto, item, erro in repetidos:
+            chave = (codRecinto, item['IDEvento'])
+            if chave in hashes_gravados:
+                item['hash'] = hashes_gravados[chave]
+            else:
+                item['erro'] = str(erro)
+        return result
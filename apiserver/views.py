@@ -1,15 +1,19 @@
+import json
 import logging
 import os
+import tempfile
 from base64 import b85encode
 
 from dateutil.parser import parse
 from flask import current_app, request, render_template, \
-    jsonify, Response, send_from_directory
+    jsonify, send_file, send_from_directory
 
-from apiserver.api import dump_eventos, _response, _commit, create_usecases
+from apiserver.api import classe_evento, dump_eventos, _response, _grava, \
+    create_usecases
 from apiserver.logconf import logger
 from apiserver.models import orm
-from apiserver.use_cases.usecases import UseCases
+from apiserver.respostas import envia_arquivo
+from apiserver.use_cases.usecases import UseCases, TAMANHO_PAGINA
 
 
 def home():
@@ -37,12 +41,12 @@ def getfile():
         if evento is None:
             return jsonify(_response('Evento não encontrado.', 404)), 404
         oanexo = UseCases.get_anexo(evento, nomearquivo)
+        if oanexo is None:
+            return jsonify(_response('Anexo não encontrado.', 404)), 404
         basepath = current_app.config.get('UPLOAD_FOLDER')
-        oanexo.load_file(basepath)
-        print(oanexo.content)
-        return Response(response=oanexo.content,
-                        mimetype=oanexo.contentType
-                        ), 200
+        por_hash = current_app.config.get('ANEXOS_POR_HASH', False)
+        return envia_arquivo(oanexo.caminhos_arquivo(basepath, por_hash),
+                             oanexo.contentType, oanexo.hashArquivo)
     except Exception as err:
         logging.error(err, exc_info=True)
         return jsonify(_response(err, 400)), 400
@@ -62,9 +66,11 @@ def uploadfile():
         if not validfile:
             return jsonify(_response(mensagem, 400)), 400
         aclass = getattr(orm, tipoevento)
-        evento = db_session.query(aclass).filter(
-            aclass.IDEvento == IDEvento
-        ).one_or_none()
+        query = db_session.query(aclass).filter(aclass.idEvento == IDEvento)
+        codRecinto = request.form.get('codRecinto')
+        if codRecinto:
+            query = query.filter(aclass.codRecinto == codRecinto)
+        evento = query.one_or_none()
         if evento is None:
             return jsonify(_response('Evento não encontrado.', 404)), 404
         db_session.add(evento)
@@ -75,53 +81,70 @@ def uploadfile():
                 evento
             )
         basepath = current_app.config.get('UPLOAD_FOLDER')
+        # Lido em pedaços: o upload não é carregado inteiro na memória
         oanexo.save_file(basepath,
-                         file.read(),
-                         file.filename
+                         file.stream,
+                         file.filename,
+                         por_hash=usecase.por_hash
                          )
         db_session.add(oanexo)
-        return jsonify(_commit(evento)), 201
+        resposta = _grava(evento)
+        return jsonify(resposta), resposta[1]
     except Exception as err:
         logger.error(str(err), exc_info=True)
         return jsonify(_response(err, 400)), 400
 
 
 def seteventosnovos():
+    """Insere arquivo de eventos em lotes e retorna hash de cada evento.
+
+    Arquivos .json retornam lista JSON. Arquivos NDJSON e zip são lidos
+    incrementalmente, gravados a cada lote, e o resultado é retornado
+    em NDJSON, uma linha por evento.
+    """
     usecase = create_usecases()
     try:
         file = request.files.get('file')
-        eventos = usecase.load_arquivo_eventos(file)
-        for tipoevento, eventos in eventos.items():
-            aclass = getattr(orm, tipoevento)
-            for evento in eventos:
-                try:
-                    usecase.insert_evento(aclass, evento, commit=False)
-                # Ignora exceções porque vai comparar no Banco de Dados
-                except Exception as err:
-                    logging.error(str(err))
-            try:
-                usecase.db_session.commit()
-            except Exception as err:
-                logging.error(str(err))
-            result = []
-            for evento in eventos:
-                try:
-                    IDEvento = evento.get('IDEvento')
-                    evento_recuperado = usecase.load_evento(aclass, IDEvento)
-                    ohash = hash(evento_recuperado)
-                    result.append({'IDEvento': IDEvento, 'hash': ohash})
-                    logger.info('Recinto: %s IDEvento: %d ID: %d hash: %d' %
-                                (evento_recuperado.recinto, IDEvento,
-                                 evento_recuperado.ID, ohash))
-                except Exception as err:
-                    result.append({'IDEvento': IDEvento, 'hash': str(err)})
-                    logger.error('Evento ID:  %d erro: %s' %
-                                 (IDEvento,
-                                  str(err)))
+        lotes = usecase.load_arquivo_eventos(file,
+                                             request.form.get('tipoevento'))
+    except Exception as err:
+        logging.error(err, exc_info=True)
+        return str(err), 405
+
+    def gera_resultados():
+        processados = 0
+        erros = 0
+        for tipoevento, lote in lotes:
+            itens = usecase.insert_lote_arquivo(tipoevento, lote)
+            # Cada lote gravado é confirmado: arquivo grande não fica
+            # numa única transação até o fim da leitura
+            usecase.db_session.commit()
+            for item in itens:
+                if item.get('erro') is None:
+                    logger.info('Tipo: %s IDEvento: %s hash: %s' %
+                                (tipoevento, item['IDEvento'], item['hash']))
+                else:
+                    erros += 1
+                    logger.error('Tipo: %s linha: %d IDEvento: %s erro: %s' %
+                                 (tipoevento, item['linha'], item['IDEvento'],
+                                  item['erro']))
+                yield item
+            processados += len(lote)
+            logger.info('Arquivo %s: %d eventos processados, %d com erro' %
+                        (file.filename, processados, erros))
+
+    try:
+        if file.filename.lower().endswith('.json'):
+            return jsonify(list(gera_resultados())), 201
+        # Resultados vão para arquivo temporário: memória não cresce com o upload
+        resultados = tempfile.TemporaryFile()
+        for item in gera_resultados():
+            resultados.write(json.dumps(item).encode('utf-8') + b'\n')
+        resultados.seek(0)
     except Exception as err:
         logging.error(err, exc_info=True)
         return str(err), 405
-    return jsonify(result), 201
+    return send_file(resultados, mimetype='application/x-ndjson'), 201
 
 
 def geteventosnovos():
@@ -138,11 +161,12 @@ def geteventosnovos():
                 return jsonify(_response('IDEvento e dataevento invalidos, '
                                          'ao menos um dos dois e necessario', 400)), 400
             dataevento = None
-        tipoevento = request.form.get('tipoevento')
-        aclass = getattr(orm, tipoevento)
+        aclass = classe_evento(request.form.get('tipoevento'))
         fields = request.form.get('fields')
-        eventos = usecase.load_eventosnovos(aclass, IDEvento, dataevento, fields)
-        if eventos is None:
+        limite = int(request.form.get('limit', TAMANHO_PAGINA))
+        eventos = usecase.load_eventosnovos(aclass, IDEvento, dataevento, fields,
+                                            limite)
+        if not eventos:
             if dataevento is None:
                 return jsonify(_response('Sem eventos com ID maior que %d.' %
                                          IDEvento, 404)), 404
@@ -164,6 +188,14 @@ def create_views(app):
     if not os.path.exists(UPLOAD_FOLDER):
         os.mkdir(UPLOAD_FOLDER)
     app.app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+    # Envio dos arquivos pelo servidor web: prefixo da location internal do
+    # nginx para UPLOAD_FOLDER ou X-Sendfile (Apache, lighttpd)
+    app.app.config['X_ACCEL_REDIRECT'] = os.environ.get('X_ACCEL_REDIRECT')
+    app.app.config['USE_X_SENDFILE'] = \
+        os.environ.get('USE_X_SENDFILE', 'NO').lower() == 'yes'
+    # Anexos guardados uma vez por conteúdo (SHA-256), ver orm.caminho_por_hash
+    app.app.config['ANEXOS_POR_HASH'] = \
+        os.environ.get('ANEXOS_POR_HASH', 'NO').lower() == 'yes'
     app.add_url_rule('/', 'home', home)
     app.add_url_rule('/upload_file', 'uploadfile', uploadfile, methods=['POST'])
     app.add_url_rule('/get_file', 'getfile', getfile)
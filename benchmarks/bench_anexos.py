@@ -0,0 +1,144 @@
+"""Benchmark de GET /inspecaonaoinvasiva com muitos anexos.
+
+Grava inspeções com ANEXOS anexos (POST) e mede o GET com o conteúdo dos
+anexos (fields=anexos.content) seguido do download de cada anexo, contando
+as chamadas a os.path.exists, os.mkdir e os.makedirs (coluna fs).
+Compara monta_caminho_arquivo como era antes (exists/mkdir em cada nível, também nas leituras) com o
+atual, com o cache de diretórios vazio (frio) e já preenchido (quente).
+
+    $python benchmarks/bench_anexos.py
+"""
+import logging
+import os
+import sys
+import time
+from base64 import b64encode
+from tempfile import TemporaryDirectory
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# operationIds do openapi.yaml são relativos ao pacote apiserver
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'apiserver'))
+
+from apiserver.main import create_app  # noqa: E402
+from apiserver.models import orm  # noqa: E402
+
+ANEXOS = 50
+TAMANHO_ANEXO = 100 * 1024
+REPETICOES = 20
+
+
+def monta_caminho_antigo(self, basepath, eventobase):
+    filepath = basepath
+    for caminho in [eventobase.codRecinto,
+                    eventobase.dtHrOcorrencia.year,
+                    eventobase.dtHrOcorrencia.month,
+                    eventobase.dtHrOcorrencia.day]:
+        filepath = os.path.join(filepath, str(caminho))
+        if not os.path.exists(filepath):
+            os.mkdir(filepath)
+    return filepath
+
+
+class ContaChamadas:
+    """Conta chamadas a os.path.exists, os.mkdir e os.makedirs."""
+
+    NOMES = (('path', 'exists'), (None, 'mkdir'), (None, 'makedirs'))
+
+    def __init__(self):
+        self.chamadas = 0
+        self.originais = []
+
+    def __enter__(self):
+        for modulo, nome in self.NOMES:
+            alvo = getattr(os, modulo) if modulo else os
+            original = getattr(alvo, nome)
+            self.originais.append((alvo, nome, original))
+            setattr(alvo, nome, self._conta(original))
+        return self
+
+    def _conta(self, funcao):
+        def contada(*args, **kwargs):
+            self.chamadas += 1
+            return funcao(*args, **kwargs)
+        return contada
+
+    def __exit__(self, *args):
+        for alvo, nome, original in self.originais:
+            setattr(alvo, nome, original)
+
+
+def cria_inspecao(client, headers, idEvento) -> dict:
+    evento = {'idEvento': idEvento, 'codRecinto': '00001',
+              'dtHrOcorrencia': '2020-01-01T10:00:00',
+              'dtHrRegistro': '2020-01-01T10:00:00',
+              'dtHrTransmissao': '2020-01-01T10:00:00',
+              'anexos': []}
+    for ind in range(ANEXOS):
+        evento['anexos'].append({
+            'nomeArquivo': 'imagem%03d.jpg' % ind,
+            'content': b64encode(os.urandom(TAMANHO_ANEXO)).decode()})
+    rv = client.post('/apirecintos/inspecaonaoinvasiva', json=evento,
+                     headers=headers)
+    assert rv.status_code == 201, rv.json
+    return evento
+
+
+def mede_post(client, headers, idEvento) -> (float, int):
+    """Tempo (ms) e chamadas ao sistema de arquivos de um POST."""
+    with ContaChamadas() as conta:
+        inicio = time.perf_counter()
+        evento = cria_inspecao(client, headers, idEvento)
+        tempo = time.perf_counter() - inicio
+    url = '/apirecintos/inspecaonaoinvasiva/%s/%s' % (
+        evento['codRecinto'], evento['idEvento'])
+    return url, tempo * 1000, conta.chamadas
+
+
+def mede_get(client, headers, url) -> (float, int):
+    """Tempo médio (ms) e chamadas ao sistema de arquivos por GET."""
+    with ContaChamadas() as conta:
+        inicio = time.perf_counter()
+        for _ in range(REPETICOES):
+            rv = client.get(url + '?fields=anexos.content,anexos.url',
+                            headers=headers)
+            for anexo in rv.json['anexos']:
+                client.get('/apirecintos' + anexo['url'],
+                           headers=headers).close()
+        tempo = time.perf_counter() - inicio
+    return tempo / REPETICOES * 1000, conta.chamadas // REPETICOES
+
+
+def main():
+    logging.disable(logging.INFO)
+    db_session, engine = orm.init_db('sqlite:///:memory:')
+    orm.Base.metadata.create_all(bind=engine)
+    app = create_app(db_session, engine)
+    client = app.app.test_client()
+    token = client.post('/apirecintos/auth', json={
+        'recinto': '00001', 'senha': 'senha'}).data.decode().strip()
+    headers = {'Authorization': 'Bearer %s' % token}
+    monta_caminho_atual = orm.AnexoBase.monta_caminho_arquivo
+    print('%d anexos de %d KiB; GET: média de %d (evento + downloads)' %
+          (ANEXOS, TAMANHO_ANEXO // 1024, REPETICOES))
+    print('%-16s %10s %6s %10s %6s' % ('', 'POST ms', 'fs', 'GET ms', 'fs'))
+    for titulo, monta_caminho, limpa_cache in (
+            ('antes', monta_caminho_antigo, True),
+            ('depois (frio)', monta_caminho_atual, True),
+            ('depois (quente)', monta_caminho_atual, False)):
+        orm.AnexoBase.monta_caminho_arquivo = monta_caminho
+        with TemporaryDirectory() as tmpdir:
+            app.app.config['UPLOAD_FOLDER'] = tmpdir
+            if limpa_cache:
+                orm._diretorios_criados.clear()
+            else:
+                # Cache preenchido por uma gravação anterior no diretório
+                cria_inspecao(client, headers, titulo + ' aquece')
+            url, tempo_post, dirs_post = mede_post(client, headers, titulo)
+            tempo_get, dirs_get = mede_get(client, headers, url)
+        print('%-16s %10.2f %6d %10.2f %6d' % (titulo, tempo_post, dirs_post,
+                                               tempo_get, dirs_get))
+    orm.AnexoBase.monta_caminho_arquivo = monta_caminho_atual
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""Micro-benchmark dos construtores de eventos.
+
+Compara a construção de PesagemVeiculoCarga e AcessoVeiculo a partir do
+JSON de exemplo usando parse_datahora (fromisoformat) e o parse do dateutil
+para todas as datas, como era antes.
+
+    $python benchmarks/bench_construtores.py
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from dateutil.parser import parse  # noqa: E402
+
+from apiserver.models import orm  # noqa: E402
+
+JSON_TEST_CASES_PATH = os.path.join(os.path.dirname(__file__), '..',
+                                    'tests', 'json_exemplos')
+REPETICOES = 5000
+
+
+def mede(aclass, evento, repeticoes=REPETICOES) -> float:
+    """Menor tempo, em microssegundos, de uma construção de aclass."""
+    tempos = timeit.repeat(lambda: aclass(**evento), number=repeticoes, repeat=5)
+    return min(tempos) / repeticoes * 1e6
+
+
+def main():
+    parse_datahora = orm.parse_datahora
+    for aclass in (orm.PesagemVeiculoCarga, orm.AcessoVeiculo):
+        with open(os.path.join(JSON_TEST_CASES_PATH,
+                               aclass.__name__ + '.json')) as json_in:
+            evento = json.load(json_in)
+        orm.parse_datahora = parse
+        antes = mede(aclass, evento)
+        orm.parse_datahora = parse_datahora
+        depois = mede(aclass, evento)
+        print('%-20s dateutil: %7.1f us  fromisoformat: %7.1f us  (%.1fx)' %
+              (aclass.__name__, antes, depois, antes / depois))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Benchmark da serialização e compressão de um resultado de /eventos/filter.
+
+Gera 50 mil eventos AcessoVeiculo sintéticos (a partir do JSON de exemplo,
+com datas como datetime, como saem do dump) e mede, para o corpo NDJSON:
+tempo de serialização com json (como era antes) e com codifica_json
+(orjson, se instalado), e bytes trafegados e tempo de compressão sem
+compressão, com gzip e com brotli (se instalado).
+
+    $python benchmarks/bench_respostas.py
+"""
+import json
+import os
+import sys
+import time
+from copy import deepcopy
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from apiserver import respostas  # noqa: E402
+
+JSON_TEST_CASES_PATH = os.path.join(os.path.dirname(__file__), '..',
+                                    'tests', 'json_exemplos')
+QUANTIDADE = 50000
+TAMANHO_LOTE = 400
+
+
+def gera_eventos(quantidade=QUANTIDADE) -> list:
+    with open(os.path.join(JSON_TEST_CASES_PATH,
+                           'AcessoVeiculo.json')) as json_in:
+        modelo = json.load(json_in)
+    modelo.pop('hash', None)
+    inicio = datetime(2020, 1, 1)
+    eventos = []
+    for ind in range(quantidade):
+        evento = deepcopy(modelo)
+        evento['ID'] = ind + 1
+        evento['idEvento'] = 'AV%08d' % ind
+        evento['dtHrOcorrencia'] = inicio + timedelta(seconds=ind * 17)
+        evento['dtHrRegistro'] = evento['dtHrOcorrencia']
+        evento['dtHrTransmissao'] = evento['dtHrOcorrencia']
+        eventos.append(evento)
+    return eventos
+
+
+def ndjson_stdlib(eventos) -> bytes:
+    return b''.join((json.dumps(evento, default=str) + '\n').encode('utf-8')
+                    for evento in eventos)
+
+
+def ndjson_codifica(eventos) -> bytes:
+    return b''.join(respostas.codifica_json(evento) + b'\n'
+                    for evento in eventos)
+
+
+def mede(funcao, *args):
+    inicio = time.perf_counter()
+    resultado = funcao(*args)
+    return resultado, time.perf_counter() - inicio
+
+
+def comprime_em_lotes(corpo: bytes, codificacao: str) -> bytes:
+    """Simula o streaming: comprime pedaço a pedaço, um por lote."""
+    passo = len(corpo) // (QUANTIDADE // TAMANHO_LOTE)
+    pedacos = (corpo[ind:ind + passo] for ind in range(0, len(corpo), passo))
+    return b''.join(respostas.comprime_stream(pedacos, codificacao))
+
+
+def main():
+    eventos = gera_eventos()
+    print('%d eventos AcessoVeiculo' % len(eventos))
+    antes, tempo_antes = mede(ndjson_stdlib, eventos)
+    depois, tempo_depois = mede(ndjson_codifica, eventos)
+    print('serialização json: %8.3f s' % tempo_antes)
+    print('serialização %s: %8.3f s (%.1fx)' % (
+        'orjson' if respostas.orjson is not None else 'json',
+        tempo_depois, tempo_antes / tempo_depois))
+    print('sem compressão: %12d bytes' % len(depois))
+    codificacoes = ['gzip'] + (['br'] if respostas.brotli is not None else [])
+    for codificacao in codificacoes:
+        comprimido, tempo = mede(comprime_em_lotes, depois, codificacao)
+        print('%-14s %12d bytes (%.1f%%) em %.3f s' % (
+            codificacao + ':', len(comprimido),
+            len(comprimido) / len(depois) * 100, tempo))
+    if respostas.brotli is None:
+        print('brotli não instalado')
+
+
+if __name__ == '__main__':
+    main()
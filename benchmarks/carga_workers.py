@@ -0,0 +1,132 @@
+"""Teste de carga: requisições por segundo em função do número de workers.
+
+Cria o schema em um arquivo SQLite (passo explícito, como o
+create_mysql.py: o app de produção não mexe no schema), sobe o gunicorn
+com gunicorn.conf.py e WORKERS workers, grava um evento AcessoVeiculo de
+exemplo e dispara GETs dele a partir de CLIENTES threads, cada uma com sua conexão keep-alive,
+por DURACAO segundos.
+
+Rode da raiz do projeto, com gunicorn instalado:
+
+    $python benchmarks/carga_workers.py
+
+Com BENCH_DB_URI, usa esse Banco (schema já criado) no lugar do SQLite.
+A escala só aparece em máquina com mais de um núcleo.
+"""
+import http.client
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from tempfile import TemporaryDirectory
+
+RAIZ = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.join(RAIZ, 'apiserver'))
+
+from apiserver.models import orm  # noqa: E402
+
+WORKERS = (1, 2, 4)
+THREADS = 4
+CLIENTES = 32
+DURACAO = 10
+PORTA = 8765
+JSON_EXEMPLO = os.path.join(RAIZ, 'tests', 'json_exemplos',
+                            'AcessoVeiculo.json')
+
+
+def cria_schema(uri: str):
+    db_session, engine = orm.init_db(uri)
+    orm.Base.metadata.create_all(bind=engine)
+    engine.dispose()
+
+
+def grava_evento() -> str:
+    """Grava o evento de exemplo (se ainda não gravado); retorna URL do GET."""
+    with open(JSON_EXEMPLO) as json_in:
+        evento = json.load(json_in)
+    conexao = http.client.HTTPConnection('127.0.0.1', PORTA, timeout=30)
+    conexao.request('POST', '/apirecintos/acessoveiculo', json.dumps(evento),
+                    {'Content-Type': 'application/json'})
+    conexao.getresponse().read()
+    conexao.close()
+    return '/apirecintos/acessoveiculo/%s/%s' % (evento['codRecinto'],
+                                                evento['idEvento'])
+
+
+def sobe_gunicorn(workers: int, uri: str) -> subprocess.Popen:
+    env = dict(os.environ, DATABASE_URL=uri, WEB_CONCURRENCY=str(workers),
+               GUNICORN_THREADS=str(THREADS), PORT=str(PORTA))
+    processo = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+         '--access-logfile', '', '--log-level', 'warning', 'wsgi:app'],
+        cwd=RAIZ, env=env)
+    for _ in range(300):
+        try:
+            conexao = http.client.HTTPConnection('127.0.0.1', PORTA, timeout=1)
+            conexao.request('GET', '/apirecintos/openapi.json')
+            conexao.getresponse().read()
+            conexao.close()
+            return processo
+        except OSError:
+            time.sleep(0.1)
+    processo.terminate()
+    raise RuntimeError('gunicorn não respondeu na porta %d' % PORTA)
+
+
+def cliente(url: str, fim: float, contagem: list, erros: list):
+    conexao = http.client.HTTPConnection('127.0.0.1', PORTA, timeout=30)
+    feitas = falhas = 0
+    while time.perf_counter() < fim:
+        conexao.request('GET', url)
+        resposta = conexao.getresponse()
+        resposta.read()
+        if resposta.status == 200:
+            feitas += 1
+        else:
+            falhas += 1
+    conexao.close()
+    contagem.append(feitas)
+    erros.append(falhas)
+
+
+def mede(url: str) -> (float, int):
+    contagem, erros = [], []
+    inicio = time.perf_counter()
+    fim = inicio + DURACAO
+    clientes = [threading.Thread(target=cliente,
+                                 args=(url, fim, contagem, erros))
+                for _ in range(CLIENTES)]
+    for thread in clientes:
+        thread.start()
+    for thread in clientes:
+        thread.join()
+    return sum(contagem) / (time.perf_counter() - inicio), sum(erros)
+
+
+def main():
+    with TemporaryDirectory() as tmpdir:
+        uri = os.environ.get('BENCH_DB_URI',
+                             'sqlite:///' + os.path.join(tmpdir, 'carga.db'))
+        if 'BENCH_DB_URI' not in os.environ:
+            cria_schema(uri)
+        url = None
+        print('%d núcleos; %d clientes por %d s; %d threads por worker' %
+              (os.cpu_count(), CLIENTES, DURACAO, THREADS))
+        print('%8s %10s %8s' % ('workers', 'req/s', 'erros'))
+        for workers in WORKERS:
+            processo = sobe_gunicorn(workers, uri)
+            try:
+                if url is None:
+                    url = grava_evento()
+                vazao, erros = mede(url)
+            finally:
+                processo.terminate()
+                processo.wait()
+            print('%8d %10.0f %8d' % (workers, vazao, erros))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+"""Configuração do gunicorn para produção.
+
+    $gunicorn wsgi:app        (ou wsgi_mysql:app)
+
+Workers gthread: um processo por núcleo, para usar todos, e threads em
+cada processo, para que a espera por Banco e disco não bloqueie o worker.
+
+Variáveis de ambiente:
+    PORT: porta (padrão 8000)
+    WEB_CONCURRENCY: número de workers (padrão: núcleos da máquina)
+    GUNICORN_THREADS: threads por worker (padrão 4)
+    DB_POOL_SIZE: se não definido, igual a GUNICORN_THREADS
+"""
+import multiprocessing
+import os
+
+bind = '0.0.0.0:%s' % os.environ.get('PORT', '8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+# Uma conexão do pool por thread do worker (ver models/pool.py)
+os.environ.setdefault('DB_POOL_SIZE', str(threads))
+
+# Não carregar o app no processo mestre: engine, pool de conexões e
+# threads de ingestão precisam ser criados em cada worker, depois do fork
+preload_app = False
+
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+# Recicla workers aos poucos, para conter crescimento de memória
+max_requests = 10000
+max_requests_jitter = 1000
+accesslog = '-'
@@ -0,0 +1,48 @@
+"""Inclui em Banco existente as colunas de anexos tamanhoArquivo e hashArquivo.
+
+create_mysql.py recria todas as tabelas, apagando os dados. Este script só
+acrescenta às tabelas de anexos (AnexoBase) as colunas e o índice que
+faltarem, o equivalente a:
+
+    ALTER TABLE anexosinspecao ADD COLUMN tamanhoArquivo INTEGER;
+    ALTER TABLE anexosinspecao ADD COLUMN hashArquivo VARCHAR(64);
+    CREATE INDEX ix_anexosinspecao_hashArquivo ON anexosinspecao (hashArquivo);
+
+Anexos antigos ficam com as colunas nulas e continuam lidos do diretório
+do evento. Pode ser rodado mais de uma vez.
+"""
+import os
+
+from sqlalchemy import inspect
+
+from apiserver.models import orm
+
+COLUNAS = ('tamanhoArquivo', 'hashArquivo')
+
+
+def migra(engine):
+    inspetor = inspect(engine)
+    for classe in orm.AnexoBase.__subclasses__():
+        tabela = classe.__table__
+        existentes = [coluna['name'] for coluna in
+                      inspetor.get_columns(tabela.name)]
+        for nome in COLUNAS:
+            if nome in existentes:
+                continue
+            tipo = tabela.c[nome].type.compile(dialect=engine.dialect)
+            print('%s: incluindo coluna %s %s' % (tabela.name, nome, tipo))
+            engine.execute('ALTER TABLE %s ADD COLUMN %s %s' %
+                           (tabela.name, nome, tipo))
+        indices = [indice['name'] for indice in
+                   inspetor.get_indexes(tabela.name)]
+        for indice in tabela.indexes:
+            if indice.name not in indices:
+                print('%s: criando índice %s' % (tabela.name, indice.name))
+                indice.create(bind=engine)
+
+
+if __name__ == '__main__':
+    MYSQLURI = os.environ.get('JAWSDB_URL',
+                              'mysql+mysqlconnector://apirecintos@localhost/apirecintos')
+    session, engine = orm.init_db(MYSQLURI)
+    migra(engine)
@@ -36,6 +36,10 @@ setup(
             'pytest-pep8',
             'pytest-cov',
             'tox'
+        ],
+        'rapido': [
+            'brotli',
+            'orjson'
         ]
     },
     packages=find_packages(),
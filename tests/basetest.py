@@ -1,6 +1,7 @@
 import json
 import os
 import random
+from copy import deepcopy
 from datetime import datetime
 from unittest import TestCase
 
@@ -52,6 +53,7 @@ class BaseTestCase(TestCase):
         self.load_test_cases()
 
     def tearDown(self) -> None:
+        self.db_session.remove()
         orm.Base.metadata.drop_all(bind=self.engine)
 
     def open_json_test_case(self, classe_evento):
@@ -68,6 +70,16 @@ class BaseTestCase(TestCase):
         for nomeclasse in self.tipos_evento:
             self.testes[nomeclasse] = self.open_json_test_case(nomeclasse)
 
+    def copias_evento(self, teste: dict, sufixos, **campos) -> list:
+        """Cópias de teste com idEvento '<idEvento>_<sufixo>' e campos trocados."""
+        copias = []
+        for sufixo in sufixos:
+            evento = deepcopy(teste)
+            evento['idEvento'] = '%s_%d' % (teste['idEvento'], sufixo)
+            evento.update(campos)
+            copias.append(evento)
+        return copias
+
 
 
     def extractDictAFromB(self, A, B):
@@ -115,6 +127,8 @@ class BaseTestCase(TestCase):
                             self.assertEqual(v, vb)
 
     def compara_eventos(self, teste, response_json):
+        # hash é calculado pelo servidor, não repete o enviado
+        teste.pop('hash', None)
         self.purge_datas(teste)
         self.purge_datas(response_json)
         # sub_response = extractDictAFromB(teste, response_json)
@@ -1,10 +1,30 @@
 import datetime
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
 import sys
-from base64 import b85encode
+import time
+import zlib
+from base64 import b64encode, b85encode
 from copy import deepcopy
 from io import BytesIO
+from tempfile import TemporaryDirectory
+from zipfile import ZipFile
 
-from apiserver.main import create_app
+from sqlalchemy import event
+
+from apiserver import authentication
+from apiserver.api import _gera_json, get_recinto
+from apiserver.duplicados import FiltroDuplicados, configure_duplicados
+from apiserver.ingestao import configure_ingestao, TrabalhadorIngestao
+from apiserver.limites import BaldesRecinto, configure_limites, \
+    fichas_da_requisicao, recinto_da_requisicao
+from apiserver.main import create_app, create_app_producao
+from apiserver.models import orm
+from apiserver.respostas import comprime_stream
+from apiserver.use_cases.usecases import UseCases, EventoDuplicado
 from basetest import BaseTestCase
 
 sys.path.insert(0, 'apiserver')
@@ -14,8 +34,8 @@ class APITestCase(BaseTestCase):
 
     def setUp(self):
         super().setUp()
-        app = create_app(self.db_session, self.engine)
-        self.client = app.app.test_client()
+        self.app = create_app(self.db_session, self.engine)
+        self.client = self.app.app.test_client()
         self.get_token()
 
     def tearDown(self) -> None:
@@ -44,6 +64,7 @@ class APITestCase(BaseTestCase):
             assert rv.is_json is True
 
     def compara_eventos(self, teste, response_json):
+        teste.pop('hash', None)
         for data in ['dataevento', 'dataregistro', 'dataoperacao', 'dataliberacao',
                      'dataagendamento', 'datamodificacao', 'datacriacao', 'inicio', 'fim',
                      'datanascimento', 'fimvalidade', 'iniciovalidade']:
@@ -108,3 +129,699 @@ class APITestCase(BaseTestCase):
         assert rv.status_code == 200
         assert rv.is_json is True
         self.compara_eventos(deepcopy(cadastro), rv.json)
+
+    def test5_lote(self):
+        for classe, teste in self.testes.items():
+            print(classe)
+            outro = deepcopy(teste)
+            outro['idEvento'] = teste['idEvento'] + '_2'
+            rv = self.client.post('/apirecintos/' + classe.lower() + '/lote',
+                                  json=[teste, outro, teste],
+                                  headers=self.headers)
+            assert rv.status_code == 201
+            assert rv.is_json is True
+            assert [item['status'] for item in rv.json] == [201, 201, 409]
+            assert rv.json[1]['idEvento'] == outro['idEvento']
+            for evento in (teste, outro):
+                rv = self.client.get(
+                    '/apirecintos/' + classe.lower() +
+                    '/' + str(evento['codRecinto']) +
+                    '/' + str(evento['idEvento']),
+                    headers=self.headers)
+                assert rv.status_code == 200
+            rv = self.client.post('/apirecintos/' + classe.lower() + '/lote',
+                                  json=[outro],
+                                  headers=self.headers)
+            assert rv.json[0]['status'] == 409
+
+    def test6_eventosnovos_upload(self):
+        eventos = {}
+        for classe, teste in self.testes.items():
+            outro = deepcopy(teste)
+            outro['idEvento'] = teste['idEvento'] + '_2'
+            eventos[classe] = [teste, outro]
+        conteudo = json.dumps(eventos).encode('utf-8')
+        rv = self.client.post('/eventosnovos/upload',
+                              data={'file': (BytesIO(conteudo), 'eventos.json')},
+                              headers=self.headers)
+        assert rv.status_code == 201
+        assert len(rv.json) == 2 * len(self.testes)
+        # Reenvio retorna os hashes gravados no Banco
+        rv2 = self.client.post('/eventosnovos/upload',
+                               data={'file': (BytesIO(conteudo), 'eventos.json')},
+                               headers=self.headers)
+        assert rv2.status_code == 201
+        assert rv2.json == rv.json
+
+    def test7_eventosnovos_upload_ndjson(self):
+        membros = {}
+        for classe, teste in self.testes.items():
+            linhas = [json.dumps(evento)
+                      for evento in self.copias_evento(teste, range(3))]
+            linhas.insert(1, '{linha invalida')
+            membros[classe] = '\n'.join(linhas) + '\n'
+        classe, conteudo = next(iter(membros.items()))
+        rv = self.client.post('/eventosnovos/upload',
+                              data={'file': (BytesIO(conteudo.encode('utf-8')),
+                                             classe + '.ndjson')},
+                              headers=self.headers)
+        assert rv.status_code == 201
+        resultado = [json.loads(linha) for linha in rv.data.splitlines()]
+        assert [item['linha'] for item in resultado] == [1, 2, 3, 4]
+        assert 'erro' in resultado[1]
+        assert all('hash' in resultado[ind] for ind in (0, 2, 3))
+        arquivozip = BytesIO()
+        with ZipFile(arquivozip, 'w') as zipout:
+            for classe, conteudo in membros.items():
+                zipout.writestr(classe + '.ndjson', conteudo)
+        arquivozip.seek(0)
+        rv = self.client.post('/eventosnovos/upload',
+                              data={'file': (arquivozip, 'eventos.zip')},
+                              headers=self.headers)
+        assert rv.status_code == 201
+        resultado = [json.loads(linha) for linha in rv.data.splitlines()]
+        assert len(resultado) == 4 * len(membros)
+        assert len([item for item in resultado if 'erro' in item]) == \
+            len(membros)
+
+    def test8_ingestao_assincrona(self):
+        with TemporaryDirectory() as tmpdir:
+            fila = configure_ingestao(self.app, ativa=True,
+                                      caminho=os.path.join(tmpdir, 'fila.db'),
+                                      trabalhadores=0)
+            trabalhador = TrabalhadorIngestao(fila, self.db_session, tmpdir)
+            tickets = {}
+            for classe, teste in self.testes.items():
+                rv = self.client.post('/apirecintos/' + classe.lower(),
+                                      json=teste,
+                                      headers=self.headers)
+                assert rv.status_code == 202
+                tickets[classe] = rv.json['detail']
+                rv = self.client.get('/apirecintos/ingestao/' + tickets[classe],
+                                     headers=self.headers)
+                assert rv.json['situacao'] == 'pendente'
+            rv = self.client.post('/apirecintos/acessoveiculo',
+                                  json=self.testes['AcessoVeiculo'],
+                                  headers=self.headers)
+            repetido = rv.json['detail']
+            assert trabalhador.processa_lote() == len(self.testes) + 1
+            for classe, ticket in tickets.items():
+                rv = self.client.get('/apirecintos/ingestao/' + ticket,
+                                     headers=self.headers)
+                assert rv.status_code == 200
+                assert rv.json['situacao'] == 'concluido'
+                assert rv.json['status'] == 201
+            rv = self.client.get('/apirecintos/ingestao/' + repetido,
+                                 headers=self.headers)
+            assert rv.json['situacao'] == 'erro'
+            assert rv.json['status'] == 409
+            assert trabalhador.processa_lote() == 0
+            rv = self.client.get('/apirecintos/ingestao/naoexiste',
+                                 headers=self.headers)
+            assert rv.status_code == 404
+            # Item gravado no Banco por trabalhador que caiu antes de concluir:
+            # reprocessado, devolve o hash gravado, não 409
+            evento = deepcopy(self.testes['AcessoVeiculo'])
+            evento['idEvento'] = 'reprocessado'
+            ticket = fila.enfileira('AcessoVeiculo', evento)
+            _, _, reservado, reprocessado = fila.reserva(1)[0]
+            assert not reprocessado
+            gravado = UseCases(self.db_session, tmpdir).insert_eventos_lote(
+                orm.AcessoVeiculo, [reservado])[0]
+            with sqlite3.connect(fila.caminho) as conn:
+                conn.execute('UPDATE fila SET reservado_ate = 0')
+            assert trabalhador.processa_lote() == 1
+            item = fila.consulta(ticket)
+            assert (item['status'], item['detail']) == (201, gravado.hash)
+            # Evento descartado ao concluir; resultado, depois da retenção
+            with sqlite3.connect(fila.caminho) as conn:
+                assert conn.execute(
+                    "SELECT count(*) FROM fila WHERE evento != ''"
+                ).fetchone()[0] == 0
+            assert fila.limpa(3600) == 0
+            assert fila.limpa(3600, time.time() + 3601) == len(tickets) + 2
+            assert fila.consulta(ticket) is None
+            # Evento malformado não derruba o lote: os demais são gravados
+            teste = self.testes['AcessoVeiculo']
+            validos = self.copias_evento(teste, range(2))
+            malformado = dict(teste, codRecinto={'invalido': 1})
+            tickets = [fila.enfileira('AcessoVeiculo', evento)
+                       for evento in (validos[0], malformado, validos[1])]
+            assert trabalhador.processa_lote() == 3
+            assert [fila.consulta(ticket)['status'] for ticket in tickets] == \
+                [201, 400, 201]
+        # Anexos da fila vão para o armazenamento por hash, se configurado
+        with TemporaryDirectory() as tmpdir:
+            self.app.app.config['ANEXOS_POR_HASH'] = True
+            fila = configure_ingestao(self.app, ativa=True,
+                                      caminho=os.path.join(tmpdir, 'fila.db'),
+                                      trabalhadores=1)
+            trabalhador = self.app.app.config['ingestao_trabalhadores'][0]
+            trabalhador.parar.set()
+            trabalhador.join()
+            assert trabalhador.por_hash
+            trabalhador.basepath = tmpdir
+            evento = self.copias_evento(self.testes['InspecaonaoInvasiva'],
+                                        [1])[0]
+            conteudo = os.urandom(100)
+            evento['anexos'][0]['content'] = b64encode(conteudo).decode()
+            ticket = fila.enfileira('InspecaonaoInvasiva', evento)
+            assert trabalhador.processa_lote() == 1
+            assert fila.consulta(ticket)['status'] == 201
+            assert os.path.isfile(orm.caminho_por_hash(
+                tmpdir, hashlib.sha256(conteudo).hexdigest()))
+
+    def test9_filtro_duplicados(self):
+        # Desligado por padrão
+        rv = self.client.get('/apirecintos/duplicados', headers=self.headers)
+        assert rv.status_code == 404
+        app = create_app(self.db_session, self.engine)
+        configure_duplicados(app, True, segundo_plano=False)
+        client = app.app.test_client()
+        for classe, teste in self.testes.items():
+            rv = client.post('/apirecintos/' + classe.lower(),
+                             json=teste,
+                             headers=self.headers)
+            assert rv.status_code == 201
+            rv = client.post('/apirecintos/' + classe.lower(),
+                             json=teste,
+                             headers=self.headers)
+            assert rv.status_code == 409
+            assert rv.json['type'] == 'EventoDuplicado'
+        rv = client.get('/apirecintos/duplicados', headers=self.headers)
+        assert rv.status_code == 200
+        for classe in self.testes.keys():
+            assert rv.json[classe]['hits'] == 1
+            assert rv.json[classe]['misses'] == 1
+        # Filtro aquecido na subida do app com eventos já gravados
+        duplicados = configure_duplicados(app, True, segundo_plano=False)
+        usecase = UseCases(self.db_session, '', duplicados)
+        for classe, teste in self.testes.items():
+            with self.assertRaises(EventoDuplicado):
+                usecase.verifica_duplicado(getattr(orm, classe), teste)
+        # Antes de aquecer, toda chave é confirmada no Banco
+        frio = FiltroDuplicados(100)
+        chaves = [('00001', 'novo'), ('00001', 'outro')]
+        assert frio.existentes(orm.AcessoVeiculo, chaves,
+                               lambda talvez: talvez[:1]) == {chaves[0]}
+
+    def test10_hash(self):
+        for classe, teste in self.testes.items():
+            print(classe)
+            ohash = orm.digest_evento(teste)
+            # Independe da ordem das chaves e do hash enviado pelo cliente
+            invertido = dict(reversed(list(teste.items())))
+            invertido['hash'] = 'outro'
+            assert orm.digest_evento(invertido) == ohash
+            rv = self.client.post('/apirecintos/' + classe.lower(),
+                                  json=teste,
+                                  headers=self.headers)
+            assert rv.status_code == 201
+            assert rv.json['detail'] == ohash
+            rv = self.client.get(
+                '/apirecintos/' + classe.lower() +
+                '/' + str(teste['codRecinto']) +
+                '/' + str(teste['idEvento']),
+                headers=self.headers)
+            assert rv.status_code == 200
+            assert rv.json['hash'] == ohash
+
+    def test11_eventosnovos_feed(self):
+        classe = 'PesagemVeiculoCarga'
+        teste = self.testes[classe]
+        eventos = self.copias_evento(teste, range(5))
+        outro = deepcopy(teste)
+        outro['codRecinto'] = teste['codRecinto'] + '_outro'
+        rv = self.client.post('/apirecintos/pesagemveiculocarga/lote',
+                              json=eventos[:3] + [outro] + eventos[3:],
+                              headers=self.headers)
+        assert rv.status_code == 201
+        filtro = {'tipoevento': classe, 'recinto': teste['codRecinto'],
+                  'limit': 2}
+        recebidos = []
+        paginas = 0
+        while True:
+            rv = self.client.post('/apirecintos/eventosnovos/list',
+                                  json=filtro, headers=self.headers)
+            assert rv.status_code == 200
+            paginas += 1
+            recebidos.extend(rv.json['eventos'])
+            filtro['after'] = rv.json['cursor']
+            if not rv.json['mais']:
+                break
+        assert paginas == 3
+        assert [evento['idEvento'] for evento in recebidos] == \
+            [evento['idEvento'] for evento in eventos]
+        assert len(recebidos[0]['listaSemirreboque']) == \
+            len(teste['listaSemirreboque'])
+        # Feed em dia: página vazia, mesmo cursor
+        rv = self.client.post('/apirecintos/eventosnovos/list',
+                              json=filtro, headers=self.headers)
+        assert rv.json['eventos'] == []
+        assert rv.json['cursor'] == filtro['after']
+        filtro['after'] = 'invalido'
+        rv = self.client.post('/apirecintos/eventosnovos/list',
+                              json=filtro, headers=self.headers)
+        assert rv.status_code == 400
+        # Classes filhas não são servidas como eventos
+        rv = self.client.post('/apirecintos/eventosnovos/list', json={
+            'tipoevento': 'ReboquePesagemVeiculoCarga'}, headers=self.headers)
+        assert rv.status_code == 400
+        rv = self.client.get('/eventosnovos/get', data={
+            'tipoevento': 'ReboquePesagemVeiculoCarga', 'IDEvento': 0},
+            headers=self.headers)
+        assert rv.status_code == 400
+
+    def test12_filter_eventos_streaming(self):
+        for classe, teste in self.testes.items():
+            print(classe)
+            eventos = self.copias_evento(teste, range(3))
+            rv = self.client.post('/apirecintos/' + classe.lower() + '/lote',
+                                  json=eventos, headers=self.headers)
+            assert rv.status_code == 201
+            filtro = {'tipoevento': classe, 'recinto': teste['codRecinto'],
+                      'datainicial': '2019-08-07T00:00:00',
+                      'datafinal': '2019-08-08T00:00:00'}
+            rv = self.client.post('/apirecintos/eventos/filter',
+                                  json=filtro, headers=self.headers)
+            assert rv.status_code == 200
+            assert rv.is_streamed
+            assert [evento['idEvento'] for evento in rv.json] == \
+                [evento['idEvento'] for evento in eventos]
+            rv = self.client.post('/apirecintos/eventos/filter', json=filtro,
+                                  headers={**self.headers,
+                                           'Accept': 'application/x-ndjson'})
+            assert rv.status_code == 200
+            assert rv.mimetype == 'application/x-ndjson'
+            linhas = [json.loads(linha) for linha in
+                      rv.get_data(as_text=True).splitlines()]
+            assert linhas == self.client.post(
+                '/apirecintos/eventos/filter', json=filtro,
+                headers=self.headers).json
+            filtro['datainicial'] = '2019-08-08T00:00:00'
+            filtro['datafinal'] = '2019-08-09T00:00:00'
+            rv = self.client.post('/apirecintos/eventos/filter',
+                                  json=filtro, headers=self.headers)
+            assert rv.json == []
+        # Só tipos de evento: outros nomes do módulo orm são recusados
+        for tipoevento in ('init_db', 'ReboqueGate'):
+            filtro['tipoevento'] = tipoevento
+            filtro['fields'] = ['idEvento']
+            rv = self.client.post('/apirecintos/eventos/filter',
+                                  json=filtro, headers=self.headers)
+            assert rv.status_code == 400
+
+    def test12_filter_erro_interrompe_stream(self):
+        def lotes():
+            yield [{'idEvento': '1'}]
+            raise OSError('Conexão perdida')
+
+        stream = _gera_json(lotes())
+        assert next(stream) == b'['
+        assert next(stream) == b'{"idEvento":"1"}'
+        # Sem fechar o array: cliente não recebe JSON válido truncado
+        with self.assertRaises(OSError):
+            next(stream)
+
+    def test13_timeline_eventos(self):
+        esperados = []
+        for ind, (classe, teste) in enumerate(sorted(self.testes.items())):
+            horas = (12 - ind, 14 + ind)
+            eventos = self.copias_evento(teste, horas, codRecinto='00001')
+            for hora, evento in zip(horas, eventos):
+                evento['dtHrOcorrencia'] = '2019-08-07T%02d:00:00' % hora
+                esperados.append((hora, classe, evento['idEvento']))
+            rv = self.client.post('/apirecintos/' + classe.lower() + '/lote',
+                                  json=eventos, headers=self.headers)
+            assert rv.status_code == 201
+        esperados.sort()
+        filtro = {'recinto': '00001', 'limit': 4,
+                  'datainicial': '2019-08-07T00:00:00',
+                  'datafinal': '2019-08-08T00:00:00'}
+        recebidos = []
+        limites = []
+
+        def conta_linhas(conn, cursor, statement, parameters, *args):
+            if 'LIMIT' in statement:
+                limites.append(parameters[-2])
+
+        event.listen(self.engine, 'before_cursor_execute', conta_linhas)
+        while True:
+            rv = self.client.post('/apirecintos/eventos/timeline',
+                                  json=filtro, headers=self.headers)
+            assert rv.status_code == 200
+            recebidos.extend(rv.json['eventos'])
+            filtro['after'] = rv.json['cursor']
+            if not rv.json['mais']:
+                break
+        event.remove(self.engine, 'before_cursor_execute', conta_linhas)
+        # Cada tabela lê no máximo limit + 1 eventos por página
+        assert limites and max(limites) == 5
+        assert [(evento['tipoevento'], evento['idEvento'])
+                for evento in recebidos] == \
+            [(classe, idEvento) for _, classe, idEvento in esperados]
+        filtro.pop('after')
+        filtro['tiposevento'] = ['AcessoVeiculo']
+        rv = self.client.post('/apirecintos/eventos/timeline',
+                              json=filtro, headers=self.headers)
+        assert [evento['tipoevento'] for evento in rv.json['eventos']] == \
+            ['AcessoVeiculo'] * 2
+        filtro['tiposevento'] = ['init_db']
+        rv = self.client.post('/apirecintos/eventos/timeline',
+                              json=filtro, headers=self.headers)
+        assert rv.status_code == 400
+
+    def test14_fields(self):
+        classe = 'AcessoVeiculo'
+        teste = self.testes[classe]
+        rv = self.client.post('/apirecintos/acessoveiculo', json=teste,
+                              headers=self.headers)
+        assert rv.status_code == 201
+        url = '/apirecintos/acessoveiculo/%s/%s' % (teste['codRecinto'],
+                                                    teste['idEvento'])
+        rv = self.client.get(url + '?fields=placa,listaConteineresUld.num,'
+                             'listaConteineresUld.listaLacres.num,listaNfe',
+                             headers=self.headers)
+        assert rv.status_code == 200
+        assert rv.json == {
+            'placa': teste['placa'],
+            'listaConteineresUld': [
+                {'num': conteiner['num'],
+                 'listaLacres': [{'num': lacre['num']}
+                                 for lacre in conteiner['listaLacres']]}
+                for conteiner in teste['listaConteineresUld']],
+            'listaNfe': teste['listaNfe']}
+        rv = self.client.get(url + '?fields=placa,listaNfe.chavenfe',
+                             headers=self.headers)
+        assert rv.status_code == 400
+        filtro = {'tipoevento': classe, 'recinto': teste['codRecinto'],
+                  'fields': ['idEvento', 'listaSemirreboque.placa']}
+        rv = self.client.post('/apirecintos/eventosnovos/list',
+                              json=filtro, headers=self.headers)
+        assert rv.json['eventos'][0]['idEvento'] == teste['idEvento']
+        assert set(rv.json['eventos'][0].keys()) == \
+            {'ID', 'idEvento', 'listaSemirreboque'}
+        filtro.pop('recinto')
+        filtro.update({'datainicial': '2019-08-07T00:00:00',
+                       'datafinal': '2019-08-08T00:00:00',
+                       'fields': ['idEvento', 'inexistente']})
+        rv = self.client.post('/apirecintos/eventos/filter',
+                              json=filtro, headers=self.headers)
+        assert rv.status_code == 400
+
+    def test15_compressao(self):
+        classe = 'AcessoVeiculo'
+        teste = self.testes[classe]
+        eventos = self.copias_evento(teste, range(10))
+        rv = self.client.post('/apirecintos/acessoveiculo/lote',
+                              json=eventos, headers=self.headers)
+        assert rv.status_code == 201
+        filtro = {'tipoevento': classe, 'recinto': teste['codRecinto'],
+                  'datainicial': '2019-08-07T00:00:00',
+                  'datafinal': '2019-08-08T00:00:00'}
+        rv = self.client.post('/apirecintos/eventos/filter',
+                              json=filtro, headers=self.headers)
+        assert 'Content-Encoding' not in rv.headers
+        esperado = rv.json
+        assert len(esperado) == 10
+        headers = {**self.headers, 'Accept-Encoding': 'gzip'}
+        rv = self.client.post('/apirecintos/eventos/filter',
+                              json=filtro, headers=headers)
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in rv.headers['Vary']
+        assert json.loads(gzip.decompress(rv.get_data())) == esperado
+        filtro = {'tipoevento': classe, 'recinto': teste['codRecinto'],
+                  'limit': 10}
+        rv = self.client.post('/apirecintos/eventosnovos/list',
+                              json=filtro, headers=headers)
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        assert len(gzip.decompress(rv.get_data())) > len(rv.get_data())
+        # Resposta pequena não compensa comprimir
+        filtro['limit'] = 1
+        filtro['fields'] = ['idEvento']
+        rv = self.client.post('/apirecintos/eventosnovos/list',
+                              json=filtro, headers=headers)
+        assert 'Content-Encoding' not in rv.headers
+        assert rv.json['eventos'][0]['idEvento'] == eventos[0]['idEvento']
+        # Streaming: cada pedaço comprimido já descomprime, sem esperar o fim
+        descompressor = zlib.decompressobj(31)
+        pedacos = comprime_stream(iter([b'[', b'{"a": 1}', b']']), 'gzip')
+        assert descompressor.decompress(next(pedacos)) == b'['
+        assert descompressor.decompress(next(pedacos)) == b'{"a": 1}'
+
+    def test16_anexos_streaming(self):
+        classe = 'InspecaonaoInvasiva'
+        teste = self.testes[classe]
+        conteudo = bytes(range(256)) * 64
+        teste['anexos'][0]['nomeArquivo'] = 'imagem 1.png'
+        teste['anexos'][0]['content'] = b64encode(conteudo).decode()
+        with TemporaryDirectory() as tmpdir:
+            self.app.app.config['UPLOAD_FOLDER'] = tmpdir
+            rv = self.client.post('/apirecintos/inspecaonaoinvasiva',
+                                  json=teste, headers=self.headers)
+            assert rv.status_code == 201
+            url = '/apirecintos/inspecaonaoinvasiva/%s/%s' % (
+                teste['codRecinto'], teste['idEvento'])
+            rv = self.client.get(url, headers=self.headers)
+            assert rv.status_code == 200
+            anexo = rv.json['anexos'][0]
+            assert 'content' not in anexo
+            digest = hashlib.sha256(conteudo).hexdigest()
+            assert anexo['tamanhoArquivo'] == len(conteudo)
+            assert anexo['hashArquivo'] == digest
+            assert anexo['url'] == '/inspecaonaoinvasiva/%s/%s/anexos/%s' % (
+                teste['codRecinto'], teste['idEvento'], 'imagem%201.png')
+            rv = self.client.get('/apirecintos' + anexo['url'],
+                                 headers=self.headers)
+            assert rv.status_code == 200
+            assert rv.mimetype == 'image/png'
+            assert rv.get_data() == conteudo
+            assert rv.headers['ETag'] == '"%s"' % digest
+            assert rv.headers['Accept-Ranges'] == 'bytes'
+            rv = self.client.get('/apirecintos' + anexo['url'], headers={
+                **self.headers, 'Range': 'bytes=100-199',
+                'Accept-Encoding': 'gzip'})
+            assert rv.status_code == 206
+            assert rv.get_data() == conteudo[100:200]
+            rv = self.client.get('/apirecintos' + anexo['url'], headers={
+                **self.headers, 'If-None-Match': '"%s"' % digest})
+            assert rv.status_code == 304
+            self.app.app.config['X_ACCEL_REDIRECT'] = '/protegido/'
+            rv = self.client.get('/apirecintos' + anexo['url'],
+                                 headers=self.headers)
+            assert rv.get_data() == b''
+            assert rv.headers['X-Accel-Redirect'].startswith('/protegido/')
+            assert rv.headers['X-Accel-Redirect'].endswith('/imagem%201.png')
+            self.app.app.config['X_ACCEL_REDIRECT'] = None
+            rv = self.client.get('/apirecintos' + anexo['url'] + 'x',
+                                 headers=self.headers)
+            assert rv.status_code == 404
+            rv = self.client.get(url + '?fields=anexos.nomeArquivo,'
+                                 'anexos.content', headers=self.headers)
+            assert rv.json['anexos'] == [{'nomeArquivo': 'imagem 1.png',
+                                          'content': teste['anexos'][0][
+                                              'content']}]
+
+    def test17_upload_anexo(self):
+        classe = 'InspecaonaoInvasiva'
+        teste = self.testes[classe]
+        teste['anexos'] = []
+        conteudo = os.urandom(200 * 1024 + 7)
+        with TemporaryDirectory() as tmpdir:
+            self.app.app.config['UPLOAD_FOLDER'] = tmpdir
+            rv = self.client.post('/apirecintos/inspecaonaoinvasiva',
+                                  json=teste, headers=self.headers)
+            assert rv.status_code == 201
+            rv = self.client.post('/upload_file', data={
+                'file': (BytesIO(conteudo), 'scanner.jpg'),
+                'IDEvento': teste['idEvento'],
+                'codRecinto': teste['codRecinto'],
+                'tipoevento': classe,
+                'tipoanexo': 'AnexoInspecao'}, headers=self.headers)
+            assert rv.status_code == 201
+            url = '/apirecintos/inspecaonaoinvasiva/%s/%s' % (
+                teste['codRecinto'], teste['idEvento'])
+            anexo = self.client.get(url, headers=self.headers).json['anexos'][0]
+            assert anexo['tamanhoArquivo'] == len(conteudo)
+            assert anexo['hashArquivo'] == hashlib.sha256(conteudo).hexdigest()
+            rv = self.client.get('/apirecintos' + anexo['url'],
+                                 headers=self.headers)
+            assert rv.get_data() == conteudo
+            # Nenhum temporário de gravação sobra no diretório do evento
+            for _, _, arquivos in os.walk(tmpdir):
+                assert not [nome for nome in arquivos
+                            if nome.endswith('.parcial')]
+
+    def test18_cache_tokens(self):
+        os.environ['AUTHENTICATE'] = 'YES'
+        try:
+            app = create_app(self.db_session, self.engine)
+        finally:
+            os.environ.pop('AUTHENTICATE')
+        client = app.app.test_client()
+        rv = client.post('/apirecintos/auth', json={'recinto': '00002',
+                                                   'senha': 'senha'})
+        assert rv.status_code == 200
+        headers = {'Authorization': 'Bearer %s' % rv.data.decode().strip()}
+        rv = client.get('/apirecintos/auth/cache')
+        assert rv.status_code == 401
+        for _ in range(3):
+            rv = client.get('/apirecintos/auth/cache', headers=headers)
+            assert rv.status_code == 200
+        assert rv.json['misses'] == 1
+        assert rv.json['hits'] == 2
+        assert rv.json['tamanho'] == 1
+        with app.app.test_request_context('/apirecintos/auth/cache',
+                                          headers=headers):
+            app.app.preprocess_request()
+            assert get_recinto() == '00002'
+        cache = authentication.CacheTokens(capacidade=2)
+        for token, exp in (('a', 100), ('b', 200), ('c', 300)):
+            cache.adiciona(token, {'exp': exp})
+        # LRU: 'a' saiu; cada token vale até o próprio exp
+        assert cache.claims('a', agora=0) is None
+        assert cache.claims('b', agora=199.9) == {'exp': 200}
+        assert cache.claims('b', agora=200) is None
+        assert cache.claims('c', agora=0) == {'exp': 300}
+
+    def test19_limite_recinto(self):
+        teste = self.testes['AcessoVeiculo']
+        with TemporaryDirectory() as tmpdir:
+            caminho = os.path.join(tmpdir, 'limites.db')
+            app = create_app(self.db_session, self.engine)
+            configure_limites(app, True, taxa=0.01, rajada=3, caminho=caminho)
+            client = app.app.test_client()
+            eventos = self.copias_evento(teste, range(3), codRecinto='00009')
+            rv = client.post('/apirecintos/acessoveiculo', json=eventos[0],
+                             headers=self.headers)
+            assert rv.status_code == 201
+            # Lote de 2 eventos consome 2 fichas: balde vazio
+            rv = client.post('/apirecintos/acessoveiculo/lote',
+                             json=eventos[1:], headers=self.headers)
+            assert rv.status_code == 201
+            rv = client.post('/apirecintos/acessoveiculo', json=eventos[0],
+                             headers=self.headers)
+            assert rv.status_code == 429
+            assert int(rv.headers['Retry-After']) == 100
+            # Consultas e outros recintos não são afetados
+            rv = client.post('/apirecintos/eventosnovos/list', json={
+                'tipoevento': 'AcessoVeiculo', 'recinto': '00009'},
+                headers=self.headers)
+            assert rv.status_code == 200
+            evento = self.copias_evento(teste, [3], codRecinto='00008')[0]
+            rv = client.post('/apirecintos/acessoveiculo', json=evento,
+                             headers=self.headers)
+            assert rv.status_code == 201
+            # Outro processo (worker) vê o mesmo balde
+            outro = BaldesRecinto(caminho, taxa=0.01, rajada=3)
+            assert outro.consome('00009') > 0
+            assert outro.consome('00009', agora=time.time() + 100) == 0
+            # Pedido maior que a rajada paga por inteiro: saldo fica negativo
+            agora = time.time()
+            assert outro.consome('00010', 10, agora) == 0
+            assert round(outro.consome('00010', 1, agora)) == (1 + 7) / 0.01
+            # Arquivo de eventos paga pelo tamanho descompactado; sem
+            # recinto, o balde é o do endereço do cliente
+            zipado = BytesIO()
+            with ZipFile(zipado, 'w') as arquivozip:
+                arquivozip.writestr('AcessoVeiculo.ndjson', b' ' * 10000)
+            for conteudo, nome, fichas in ((b' ' * 5000, 'eventos.ndjson', 3),
+                                           (zipado.getvalue(), 'eventos.zip', 5)):
+                with app.app.test_request_context(
+                        '/eventosnovos/upload', method='POST',
+                        data={'file': (BytesIO(conteudo), nome)},
+                        environ_base={'REMOTE_ADDR': '127.0.0.1'}):
+                    assert fichas_da_requisicao(2048) == fichas
+                    assert recinto_da_requisicao() == 'ip:127.0.0.1'
+            # Anexo não é arquivo de eventos: uma ficha, qualquer o tamanho
+            with app.app.test_request_context(
+                    '/upload_file', method='POST',
+                    data={'file': (BytesIO(b' ' * 5000), 'scanner.jpg')}):
+                assert fichas_da_requisicao(2048) == 1
+            rv = client.post('/eventosnovos/upload', data={
+                'file': (BytesIO(b'\n' * 3 * 2048), 'eventos.ndjson')})
+            assert rv.status_code == 201
+            rv = client.post('/eventosnovos/upload', data={
+                'file': (BytesIO(b'\n'), 'eventos.ndjson')})
+            assert rv.status_code == 429
+
+    def test20_pool(self):
+        rv = self.client.get('/apirecintos/pool', headers=self.headers)
+        assert rv.status_code == 200
+        assert rv.json['checkouts'] > 0
+        assert set(rv.json['espera_ms']) >= {'<=1ms', '>5000ms'}
+
+    def test21_app_producao(self):
+        # Engine e sessão próprias, mesmo com as do processo já criadas
+        app = create_app_producao('sqlite:///:memory:')
+        engine = app.app.config['engine']
+        db_session = app.app.config['db_session']
+        assert engine is not self.engine
+        assert db_session is not self.db_session
+        orm.Base.metadata.create_all(bind=engine)
+        client = app.app.test_client()
+        db_session.query(orm.AcessoVeiculo).first()
+        assert db_session.registry.has()
+        rv = client.get('/apirecintos/acessoveiculo/00001/inexistente')
+        assert rv.status_code == 404
+        # Sessão da thread liberada ao fim da requisição
+        assert not db_session.registry.has()
+        engine.dispose()
+
+    def test22_sessao_requisicao(self):
+        # Alteração pendente de requisição com erro é desfeita, não gravada
+        self.db_session.add(orm.AcessoVeiculo(
+            idEvento='pendente', codRecinto='00001',
+            dtHrOcorrencia=datetime.datetime.now(),
+            dtHrRegistro=datetime.datetime.now()))
+        rv = self.client.get('/apirecintos/acessoveiculo/00001/inexistente',
+                             headers=self.headers)
+        assert rv.status_code == 404
+        assert not self.db_session.registry.has()
+        assert self.db_session.query(orm.AcessoVeiculo).filter(
+            orm.AcessoVeiculo.idEvento == 'pendente').count() == 0
+        self.db_session.remove()
+        # POST com sucesso é gravado; GET com sucesso não grava alteração
+        teste = self.testes['AcessoVeiculo']
+        rv = self.client.post('/apirecintos/acessoveiculo', json=teste,
+                              headers=self.headers)
+        assert rv.status_code == 201
+        self.db_session.add(orm.AcessoVeiculo(
+            idEvento='pendente', codRecinto='00001',
+            dtHrOcorrencia=datetime.datetime.now(),
+            dtHrRegistro=datetime.datetime.now()))
+        rv = self.client.get('/apirecintos/acessoveiculo/%s/%s' %
+                             (teste['codRecinto'], teste['idEvento']),
+                             headers=self.headers)
+        assert rv.status_code == 200
+        assert self.db_session.query(orm.AcessoVeiculo).filter(
+            orm.AcessoVeiculo.idEvento == 'pendente').count() == 0
+        assert self.db_session.query(orm.AcessoVeiculo).filter(
+            orm.AcessoVeiculo.idEvento == teste['idEvento']).count() == 1
+        self.db_session.remove()
+        # Commit que falha vira resposta de erro, não recibo de evento
+        def falha(session):
+            raise OSError('conexão perdida')
+
+        outro = self.copias_evento(teste, [1])[0]
+        event.listen(self.db_session, 'before_commit', falha)
+        try:
+            rv = self.client.post('/apirecintos/acessoveiculo', json=outro,
+                                  headers=self.headers)
+        finally:
+            event.remove(self.db_session, 'before_commit', falha)
+        assert rv.status_code == 500
+        assert 'conexão perdida' in rv.json['detail']
+        assert self.db_session.query(orm.AcessoVeiculo).filter(
+            orm.AcessoVeiculo.idEvento == outro['idEvento']).count() == 0
+        self.db_session.remove()
+        # Aviso para conexão retida além do limite
+        alerta = self.engine.alerta_sessao
+        self.engine.alerta_sessao = 1e-9
+        try:
+            with self.assertLogs(level='WARNING') as logs:
+                self.client.get('/apirecintos/acessoveiculo/00001/inexistente',
+                                headers=self.headers)
+        finally:
+            self.engine.alerta_sessao = alerta
+        assert any('segurou conexão' in linha for linha in logs.output)
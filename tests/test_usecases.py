@@ -1,8 +1,45 @@
+import os
+import re
+from base64 import b64encode, encodebytes
+from datetime import datetime
+from tempfile import TemporaryDirectory
+
+from dateutil.parser import parse
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.exc import IntegrityError
+
 from apiserver.models import orm
-from apiserver.use_cases.usecases import UseCases
+from apiserver.models.pool import QueuePoolMedido, TelemetriaPool, opcoes_pool, \
+    protege_fork
+from apiserver.use_cases.usecases import FILHOS, UseCases, arvore_campos
 from tests.basetest import BaseTestCase
 
 
+class ContaSQL:
+    """Conta comandos SQL emitidos pelo engine dentro do bloco with."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.comandos = []
+        self.instrucoes = []
+
+    def _before_cursor_execute(self, conn, cursor, statement, *args):
+        self.comandos.append(statement.split()[0].upper())
+        self.instrucoes.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute',
+                     self._before_cursor_execute)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(self.engine, 'before_cursor_execute',
+                     self._before_cursor_execute)
+
+    def count(self, comando):
+        return self.comandos.count(comando)
+
+
 class UseCaseTestCase(BaseTestCase):
 
     def setUp(self):
@@ -60,3 +97,312 @@ class UseCaseTestCase(BaseTestCase):
         self.purge_datas(evento)
         self.purge_datas(evento_banco_load)
         self.assertDictContainsSubset(evento, evento_banco_load)
+
+    def test_insert_grafo_um_flush(self):
+        # Um INSERT por linha e só o refresh final: nenhum flush intermediário
+        evento = self.open_json_test_case(orm.AcessoVeiculo)
+        linhas = 1 + len(evento['listaManifestos']) + \
+            len(evento['listaDiDue']) + len(evento['listaChassi']) + \
+            len(evento['listaNfe'])
+        for item in evento['listaSemirreboque'] + evento['listaConteineresUld']:
+            linhas += 1 + len(item['listaLacres'])
+        with ContaSQL(self.engine) as sql:
+            self.usecase.insert_acessoveiculo(evento)
+        assert sql.count('INSERT') == linhas
+        assert sql.comandos == ['INSERT'] * linhas + ['SELECT']
+        evento = self.open_json_test_case(orm.InspecaonaoInvasiva)
+        linhas = 1 + len(evento['listaManifestos']) + \
+            len(evento['listaCarga']) + len(evento['listaSemirreboque']) + \
+            len(evento['listaConteineresUld'])
+        for anexo in evento['anexos']:
+            linhas += 1 + len(anexo['coordenadasAlerta'])
+        with ContaSQL(self.engine) as sql:
+            self.usecase.insert_inspecaonaoinvasiva(evento)
+        assert sql.comandos == ['INSERT'] * linhas + ['SELECT']
+
+    def test_dump_estavel(self):
+        evento = self.open_json_test_case(orm.PesagemVeiculoCarga)
+        evento_banco = self.usecase.insert_pesagemveiculocarga(evento)
+        colunas = set([coluna.key for coluna in
+                       inspect(orm.PesagemVeiculoCarga).column_attrs])
+        dump = evento_banco.dump()
+        assert set(dump.keys()) == colunas
+        assert dump['dtHrOcorrencia'] == \
+            evento_banco.dtHrOcorrencia.isoformat()
+        # Relacionamentos carregados não mudam o dump
+        assert len(evento_banco.listaSemirreboque) > 0
+        assert evento_banco.dump() == dump
+        reboque = evento_banco.listaSemirreboque[0].dump(
+            exclude=['ID', 'pesagem', 'pesagem_id'])
+        assert set(reboque.keys()) == {'placa', 'tara'}
+
+    def test_load_consultas_fixas(self):
+        # Um SELECT do evento e um por lista de filhos ou netos, sem JOINs
+        consultas = {orm.PesagemVeiculoCarga: 4,
+                     orm.AcessoVeiculo: 9,
+                     orm.InspecaonaoInvasiva: 7}
+        for aclass, total in consultas.items():
+            evento = self.open_json_test_case(aclass)
+            self.usecase.insert_evento_com_filhos(aclass, evento)
+            self.db_session.commit()
+            self.db_session.remove()
+            with ContaSQL(self.engine) as sql:
+                dump = self.usecase.load_evento_com_filhos(
+                    aclass, evento['codRecinto'], evento['idEvento'])
+            assert sql.comandos == ['SELECT'] * total
+            assert dump['idEvento'] == evento['idEvento']
+            for filho in FILHOS[aclass]:
+                assert len(dump[filho.campo]) == len(evento[filho.campo])
+
+    def test_load_eventosnovos_lote(self):
+        # Consultas não crescem com a quantidade de eventos
+        aclass = orm.InspecaonaoInvasiva
+        evento = self.open_json_test_case(aclass)
+        eventos = self.copias_evento(evento, range(20))
+        self.usecase.insert_eventos_lote(aclass, eventos)
+        self.db_session.remove()
+        with ContaSQL(self.engine) as sql:
+            dumps = self.usecase.load_eventosnovos(aclass, 0, None)
+        assert sql.comandos == ['SELECT'] * 7
+        assert [dump['idEvento'] for dump in dumps] == \
+            [novo['idEvento'] for novo in eventos]
+        for dump in dumps:
+            assert dump == self.usecase.load_evento_com_filhos(
+                aclass, dump['codRecinto'], dump['idEvento'])
+        assert self.usecase.load_eventosnovos(aclass, dumps[-1]['ID'],
+                                              None) == []
+        # Filhos pelos IDs lidos: MySQL não aceita LIMIT em IN (SELECT ...)
+        with ContaSQL(self.engine) as sql:
+            dumps = self.usecase.load_eventosnovos(aclass, 0, None, limite=5)
+        assert len(dumps) == 5
+        assert not any('IN (SELECT' in instrucao for instrucao in sql.instrucoes)
+
+    def test_lote_chaves_cruzadas(self):
+        # (R1, E2) gravado não pode casar com (R1, E1) e (R2, E2) do lote
+        aclass = orm.AcessoVeiculo
+        evento = self.open_json_test_case(aclass)
+        gravado = dict(evento, codRecinto='R1', idEvento='E2')
+        self.usecase.insert_eventos_lote(aclass, [gravado])
+        lote = [dict(evento, codRecinto='R1', idEvento='E1'),
+                dict(evento, codRecinto='R2', idEvento='E2')]
+        assert list(self.usecase.valores_por_chave(
+            aclass, [('R1', 'E1'), ('R2', 'E2')])) == []
+        resultados = self.usecase.insert_eventos_lote(aclass, lote)
+        assert all([isinstance(resultado, aclass)
+                    for resultado in resultados])
+        assert set(self.usecase.valores_por_chave(
+            aclass, [('R1', 'E1'), ('R2', 'E2'), ('R1', 'E2')])) == \
+            {('R1', 'E1'), ('R2', 'E2'), ('R1', 'E2')}
+
+    def test_lote_erro_isolado(self):
+        # Filho inválido só afeta o seu evento, não o lote
+        aclass = orm.InspecaonaoInvasiva
+        evento = self.open_json_test_case(aclass)
+        valido, invalido = self.copias_evento(evento, range(2))
+        invalido['anexos'][0].pop('content', None)
+        invalido['anexos'][0]['hashArquivo'] = '0' * 64
+        with TemporaryDirectory() as tmpdir:
+            usecase = UseCases(self.db_session, tmpdir)
+            resultados = usecase.insert_eventos_lote(aclass, [valido, invalido])
+            assert isinstance(resultados[0], aclass)
+            assert isinstance(resultados[1], ValueError)
+            # Erro no Banco: eventos regravados um a um, cada um com o seu
+            usecase.chaves_existentes = lambda aclass, chaves: set()
+            novo = self.copias_evento(evento, [2])[0]
+            resultados = usecase.insert_eventos_lote(aclass, [valido, novo])
+            assert isinstance(resultados[0], IntegrityError)
+            assert isinstance(resultados[1], aclass)
+        assert set(self.usecase.valores_por_chave(
+            aclass, [(evento['codRecinto'], '%s_%d' % (evento['idEvento'], ind))
+                     for ind in range(3)])) == \
+            {(evento['codRecinto'], valido['idEvento']),
+             (evento['codRecinto'], novo['idEvento'])}
+
+    def test_gera_eventos_filtro_lotes(self):
+        aclass = orm.AcessoVeiculo
+        evento = self.open_json_test_case(aclass)
+        eventos = self.copias_evento(evento, range(5))
+        self.usecase.insert_eventos_lote(aclass, eventos)
+        inicio, fim = datetime(2000, 1, 1), datetime(2100, 1, 1)
+        lotes = list(self.usecase.gera_eventos_filtro(
+            aclass, inicio, fim, tamanho_lote=2))
+        assert [len(lote) for lote in lotes] == [2, 2, 1]
+        assert [dump['idEvento'] for lote in lotes for dump in lote] == \
+            [novo['idEvento'] for novo in eventos]
+        linha_tempo = list(self.usecase.gera_linha_tempo(
+            [aclass], evento['codRecinto'], inicio, fim,
+            tamanho_lote=2))
+        assert [item[3]['idEvento'] for item in linha_tempo] == \
+            [novo['idEvento'] for novo in eventos]
+
+    def test_pagina_eventos_usa_indice(self):
+        aclass = orm.AcessoVeiculo
+        query = self.db_session.query(aclass).filter(
+            aclass.codRecinto == '1', aclass.ID > 1000
+        ).order_by(aclass.ID).limit(100)
+        sql = str(query.statement.compile(
+            self.engine, compile_kwargs={'literal_binds': True}))
+        plano = ' '.join([str(linha) for linha in
+                          self.engine.execute('EXPLAIN QUERY PLAN ' + sql)])
+        # ID é o rowid: o índice de codRecinto já o contém, em ordem
+        assert re.search(r'INDEX ix_acessosveiculo_codRecinto '
+                         r'\(codRecinto=\? AND rowid>\?\)', plano)
+        assert 'TEMP B-TREE' not in plano
+
+    def test_campos_no_select(self):
+        aclass = orm.AcessoVeiculo
+        evento = self.open_json_test_case(aclass)
+        self.usecase.insert_evento_com_filhos(aclass, evento)
+        self.db_session.commit()
+        self.db_session.remove()
+        campos = arvore_campos(aclass, 'placa,listaChassi')
+        with ContaSQL(self.engine) as sql:
+            dump = self.usecase.load_evento_com_filhos(
+                aclass, evento['codRecinto'], evento['idEvento'], campos)
+        # Apenas o evento e a lista pedida: demais listas não são lidas
+        assert sql.comandos == ['SELECT'] * 2
+        assert dump == {'placa': evento['placa'],
+                        'listaChassi': evento['listaChassi']}
+        with self.assertRaises(ValueError):
+            arvore_campos(aclass, 'listaLacres.num')
+
+    def test_cache_serializador_limitado(self):
+        assert orm.serializador.cache_info().maxsize == 256
+        anexo = orm.AnexoInspecao(nomeArquivo='a.jpg')
+        anexo.dump(campos={'nomeArquivo': None})
+        antes = orm.serializador.cache_info().currsize
+        # Nomes que não são campos da classe não criam novas entradas
+        assert anexo.dump(campos={'nomeArquivo': None,
+                                  'coordenadasAlerta': None}) == \
+            {'nomeArquivo': 'a.jpg'}
+        assert orm.serializador.cache_info().currsize == antes
+
+    def test_parse_datahora(self):
+        for valor in ['2019-08-07T13:36:51.809Z', '2019-08-07T13:36:51',
+                      '2019-08-07 13:36', '2019-08-07T13:36:51.809-03:00',
+                      '07/08/2019 13:36']:
+            self.assertEqual(orm.parse_datahora(valor), parse(valor))
+
+    def test_decodifica_base64(self):
+        conteudo = bytes(range(256)) * 10
+        # encodebytes quebra linhas a cada 76 caracteres
+        texto = encodebytes(conteudo).decode()
+        for tamanho in (1, 5, 64, len(texto)):
+            pedacos = [texto[inicio:inicio + tamanho]
+                       for inicio in range(0, len(texto), tamanho)]
+            self.assertEqual(b''.join(orm.decodifica_base64(pedacos)),
+                             conteudo)
+        self.assertEqual(b''.join(orm.pedacos_arquivo(texto, 7)), conteudo)
+
+    def test_anexos_por_hash(self):
+        conteudo = os.urandom(1000)
+        evento = self.open_json_test_case(orm.InspecaonaoInvasiva)
+        with TemporaryDirectory() as tmpdir:
+            usecase = UseCases(self.db_session, tmpdir, por_hash=True)
+            hashes = set()
+            for codRecinto in ('00001', '00002'):
+                evento['codRecinto'] = codRecinto
+                evento['anexos'][0]['content'] = \
+                    b64encode(conteudo).decode()
+                usecase.insert_inspecaonaoinvasiva(evento)
+                anexo = usecase.load_inspecaonaoinvasiva(
+                    codRecinto, evento['idEvento'])['anexos'][0]
+                hashes.add(anexo['hashArquivo'])
+            # Mesmo conteúdo de dois recintos: um só arquivo gravado
+            arquivos = [nome for _, _, nomes in os.walk(tmpdir)
+                        for nome in nomes]
+            assert arquivos == list(hashes)
+            # Reenvio só com o hash: nada é transmitido nem gravado
+            evento['codRecinto'] = '00003'
+            evento['anexos'][0].pop('content')
+            evento['anexos'][0]['hashArquivo'] = anexo['hashArquivo']
+            usecase.insert_inspecaonaoinvasiva(evento)
+            anexo = usecase.load_inspecaonaoinvasiva(
+                '00003', evento['idEvento'], arvore_campos(
+                    orm.InspecaonaoInvasiva, 'anexos.content'))['anexos'][0]
+            assert anexo['content'] == b64encode(conteudo).decode()
+            # Com a opção desligada, o armazenamento por hash ainda é lido
+            # quando o arquivo não está no diretório do evento
+            sem_hash = UseCases(self.db_session, tmpdir)
+            anexo = sem_hash.load_inspecaonaoinvasiva(
+                '00003', evento['idEvento'], arvore_campos(
+                    orm.InspecaonaoInvasiva, 'anexos.content'))['anexos'][0]
+            assert anexo['content'] == b64encode(conteudo).decode()
+            evento['codRecinto'] = '00004'
+            evento['anexos'][0]['hashArquivo'] = '0' * 64
+            with self.assertRaises(ValueError):
+                usecase.insert_inspecaonaoinvasiva(evento)
+            self.db_session.rollback()
+
+    def test_leitura_anexo_nao_cria_diretorio(self):
+        evento = self.open_json_test_case(orm.InspecaonaoInvasiva)
+        with TemporaryDirectory() as tmpdir:
+            usecase = UseCases(self.db_session, tmpdir)
+            usecase.insert_inspecaonaoinvasiva(evento)
+            anexo = usecase.load_inspecaonaoinvasiva(
+                evento['codRecinto'], evento['idEvento'], arvore_campos(
+                    orm.InspecaonaoInvasiva, 'anexos.content'))['anexos'][0]
+            assert anexo['content'] is None
+            assert os.listdir(tmpdir) == []
+
+    def test_caminhos_anexo(self):
+        inspecao = orm.InspecaonaoInvasiva(codRecinto='00001',
+                                           dtHrOcorrencia='2020-01-02T10:00')
+        anexo = orm.AnexoInspecao(nomeArquivo='a.jpg', hashArquivo='ab' * 32,
+                                  inspecao=inspecao)
+        no_evento = os.path.join('base', '00001', '2020', '1', '2', 'a.jpg')
+        por_hash = orm.caminho_por_hash('base', 'ab' * 32)
+        # Sem a opção, o armazenamento por hash é só a segunda opção
+        assert anexo.caminhos_arquivo('base') == [no_evento, por_hash]
+        assert anexo.caminhos_arquivo('base', True) == [por_hash, no_evento]
+        anexo.hashArquivo = None
+        assert anexo.caminhos_arquivo('base', True) == [no_evento]
+
+    def test_pool_configuravel(self):
+        opcoes = opcoes_pool('mysql+mysqlconnector://u@localhost/db',
+                             {'DB_POOL_SIZE': '2', 'DB_MAX_OVERFLOW': '1',
+                              'DB_POOL_RECYCLE': '600'})
+        assert opcoes['poolclass'] is QueuePoolMedido
+        assert (opcoes['pool_size'], opcoes['max_overflow'],
+                opcoes['pool_recycle'], opcoes['pool_pre_ping']) == \
+            (2, 1, 600, True)
+        assert opcoes_pool('sqlite://', {}) == {'pool_pre_ping': True}
+        with TemporaryDirectory() as tmpdir:
+            opcoes.pop('pool_recycle')
+            engine = create_engine(
+                'sqlite:///' + os.path.join(tmpdir, 'pool.db'),
+                connect_args={'check_same_thread': False}, **opcoes)
+            telemetria = TelemetriaPool()
+            telemetria.registra(engine)
+            conexoes = [engine.connect() for _ in range(3)]
+            estatisticas = telemetria.estatisticas(engine.pool)
+            assert estatisticas['em_uso'] == 3
+            assert estatisticas['overflow'] == 1
+            assert estatisticas['conexoes'] == 3
+            assert sum(estatisticas['espera_ms'].values()) == 3
+            for conexao in conexoes:
+                conexao.close()
+            engine.dispose()
+            assert engine.pool.telemetria is telemetria
+            estatisticas = telemetria.estatisticas(engine.pool)
+            assert estatisticas['checkouts'] >= 3
+            assert estatisticas['em_uso'] == 0
+            assert estatisticas['conexoes'] == 0
+
+    def test_protege_fork(self):
+        with TemporaryDirectory() as tmpdir:
+            engine = create_engine(
+                'sqlite:///' + os.path.join(tmpdir, 'fork.db'),
+                connect_args={'check_same_thread': False},
+                poolclass=QueuePoolMedido)
+            protege_fork(engine)
+            conexao = engine.connect()
+            dbapi_connection = conexao.connection.connection
+            # Simula conexão aberta pelo processo pai antes do fork
+            conexao.connection.info['pid'] = -1
+            conexao.close()
+            conexao = engine.connect()
+            assert conexao.connection.info['pid'] == os.getpid()
+            assert conexao.connection.connection is not dbapi_connection
+            conexao.close()
+            engine.dispose()
@@ -1,29 +1,18 @@
-import sys
-
-
-from werkzeug.serving import run_simple
+"""Entrada WSGI: $gunicorn wsgi:app (configuração em gunicorn.conf.py).
 
-from werkzeug.middleware.dispatcher import DispatcherMiddleware
+Não mexe no schema do Banco ao subir. Para desenvolvimento, rodar este
+arquivo cria as tabelas que faltarem e sobe o servidor do Flask.
+"""
+import sys
 
 from apiserver.models import orm
 
 sys.path.insert(0, './apiserver')
 
-from apiserver.main import create_app
+from apiserver.main import create_app_producao
 
-session, engine = orm.init_db() # 'sqlite:///:memory:')
-# print(orm.Base.metadata.tables)
-orm.Base.metadata.drop_all(bind=engine)
-orm.Base.metadata.create_all(bind=engine)
-app = create_app(session, engine)
+app = create_app_producao()
 
 if __name__ == '__main__':
-    """
-    application = DispatcherMiddleware(app,
-                                       {
-                                           '/apirecintos': app
-                                       })
-
-    run_simple('localhost', 8000, application, use_reloader=True)
-    """
-    app.run(port=8000, threaded=False, debug=True)
\ No newline at end of file
+    orm.Base.metadata.create_all(bind=app.app.config['engine'])
+    app.run(port=8000, threaded=True, debug=True)
@@ -1,16 +1,13 @@
 import os
 import sys
 
-from apiserver.models import orm
-
 sys.path.insert(0, './apiserver')
 
-from apiserver.main import create_app
+from apiserver.main import create_app_producao
 
 MYSQLURI = os.environ.get('JAWSDB_URL',
                           'mysql+mysqlconnector://apirecintos@localhost/apirecintos')
-session, engine = orm.init_db(MYSQLURI)
-app = create_app(session, engine)
+app = create_app_producao(MYSQLURI)
 
 if __name__ == '__main__':
     app.run(port=8000, debug=True)